@@ -0,0 +1,147 @@
+"""Бенчмарк плановой рассылки против локального поддельного Bot API.
+
+Прогоняет prepare_concert_plan, start_concert_job и stop_concert_job на синтетических чатах
+и сохраняет время, число запросов в секунду и хвосты задержек в JSON.
+
+    python3 bench_mishakrug.py --sizes 1000,10000,100000 --latency 0.02 --save bench_baseline.json
+    python3 bench_mishakrug.py --sizes 1000,10000,100000 --latency 0.02 --compare bench_baseline.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+from unittest.mock import patch
+
+# Бенчмарку не нужны настоящие токен и администраторы
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCH')
+os.environ.setdefault('ADMIN_CHAT_ID', '1')
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+import mishakrug
+from fake_bot_api import FakeApiConfig, FakeBotApi
+
+def synthetic_chats(size: int) -> List[int]:
+    """Идентификаторы супергрупп для прогона"""
+    return [-1000000000000 - i for i in range(size)]
+
+async def _measure(name: str, size: int, server: FakeBotApi, coroutine) -> Dict[str, Any]:
+    server.reset_stats()
+    started = perf_counter()
+    report = await coroutine
+    wall_clock = perf_counter() - started
+    calls = server.total_calls
+    result = {
+        'scenario': name,
+        'chats': size,
+        'wall_clock': round(wall_clock, 4),
+        'api_calls': calls,
+        'calls_per_second': round(calls / wall_clock, 1) if wall_clock else 0.0,
+        'api_errors': sum(server.errors.values()),
+    }
+    if isinstance(report, mishakrug.FanOutReport):
+        result.update({
+            'p50': round(report.percentile(50), 4),
+            'p95': round(report.percentile(95), 4),
+            'p99': round(report.percentile(99), 4),
+            'max': round(report.percentile(100), 4),
+            'failures': len(report.failures),
+        })
+    return result
+
+async def run_benchmarks(sizes: List[int], config: FakeApiConfig, concurrency: Optional[int] = None,
+                         global_rate: float = 1e6, chat_rate: float = 1e6, shards: int = 1) -> List[Dict[str, Any]]:
+    """Прогон всех сценариев для каждого размера"""
+    concurrency = concurrency or mishakrug.FANOUT_CONCURRENCY
+    server = FakeBotApi(config)
+    server.start_in_thread()
+    results = []
+    try:
+        request = HTTPXRequest(connection_pool_size=concurrency, read_timeout=30, pool_timeout=30)
+        bot = Bot('123456:BENCH', base_url=server.base_url, request=request)
+        await bot.initialize()
+        with patch.object(mishakrug, 'FANOUT_CONCURRENCY', concurrency), \
+             patch.object(mishakrug, 'FANOUT_GLOBAL_RATE', global_rate), \
+             patch.object(mishakrug, 'FANOUT_CHAT_RATE', chat_rate), \
+             patch.object(mishakrug, 'FANOUT_CHAT_BURST', 1000), \
+             patch.object(mishakrug, 'FANOUT_SHARDS', shards), \
+             patch.object(mishakrug, 'BOT_API_URL', server.base_url):
+            for size in sizes:
+                chats = synthetic_chats(size)
+                context = SimpleNamespace(bot=bot, bot_data={
+                    'chat_registry': mishakrug.ChatRegistry(managed=chats, tracked=chats)
+                })
+                with patch.object(mishakrug, 'MODE', 'public'):
+                    target = datetime.now(mishakrug.moscow_tz)
+                    results.append(await _measure('prepare_plan_cold', size, server,
+                                                  mishakrug.prepare_concert_plan(context, 'start', target)))
+                    results.append(await _measure('prepare_plan_warm', size, server,
+                                                  mishakrug.prepare_concert_plan(context, 'start', target)))
+                with patch.object(mishakrug, 'MODE', 'secured'):
+                    results.append(await _measure('start_concert_job', size, server,
+                                                  mishakrug.start_concert_job(context)))
+                    results.append(await _measure('stop_concert_job', size, server,
+                                                  mishakrug.stop_concert_job(context)))
+        await bot.shutdown()
+    finally:
+        mishakrug.shutdown_shard_pool()
+        server.stop_thread()
+    return results
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Список сценариев, которые стали медленнее базовой линии больше чем на tolerance"""
+    previous = {(item['scenario'], item['chats']): item for item in baseline}
+    regressions = []
+    for item in results:
+        base = previous.get((item['scenario'], item['chats']))
+        if base is None or base['wall_clock'] <= 0:
+            continue
+        if item['wall_clock'] > base['wall_clock'] * (1 + tolerance):
+            regressions.append(f"{item['scenario']}@{item['chats']}: {base['wall_clock']}с -> {item['wall_clock']}с")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000', help='размеры прогонов через запятую')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа API в секундах')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--retry-after-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=None, help='лимит запросов в секунду на стороне API')
+    parser.add_argument('--concurrency', type=int, default=None, help='FANOUT_CONCURRENCY бота на время прогона')
+    parser.add_argument('--global-rate', type=float, default=1e6, help='FANOUT_GLOBAL_RATE бота на время прогона')
+    parser.add_argument('--chat-rate', type=float, default=1e6, help='FANOUT_CHAT_RATE бота на время прогона')
+    parser.add_argument('--shards', type=int, default=1, help='FANOUT_SHARDS бота на время прогона')
+    parser.add_argument('--save', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', help='сравнить с сохраненной базовой линией')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое замедление (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    config = FakeApiConfig(latency=args.latency, jitter=args.jitter, retry_after_rate=args.retry_after_rate,
+                           error_rate=args.error_rate, rate_limit=args.rate_limit, seed=0)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = asyncio.run(run_benchmarks(sizes, config, args.concurrency, args.global_rate, args.chat_rate, args.shards))
+
+    for item in results:
+        print(json.dumps(item, ensure_ascii=False))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"Регрессия: {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,25 @@
 #!/bin/bash
 
+# Каталог бота (скрипт лежит рядом с mishakrug.py)
+cd "$(dirname "$0")"
+
 # Проверяем, запущен ли бот
-if ! pgrep -f "python3 mishakrug.py"; then
+if ! pgrep -f "python3 mishakrug.py" > /dev/null; then
     # Если бот не запущен, запускаем его
-    python3 /path/to/your/mishakrug.py &
+    nohup python3 mishakrug.py > /dev/null 2>&1 &
     echo "Бот запущен."
+    exit 0
+fi
+
+# Процесс есть — проверяем, что цикл событий не завис и опрос Telegram работает
+# (код 2 — проверка не настроена, METRICS_PORT не задан)
+python3 mishakrug.py --healthcheck > /dev/null
+if [ $? -eq 1 ]; then
+    pkill -f "python3 mishakrug.py"
+    sleep 5
+    pkill -9 -f "python3 mishakrug.py"
+    nohup python3 mishakrug.py > /dev/null 2>&1 &
+    echo "Бот был нездоров и перезапущен."
 else
     echo "Бот уже работает."
 fi
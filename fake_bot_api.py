@@ -0,0 +1,302 @@
+"""Локальная замена Telegram Bot API для тестов и бенчмарков.
+
+Сервер понимает методы, которые вызывает бот, и умеет имитировать задержку сети,
+ответы 429 с retry_after, случайные ошибки и лимит запросов в секунду.
+
+Запуск отдельно:
+    python3 fake_bot_api.py --port 8081 --latency 0.05 --rate-limit 30
+Затем боту передается base_url=http://127.0.0.1:8081/bot
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+from collections import Counter, deque
+from dataclasses import dataclass
+from time import monotonic, time
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl
+
+BOT_ID = 987654321
+
+@dataclass
+class FakeApiConfig:
+    """Параметры поведения поддельного API"""
+    latency: float = 0.0  # Задержка ответа в секундах
+    jitter: float = 0.0  # Случайная добавка к задержке от 0 до jitter
+    retry_after_rate: float = 0.0  # Доля запросов, на которые отвечаем 429
+    retry_after: int = 1  # Значение retry_after в ответе 429
+    error_rate: float = 0.0  # Доля запросов, на которые отвечаем 400
+    rate_limit: Optional[float] = None  # Лимит запросов в секунду, сверх которого отвечаем 429
+    bot_is_admin: bool = True  # Является ли бот администратором во всех чатах
+    seed: Optional[int] = None
+
+class FakeBotApi:
+    """HTTP-сервер, отвечающий как Bot API"""
+
+    def __init__(self, config: Optional[FakeApiConfig] = None, host: str = '127.0.0.1', port: int = 0):
+        self.config = config or FakeApiConfig()
+        self.host = host
+        self.port = port
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.chat_permissions: Dict[int, Dict[str, bool]] = {}
+        self.updates: Deque[Dict[str, Any]] = deque()
+        self._random = random.Random(self.config.seed)
+        self._recent: Deque[float] = deque()
+        self._message_id = 0
+        self._update_id = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.Task] = set()
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def base_url(self) -> str:
+        """Адрес для параметра base_url бота"""
+        return f"http://{self.host}:{self.port}/bot"
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def reset_stats(self) -> None:
+        """Сброс счетчиков вызовов"""
+        self.calls.clear()
+        self.errors.clear()
+
+    def push_update(self, update: Dict[str, Any]) -> None:
+        """Добавление обновления в очередь для getUpdates"""
+        self._update_id += 1
+        self.updates.append({'update_id': self._update_id, **update})
+
+    async def start(self) -> None:
+        """Запуск сервера в текущем цикле событий"""
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port, backlog=1024)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        """Остановка сервера"""
+        if self._server is not None:
+            self._server.close()
+            # Клиенты держат keep-alive соединения, закрываем их сами
+            for task in self._connections:
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    def start_in_thread(self) -> None:
+        """Запуск сервера в отдельном потоке со своим циклом событий"""
+        started = threading.Event()
+
+        def run() -> None:
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self.stop())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='fake-bot-api', daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop_thread(self) -> None:
+        """Остановка сервера, запущенного через start_in_thread"""
+        if self._loop is not None and self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self._dispatch(path, headers.get('content-type', ''), body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, asyncio.CancelledError):
+            # Отмена приходит только из stop(), соединение просто закрываем
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    @staticmethod
+    def _parse_params(content_type: str, body: bytes) -> Dict[str, Any]:
+        if not body:
+            return {}
+        if content_type.startswith('application/json'):
+            return json.loads(body)
+        params = {}
+        for key, value in parse_qsl(body.decode(), keep_blank_values=True):
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        return params
+
+    async def _dispatch(self, path: str, content_type: str, body: bytes) -> Tuple[int, Dict[str, Any]]:
+        method = path.rstrip('/').rsplit('/', 1)[-1]
+        params = self._parse_params(content_type, body)
+        self.calls[method] += 1
+
+        delay = self.config.latency + self._random.random() * self.config.jitter
+        if method == 'getUpdates':
+            return 200, await self._get_updates(params)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self._over_rate_limit() or self._random.random() < self.config.retry_after_rate:
+            self.errors[method] += 1
+            return 429, {
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.config.retry_after}",
+                'parameters': {'retry_after': self.config.retry_after},
+            }
+        if self._random.random() < self.config.error_rate:
+            self.errors[method] += 1
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: injected error'}
+
+        handler = getattr(self, f"_method_{method}", None)
+        if handler is None:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+        return 200, {'ok': True, 'result': handler(params)}
+
+    def _over_rate_limit(self) -> bool:
+        if self.config.rate_limit is None:
+            return False
+        now = monotonic()
+        while self._recent and now - self._recent[0] >= 1.0:
+            self._recent.popleft()
+        if len(self._recent) >= self.config.rate_limit:
+            return True
+        self._recent.append(now)
+        return False
+
+    async def _get_updates(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        # Длинный опрос: ждем обновления не дольше timeout (но не больше секунды, чтобы быстро останавливаться)
+        deadline = monotonic() + min(float(params.get('timeout') or 0), 1.0)
+        offset = int(params.get('offset') or 0)
+        while self.updates and self.updates[0]['update_id'] < offset:
+            self.updates.popleft()
+        while not self.updates and monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        limit = int(params.get('limit') or 100)
+        return {'ok': True, 'result': [self.updates[i] for i in range(min(limit, len(self.updates)))]}
+
+    # Ответы методов Bot API
+
+    @staticmethod
+    def _user(user_id: int) -> Dict[str, Any]:
+        if user_id == BOT_ID:
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"}
+
+    def _administrator(self, user_id: int) -> Dict[str, Any]:
+        rights = user_id != BOT_ID or self.config.bot_is_admin
+        return {
+            'status': 'administrator', 'user': self._user(user_id), 'can_be_edited': False,
+            'is_anonymous': False, 'can_manage_chat': True, 'can_delete_messages': rights,
+            'can_manage_video_chats': False, 'can_restrict_members': rights, 'can_promote_members': False,
+            'can_change_info': False, 'can_invite_users': True, 'can_post_stories': False,
+            'can_edit_stories': False, 'can_delete_stories': False,
+        }
+
+    def _method_getMe(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {**self._user(BOT_ID), 'can_join_groups': True, 'can_read_all_group_messages': False,
+                'supports_inline_queries': False}
+
+    def _method_getChatMember(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        user_id = int(params['user_id'])
+        if user_id == BOT_ID:
+            return self._administrator(user_id)
+        return {'status': 'member', 'user': self._user(user_id)}
+
+    def _method_getChatAdministrators(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        owner = {'status': 'creator', 'user': self._user(1), 'is_anonymous': False}
+        return [owner, self._administrator(BOT_ID)]
+
+    def _method_getChat(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = int(params['chat_id'])
+        chat = {'id': chat_id, 'type': 'supergroup', 'title': f"Chat {chat_id}",
+                'accent_color_id': 0, 'max_reaction_count': 11,
+                'accepted_gift_types': {'unlimited_gifts': False, 'limited_gifts': False,
+                                        'unique_gifts': False, 'premium_subscription': False,
+                                        'gifts_from_channels': False}}
+        if chat_id in self.chat_permissions:
+            chat['permissions'] = self.chat_permissions[chat_id]
+        return chat
+
+    def _method_setChatPermissions(self, params: Dict[str, Any]) -> bool:
+        self.chat_permissions[int(params['chat_id'])] = params.get('permissions', {})
+        return True
+
+    def _method_sendMessage(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        self._message_id += 1
+        return {'message_id': self._message_id, 'date': int(time()), 'text': params.get('text', ''),
+                'chat': {'id': int(params['chat_id']), 'type': 'supergroup'}, 'from': self._user(BOT_ID)}
+
+    def _method_deleteMessage(self, params: Dict[str, Any]) -> bool:
+        return True
+
+    def _method_deleteMessages(self, params: Dict[str, Any]) -> bool:
+        return True
+
+    def _method_setWebhook(self, params: Dict[str, Any]) -> bool:
+        return True
+
+    def _method_deleteWebhook(self, params: Dict[str, Any]) -> bool:
+        return True
+
+def main() -> None:
+    """Запуск поддельного API из командной строки"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--retry-after-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=None)
+    args = parser.parse_args()
+
+    config = FakeApiConfig(latency=args.latency, jitter=args.jitter, retry_after_rate=args.retry_after_rate,
+                           retry_after=args.retry_after, error_rate=args.error_rate, rate_limit=args.rate_limit)
+    server = FakeBotApi(config, args.host, args.port)
+
+    async def serve() -> None:
+        await server.start()
+        print(f"Поддельный Bot API слушает {server.base_url}")
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Нагрузочный тест обработки обновлений против локального поддельного Bot API.
+
+Подает синтетические Update прямо в Application.process_update с заданной частотой (через тот же
+обработчик параллельных обновлений, что и при polling) и проверяет, что реестр чатов в bot_data
+после прогона согласован: в нем ровно те чаты и признаки, которые следуют из поданных команд.
+
+    python3 loadtest_mishakrug.py --updates 20000 --chats 2000 --rate 2000 --latency 0.02
+    python3 loadtest_mishakrug.py --mode public --updates 20000 --save load_baseline.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter, time
+from typing import Any, Dict, List, Optional, Set, Tuple
+from unittest.mock import patch
+
+# Нагрузочному тесту не нужны настоящие токен и администраторы
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCH')
+os.environ.setdefault('ADMIN_CHAT_ID', '1')
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes
+
+import mishakrug
+from bench_mishakrug import compare, synthetic_chats
+from fake_bot_api import FakeApiConfig, FakeBotApi
+
+ADMIN_ID = 1  # Администратор бота (secured) и владелец каждого чата в поддельном API (public)
+
+def _message(update_id: int, chat_id: int, user_id: int, **fields: Any) -> Dict[str, Any]:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f"Chat {chat_id}"},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"},
+            **fields,
+        },
+    }
+
+def command(update_id: int, chat_id: int, name: str, user_id: int = ADMIN_ID) -> Dict[str, Any]:
+    """Сообщение с командой /name"""
+    text = f"/{name}"
+    return _message(update_id, chat_id, user_id, text=text,
+                    entities=[{'type': 'bot_command', 'offset': 0, 'length': len(text)}])
+
+def bot_added(update_id: int, chat_id: int) -> Dict[str, Any]:
+    """Сервисное сообщение о добавлении бота в чат"""
+    bot = {'id': 987654321, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}
+    return _message(update_id, chat_id, ADMIN_ID, new_chat_members=[bot])
+
+def make_workload(mode: str, updates: int, chats: List[int], seed: int = 0) -> Tuple[List[Dict[str, Any]], Dict[str, Set[int]]]:
+    """Поток обновлений и состояние реестра, которое должно получиться после их обработки.
+
+    Порядок обработки параллельных обновлений не определен, поэтому каждый чат получает команды,
+    итог которых от порядка не зависит: регистрацию (или добавление бота) и только запуски
+    или только остановки концерта.
+    """
+    rng = random.Random(seed)
+    join = 'register_chat' if mode == 'secured' else None
+    starting = set(chats[::2])
+    touched = {'joined': set(), 'start': set(), 'stop': set()}
+    workload = []
+    for update_id in range(1, updates + 1):
+        chat_id = rng.choice(chats)
+        if rng.random() < 0.5:
+            touched['joined'].add(chat_id)
+            data = command(update_id, chat_id, join) if join else bot_added(update_id, chat_id)
+        else:
+            kind = 'start' if chat_id in starting else 'stop'
+            touched[kind].add(chat_id)
+            data = command(update_id, chat_id, f"{kind}_concert")
+        workload.append(data)
+    expected = {
+        'managed' if mode == 'secured' else 'tracked': touched['joined'],
+        'in_concert': touched['start'],
+    }
+    return workload, expected
+
+def check_registry(registry: mishakrug.ChatRegistry, expected: Dict[str, Set[int]]) -> List[str]:
+    """Расхождения реестра с ожидаемым состоянием и нарушения его внутренних инвариантов"""
+    problems = []
+    ids = list(registry.snapshot())
+    if any(a >= b for a, b in zip(ids, ids[1:])):
+        problems.append("chat_id в реестре не упорядочены или повторяются")
+    for name, chats in expected.items():
+        actual = set(getattr(registry, name))
+        if actual != chats:
+            problems.append(f"{name}: лишних {len(actual - chats)}, недостает {len(chats - actual)}")
+        if len(getattr(registry, name)) != len(registry.snapshot().chats(name)):
+            problems.append(f"{name}: счетчик расходится с признаками")
+    return problems
+
+def _percentile(values: List[float], p: float) -> float:
+    return mishakrug.FanOutReport._percentile(values, p)
+
+async def run_load(mode: str, updates: int, chats: int, rate: float, config: FakeApiConfig,
+                   workers: Optional[int] = None, seed: int = 0) -> Dict[str, Any]:
+    """Один прогон: подача обновлений с частотой rate (0 — без пауз), замер задержек и проверка реестра"""
+    workers = workers or mishakrug.UPDATE_WORKERS
+    server = FakeBotApi(config)
+    server.start_in_thread()
+    workload, expected = make_workload(mode, updates, synthetic_chats(chats), seed)
+    latencies: List[float] = []
+    errors: List[str] = []
+
+    async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        errors.append(repr(context.error))
+
+    try:
+        with tempfile.TemporaryDirectory() as directory, \
+             patch.object(mishakrug, 'MODE', mode), \
+             patch.object(mishakrug, 'TOKEN', '123456:BENCH'), \
+             patch.object(mishakrug, 'ADMIN_CHAT_IDS', [ADMIN_ID]), \
+             patch.object(mishakrug, 'BOT_API_URL', server.base_url), \
+             patch.object(mishakrug, 'UPDATE_WORKERS', workers), \
+             patch.object(mishakrug, 'REGISTRY_DB', os.path.join(directory, 'registry.db')):
+            application: Application = mishakrug.build_application()
+            application.add_error_handler(on_error)
+            await application.initialize()
+            server.reset_stats()
+
+            async def feed(data: Dict[str, Any]) -> None:
+                started = perf_counter()
+                update = Update.de_json(data, application.bot)
+                # Так же, как при polling: параллельность ограничивает update_processor приложения
+                await application.update_processor.process_update(update, application.process_update(update))
+                latencies.append(perf_counter() - started)
+
+            tasks = []
+            started = perf_counter()
+            for index, data in enumerate(workload):
+                if rate > 0:
+                    delay = started + index / rate - perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(feed(data)))
+            await asyncio.gather(*tasks)
+            wall_clock = perf_counter() - started
+
+            problems = check_registry(mishakrug.get_chat_registry(application), expected)
+            await application.shutdown()
+    finally:
+        server.stop_thread()
+
+    if errors:
+        problems.append(f"ошибок в обработчиках: {len(errors)}, первая: {errors[0]}")
+    return {
+        'scenario': f"updates_{mode}",
+        'chats': chats,
+        'updates': updates,
+        'rate': rate,
+        'wall_clock': round(wall_clock, 4),
+        'updates_per_second': round(updates / wall_clock, 1) if wall_clock else 0.0,
+        'p50': round(_percentile(latencies, 50), 4),
+        'p95': round(_percentile(latencies, 95), 4),
+        'p99': round(_percentile(latencies, 99), 4),
+        'max': round(_percentile(latencies, 100), 4),
+        'api_calls': server.total_calls,
+        'api_errors': sum(server.errors.values()),
+        'consistent': not problems,
+        'problems': problems,
+    }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('secured', 'public'), default='secured', help='MODE бота на время прогона')
+    parser.add_argument('--updates', type=int, default=10000, help='сколько обновлений подать')
+    parser.add_argument('--chats', type=int, default=1000, help='между сколькими чатами их распределить')
+    parser.add_argument('--rate', type=float, default=0.0, help='обновлений в секунду (0 — без пауз)')
+    parser.add_argument('--workers', type=int, default=None, help='UPDATE_WORKERS бота на время прогона')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа API в секундах')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='сохранить результат в JSON')
+    parser.add_argument('--compare', help='сравнить с сохраненной базовой линией')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое замедление (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    config = FakeApiConfig(latency=args.latency, jitter=args.jitter, seed=args.seed)
+    result = asyncio.run(run_load(args.mode, args.updates, args.chats, args.rate, config, args.workers, args.seed))
+
+    print(json.dumps(result, ensure_ascii=False))
+    for problem in result['problems']:
+        print(f"Несогласованность: {problem}", file=sys.stderr)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump([result], f, ensure_ascii=False, indent=2)
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare([result], json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"Регрессия: {line}", file=sys.stderr)
+    return 1 if regressions or not result['consistent'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
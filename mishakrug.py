@@ -1,41 +1,1479 @@
+# Отсчет времени запуска для --profile-startup начинается до остальных импортов
+from time import monotonic, perf_counter, time as wall_time
+_IMPORT_STARTED = perf_counter()
+
 import os
-import pytz
-from datetime import datetime, time
+import sys
+from dataclasses import dataclass, field
+from typing import (
+    TYPE_CHECKING, Any, Awaitable, Callable, Dict, FrozenSet, Iterable, Iterator, List, Mapping, Optional, Sequence,
+    Set, Tuple
+)
 from dotenv import load_dotenv
+
+def parse_admin_ids(value: Optional[str]) -> FrozenSet[int]:
+    """chat_id администраторов из строки через запятую; пустые и нечисловые значения пропускаются"""
+    items = (item.strip() for item in (value or '').split(','))
+    return frozenset(int(item) for item in items if item.lstrip('-').isdigit())
+
+_MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+@dataclass(frozen=True)
+class Settings:
+    """Настройки бота из переменных окружения (и файла .env).
+
+    Ошибки разбора числовых значений не мешают созданию настроек: они собираются в errors,
+    а запуск бота с такими настройками останавливает check_settings().
+    """
+    token: Optional[str]
+    mode: str  # secured или public
+    admin_chat_ids: FrozenSet[int]  # Используются только в secured режиме
+
+    # Расписание концертов для чатов без собственного (дни, время запуска и остановки, часовой пояс)
+    concert_schedule: str
+    # Разброс срабатываний: чаты одного расписания делятся на корзины, которые стартуют через равные доли schedule_jitter секунд
+    schedule_jitter: float
+    schedule_jitter_buckets: int
+    # За сколько минут до планового запуска или остановки готовить список чатов и проверять права
+    prewarm_minutes: int
+
+    # Параметры рассылки по чатам (лимиты Telegram: ~30 запросов в секунду на бота и 20 сообщений в минуту на группу)
+    fanout_concurrency: int
+    fanout_global_rate: float
+    fanout_chat_rate: float
+    fanout_chat_burst: int
+
+    # Повторы запросов при RetryAfter и сетевых ошибках, сохранение прогресса и продолжение прерванной рассылки
+    fanout_max_retries: int
+    fanout_retry_backoff: float  # Первая пауза при сетевой ошибке, дальше вдвое больше
+    fanout_checkpoint_interval: float
+    fanout_resume_max_age: float  # Часы, после которых прерванную рассылку не продолжаем
+
+    # Число процессов плановой рассылки: чаты делятся между ними по chat_id, общий лимит запросов — поровну (1 — без процессов)
+    fanout_shards: int
+    bot_api_url: str  # Адрес Bot API (например, локального сервера)
+
+    # Сводка ошибок плановой рассылки для администраторов: одно сообщение на рассылку, не длиннее лимита Telegram
+    admin_digest_max_length: int
+    admin_digest_max_chats: int  # Сколько chat_id показывать для каждой ошибки
+    admin_notify_rate: float  # Сообщений администраторам в секунду
+
+    # Удаление во время концерта всех сообщений, кроме видеосообщений (в том числе от администраторов, на которых
+    # не действуют разрешения чата). Удаления копятся в очереди и уходят пачками через delete_messages
+    enforce_concert: bool
+    enforce_flush_interval: float  # Как часто отправлять накопленные удаления
+    enforce_queue_size: int  # Сколько сообщений может ждать удаления
+    enforce_chat_rate: float  # Вызовов delete_messages в секунду на чат
+
+    # Время жизни закешированных прав бота в чате (секунды); кеш обновляется событиями my_chat_member
+    bot_rights_ttl: float
+    # Время жизни закешированного списка администраторов чата (секунды, public режим)
+    chat_admins_ttl: float
+
+    # Файл базы с реестром чатов и интервал сброса изменений в нее (секунды)
+    registry_db: str
+    registry_flush_interval: float
+
+    # Логирование: файл (пустое значение — только консоль), ротация по размеру или по времени
+    log_level: str
+    log_file: str
+    log_max_bytes: int
+    log_backup_count: int
+    log_rotate_when: str  # Например, midnight или W0; пусто — ротация по размеру
+
+    # Пулы соединений с Bot API: getUpdates, команды и плановые рассылки ходят через разные пулы,
+    # чтобы ответы на команды не стояли в очереди за тысячами set_chat_permissions
+    http_version: str  # 2 — HTTP/2 (нужен python-telegram-bot[http2])
+    http_pool_size: int  # Соединений для обработчиков обновлений
+    http_pool_timeout: float  # Сколько ждать свободного соединения
+    http_keepalive_expiry: float  # Сколько держать простаивающее соединение
+    fanout_pool_size: int  # Соединений для плановых рассылок
+
+    # Способ получения обновлений (не зависит от mode): polling или webhook
+    transport: str
+    update_workers: int  # Сколько обновлений обрабатывается одновременно
+
+    # Настройки встроенного webhook-сервера (используются при transport=webhook)
+    webhook_url: Optional[str]  # Публичный адрес, на который Telegram будет присылать обновления
+    webhook_listen: str
+    webhook_port: int
+    webhook_path: str
+    webhook_secret: str  # Без явного секрета генерируется новый при каждом запуске
+    webhook_max_connections: int
+
+    # HTTP-эндпоинт /metrics в формате Prometheus (0 — выключен); на том же сервере отдаются /healthz и /readyz
+    metrics_port: int
+    metrics_listen: str
+
+    # Проверка здоровья
+    health_lag_interval: float  # Как часто замерять задержку цикла событий
+    health_max_lag: float  # Допустимая задержка цикла событий в секундах
+    health_max_poll_age: float  # Сколько секунд можно жить без успешного getUpdates
+    health_watchdog: bool  # Завершать процесс при потере здоровья
+
+    errors: Tuple[str, ...] = field(default=())  # Ошибки разбора значений
+
+    @classmethod
+    def from_env(cls, env: Optional[Mapping[str, str]] = None) -> 'Settings':
+        """Настройки из env (по умолчанию — из os.environ)"""
+        env = os.environ if env is None else env
+        errors: List[str] = []
+
+        def number(name: str, default: Any, kind: type) -> Any:
+            value = env.get(name)
+            try:
+                return kind(value) if value is not None else default
+            except ValueError:
+                errors.append(f"{name}={value!r} — нужно {'целое ' if kind is int else ''}число")
+                return default
+
+        def flag(name: str) -> bool:
+            return env.get(name, '0').lower() in ('1', 'true', 'yes')
+
+        mode = env.get('MODE', 'secured').lower()
+        fanout_concurrency = number('FANOUT_CONCURRENCY', 32, int)
+        webhook_secret = env.get('WEBHOOK_SECRET')
+        if not webhook_secret:
+            import secrets
+            webhook_secret = secrets.token_urlsafe(32)
+        return cls(
+            token=env.get('TELEGRAM_BOT_TOKEN'),
+            mode=mode,
+            admin_chat_ids=parse_admin_ids(env.get('ADMIN_CHAT_ID')) if mode == 'secured' else frozenset(),
+            concert_schedule=env.get('CONCERT_SCHEDULE', 'пн 08:00 23:59 Europe/Moscow'),
+            schedule_jitter=number('SCHEDULE_JITTER', 0.0, float),
+            schedule_jitter_buckets=number('SCHEDULE_JITTER_BUCKETS', 10, int),
+            prewarm_minutes=number('PREWARM_MINUTES', 5, int),
+            fanout_concurrency=fanout_concurrency,
+            fanout_global_rate=number('FANOUT_GLOBAL_RATE', 30.0, float),
+            fanout_chat_rate=number('FANOUT_CHAT_RATE', 20 / 60, float),
+            fanout_chat_burst=number('FANOUT_CHAT_BURST', 20, int),
+            fanout_max_retries=number('FANOUT_MAX_RETRIES', 5, int),
+            fanout_retry_backoff=number('FANOUT_RETRY_BACKOFF', 1.0, float),
+            fanout_checkpoint_interval=number('FANOUT_CHECKPOINT_INTERVAL', 2.0, float),
+            fanout_resume_max_age=number('FANOUT_RESUME_MAX_AGE', 12.0, float),
+            fanout_shards=number('FANOUT_SHARDS', 1, int),
+            bot_api_url=env.get('BOT_API_URL', 'https://api.telegram.org/bot'),
+            admin_digest_max_length=number('ADMIN_DIGEST_MAX_LENGTH', 4000, int),
+            admin_digest_max_chats=number('ADMIN_DIGEST_MAX_CHATS', 10, int),
+            admin_notify_rate=number('ADMIN_NOTIFY_RATE', 1.0, float),
+            enforce_concert=flag('ENFORCE_CONCERT'),
+            enforce_flush_interval=number('ENFORCE_FLUSH_INTERVAL', 1.0, float),
+            enforce_queue_size=number('ENFORCE_QUEUE_SIZE', 10000, int),
+            enforce_chat_rate=number('ENFORCE_CHAT_RATE', 1.0, float),
+            bot_rights_ttl=number('BOT_RIGHTS_TTL', 86400.0, float),
+            chat_admins_ttl=number('CHAT_ADMINS_TTL', 300.0, float),
+            registry_db=env.get('REGISTRY_DB', os.path.join(_MODULE_DIR, 'mishakrug.db')),
+            registry_flush_interval=number('REGISTRY_FLUSH_INTERVAL', 5.0, float),
+            log_level=env.get('LOG_LEVEL', 'INFO').upper(),
+            log_file=env.get('LOG_FILE', os.path.join(_MODULE_DIR, 'mishakrug.log')),
+            log_max_bytes=number('LOG_MAX_BYTES', 10 * 1024 * 1024, int),
+            log_backup_count=number('LOG_BACKUP_COUNT', 5, int),
+            log_rotate_when=env.get('LOG_ROTATE_WHEN', ''),
+            http_version=env.get('HTTP_VERSION', '1.1'),
+            http_pool_size=number('HTTP_POOL_SIZE', 64, int),
+            http_pool_timeout=number('HTTP_POOL_TIMEOUT', 5.0, float),
+            http_keepalive_expiry=number('HTTP_KEEPALIVE_EXPIRY', 60.0, float),
+            fanout_pool_size=number('FANOUT_POOL_SIZE', fanout_concurrency, int),
+            transport=env.get('TRANSPORT', 'polling').lower(),
+            update_workers=number('UPDATE_WORKERS', 256, int),
+            webhook_url=env.get('WEBHOOK_URL'),
+            webhook_listen=env.get('WEBHOOK_LISTEN', '0.0.0.0'),
+            webhook_port=number('WEBHOOK_PORT', 8443, int),
+            webhook_path=env.get('WEBHOOK_PATH', 'telegram'),
+            webhook_secret=webhook_secret,
+            webhook_max_connections=number('WEBHOOK_MAX_CONNECTIONS', 40, int),
+            metrics_port=number('METRICS_PORT', 0, int),
+            metrics_listen=env.get('METRICS_LISTEN', '127.0.0.1'),
+            health_lag_interval=number('HEALTH_LAG_INTERVAL', 1.0, float),
+            health_max_lag=number('HEALTH_MAX_LAG', 5.0, float),
+            health_max_poll_age=number('HEALTH_MAX_POLL_AGE', 120.0, float),
+            health_watchdog=flag('HEALTH_WATCHDOG'),
+            errors=tuple(errors),
+        )
+
+def run_healthcheck(settings: Settings) -> int:
+    """Проверка работающего бота через /healthz: 0 — здоров, иначе — нет (для cron и супервизоров)"""
+    if not settings.metrics_port:
+        print("Для проверки здоровья нужно указать METRICS_PORT", file=sys.stderr)
+        return 2
+    import urllib.error
+    import urllib.request
+
+    host = '127.0.0.1' if settings.metrics_listen in ('0.0.0.0', '') else settings.metrics_listen
+    try:
+        with urllib.request.urlopen(f"http://{host}:{settings.metrics_port}/healthz", timeout=10) as response:
+            print(response.read().decode())
+            return 0
+    except urllib.error.HTTPError as e:
+        print(e.read().decode(), file=sys.stderr)
+        return 1
+    except OSError as e:
+        print(f"Бот не отвечает: {e}", file=sys.stderr)
+        return 1
+
+# Загрузка переменных окружения
+load_dotenv()
+
+if __name__ == '__main__' and '--healthcheck' in sys.argv[1:]:
+    # Проверку здоровья cron запускает каждую минуту, а ей нужны только адрес и порт /healthz:
+    # завершаемся до импорта python-telegram-bot, asyncio и остального
+    sys.exit(run_healthcheck(Settings.from_env()))
+
+import asyncio
+import bisect
+import contextlib
+import heapq
+import functools
+import itertools
+from array import array
+from collections import Counter
+from collections.abc import Set as AbstractSet
+from operator import itemgetter
+import threading
+from datetime import datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import logging
-from pathlib import Path
-from telegram import Update, ChatPermissions, ChatMemberAdministrator
+import logging.handlers
+import queue
+from telegram import Bot, Update, ChatPermissions, ChatMember, ChatMemberAdministrator
 from telegram.ext import (
     Application,
+    BasePersistence,
+    ChatMemberHandler,
     CommandHandler,
     MessageHandler,
     ContextTypes,
+    PersistenceInput,
+    TypeHandler,
     filters,
     JobQueue
 )
-from telegram.error import TelegramError, BadRequest
+from telegram.request import HTTPXRequest
+from telegram.error import TelegramError, BadRequest, NetworkError, RetryAfter
 
-# Загрузка переменных окружения
-load_dotenv()
+if TYPE_CHECKING:
+    # Пул процессов нужен только при FANOUT_SHARDS > 1, а ssl — только при создании пулов соединений;
+    # оба импортируются при первом обращении
+    import ssl
+    from concurrent.futures import ProcessPoolExecutor
+
+class StartupProfile:
+    """Время запуска бота по фазам (python mishakrug.py --profile-startup)"""
+
+    def __init__(self, started: float):
+        self.started = started
+        self._last = started
+        self.phases: List[Tuple[str, float]] = []
+        self.milestones: List[Tuple[str, float]] = []
 
-# Получение настроек из переменных окружения
-TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-MODE = os.getenv('MODE', 'secured').lower()  # По умолчанию используем secured режим
+    def mark(self, name: str) -> None:
+        """Конец фазы name: в отчет идет время с конца предыдущей"""
+        now = perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
 
-# Получение списка ID администраторов (используется только в secured режиме)
-ADMIN_CHAT_IDS = set(int(admin_id.strip()) for admin_id in os.getenv('ADMIN_CHAT_ID').split(',')) if MODE == 'secured' else set()
+    def milestone(self, name: str) -> None:
+        """Отметка времени от начала запуска (например, когда бот начал принимать обновления)"""
+        self.milestones.append((name, perf_counter() - self.started))
+
+    def report(self) -> str:
+        rows = [*self.phases, *self.milestones, ('всего', self._last - self.started)]
+        width = max(len(name) for name, _ in rows)
+        return '\n'.join(f"{name:<{width}}  {duration * 1000:8.1f} мс" for name, duration in rows)
+
+STARTUP = StartupProfile(_IMPORT_STARTED)
+STARTUP.mark("импорт библиотек")
+
+SETTINGS = Settings.from_env()
+
+# Модульные имена настроек: ими пользуется остальной код, их же подменяют тесты и бенчмарки
+TOKEN = SETTINGS.token
+MODE = SETTINGS.mode
+ADMIN_CHAT_IDS = SETTINGS.admin_chat_ids
+CONCERT_SCHEDULE = SETTINGS.concert_schedule
+SCHEDULE_JITTER = SETTINGS.schedule_jitter
+SCHEDULE_JITTER_BUCKETS = SETTINGS.schedule_jitter_buckets
+PREWARM_MINUTES = SETTINGS.prewarm_minutes
+FANOUT_CONCURRENCY = SETTINGS.fanout_concurrency
+FANOUT_GLOBAL_RATE = SETTINGS.fanout_global_rate
+FANOUT_CHAT_RATE = SETTINGS.fanout_chat_rate
+FANOUT_CHAT_BURST = SETTINGS.fanout_chat_burst
+FANOUT_MAX_RETRIES = SETTINGS.fanout_max_retries
+FANOUT_RETRY_BACKOFF = SETTINGS.fanout_retry_backoff
+FANOUT_CHECKPOINT_INTERVAL = SETTINGS.fanout_checkpoint_interval
+FANOUT_RESUME_MAX_AGE = SETTINGS.fanout_resume_max_age
+FANOUT_SHARDS = SETTINGS.fanout_shards
+BOT_API_URL = SETTINGS.bot_api_url
+ADMIN_DIGEST_MAX_LENGTH = SETTINGS.admin_digest_max_length
+ADMIN_DIGEST_MAX_CHATS = SETTINGS.admin_digest_max_chats
+ADMIN_NOTIFY_RATE = SETTINGS.admin_notify_rate
+ENFORCE_CONCERT = SETTINGS.enforce_concert
+ENFORCE_FLUSH_INTERVAL = SETTINGS.enforce_flush_interval
+ENFORCE_QUEUE_SIZE = SETTINGS.enforce_queue_size
+ENFORCE_CHAT_RATE = SETTINGS.enforce_chat_rate
+BOT_RIGHTS_TTL = SETTINGS.bot_rights_ttl
+CHAT_ADMINS_TTL = SETTINGS.chat_admins_ttl
+REGISTRY_DB = SETTINGS.registry_db
+REGISTRY_FLUSH_INTERVAL = SETTINGS.registry_flush_interval
+LOG_LEVEL = SETTINGS.log_level
+LOG_FILE = SETTINGS.log_file
+LOG_MAX_BYTES = SETTINGS.log_max_bytes
+LOG_BACKUP_COUNT = SETTINGS.log_backup_count
+LOG_ROTATE_WHEN = SETTINGS.log_rotate_when
+HTTP_VERSION = SETTINGS.http_version
+HTTP_POOL_SIZE = SETTINGS.http_pool_size
+HTTP_POOL_TIMEOUT = SETTINGS.http_pool_timeout
+HTTP_KEEPALIVE_EXPIRY = SETTINGS.http_keepalive_expiry
+FANOUT_POOL_SIZE = SETTINGS.fanout_pool_size
+TRANSPORT = SETTINGS.transport
+UPDATE_WORKERS = SETTINGS.update_workers
+WEBHOOK_URL = SETTINGS.webhook_url
+WEBHOOK_LISTEN = SETTINGS.webhook_listen
+WEBHOOK_PORT = SETTINGS.webhook_port
+WEBHOOK_PATH = SETTINGS.webhook_path
+WEBHOOK_SECRET = SETTINGS.webhook_secret
+WEBHOOK_MAX_CONNECTIONS = SETTINGS.webhook_max_connections
+METRICS_PORT = SETTINGS.metrics_port
+METRICS_LISTEN = SETTINGS.metrics_listen
+HEALTH_LAG_INTERVAL = SETTINGS.health_lag_interval
+HEALTH_MAX_LAG = SETTINGS.health_max_lag
+HEALTH_MAX_POLL_AGE = SETTINGS.health_max_poll_age
+HEALTH_WATCHDOG = SETTINGS.health_watchdog
 
 # Московское время
-moscow_tz = pytz.timezone('Europe/Moscow')
+moscow_tz = ZoneInfo('Europe/Moscow')
+
+# Разрешения на время концерта (разрешаем только видеокружочки)
+CONCERT_PERMISSIONS = ChatPermissions(
+    can_send_messages=False, 
+    can_send_other_messages=False,
+    can_add_web_page_previews=False,
+    can_send_polls=False,
+    can_change_info=False,
+    can_invite_users=True,
+    can_pin_messages=False,
+    can_send_photos=False,
+    can_send_videos=False, 
+    can_send_audios=False,
+    can_send_documents=False,
+    can_send_video_notes=True,  # Разрешаем только видеокружочки
+    can_send_voice_notes=False
+)
+
+# Обычные разрешения после концерта
+NORMAL_PERMISSIONS = ChatPermissions(
+    can_send_messages=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+    can_send_polls=True,
+    can_change_info=False,
+    can_invite_users=True,
+    can_pin_messages=False,
+    can_send_photos=True,
+    can_send_videos=True,
+    can_send_audios=True,
+    can_send_documents=True,
+    can_send_video_notes=True,
+    can_send_voice_notes=True
+)
+
+CONCERT_ANNOUNCEMENTS = {
+    'start': "Я включаю Михаила Круга",
+    'stop': "Концерт Михаила Круга окончен, мемасы снова доступны",
+}
+
+def check_settings() -> List[str]:
+    """Ошибки настроек, с которыми бот не запустится"""
+    problems = list(SETTINGS.errors)
+    try:
+        ChatSchedule.parse(CONCERT_SCHEDULE)
+    except ValueError as e:
+        problems.append(f"CONCERT_SCHEDULE={CONCERT_SCHEDULE!r}: {e}")
+    if not TOKEN:
+        problems.append("не задан TELEGRAM_BOT_TOKEN")
+    if MODE not in ('secured', 'public'):
+        problems.append(f"неизвестный MODE={MODE} (secured или public)")
+    if MODE == 'secured' and not ADMIN_CHAT_IDS:
+        problems.append("в secured режиме нужен ADMIN_CHAT_ID (chat_id администраторов через запятую)")
+    if TRANSPORT not in ('polling', 'webhook'):
+        problems.append(f"неизвестный TRANSPORT={TRANSPORT} (polling или webhook)")
+    elif TRANSPORT == 'webhook' and not WEBHOOK_URL:
+        problems.append("для TRANSPORT=webhook нужно указать WEBHOOK_URL")
+    return problems
+
+STARTUP.mark("чтение настроек")
+
+class Metrics:
+    """Счетчики и гистограммы в текстовом формате Prometheus"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self):
+        self._descriptions: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        # Для гистограммы: число попаданий в каждую корзину (последняя — +Inf) и сумма значений
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Tuple[List[int], List[float]]] = {}
+
+    def describe(self, name: str, kind: str, description: str) -> None:
+        self._descriptions[name] = (kind, description)
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = ([0] * (len(self.BUCKETS) + 1), [0.0])
+        histogram[0][bisect.bisect_left(self.BUCKETS, value)] += 1
+        histogram[1][0] += value
+
+    @staticmethod
+    def _labels(labels: Iterable[Tuple[str, str]]) -> str:
+        pairs = []
+        for k, v in labels:
+            v = v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{k}="{v}"')
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self, gauges: Iterable[Tuple[str, Dict[str, Any], float]] = ()) -> str:
+        """Все метрики в текстовом формате; gauges — текущие значения, которые считаются при запросе"""
+        samples: Dict[str, List[str]] = {}
+        for (name, labels), value in self._counters.items():
+            samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (counts, total) in self._histograms.items():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total[0]}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        for name, labels, value in gauges:
+            pairs = tuple(sorted((k, str(v)) for k, v in labels.items()))
+            samples.setdefault(name, []).append(f"{name}{self._labels(pairs)} {value}")
+
+        output = []
+        for name in sorted(samples):
+            kind, description = self._descriptions.get(name, ('untyped', ''))
+            output.append(f"# HELP {name} {description}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+METRICS = Metrics()
+METRICS.describe('bot_api_request_duration_seconds', 'histogram', 'Время запросов к Bot API по методам')
+METRICS.describe('bot_api_requests_total', 'counter', 'Запросы к Bot API по методам и кодам ответа')
+METRICS.describe('handler_duration_seconds', 'histogram', 'Время обработки команд')
+METRICS.describe('fanout_duration_seconds', 'histogram', 'Длительность плановой рассылки')
+METRICS.describe('fanout_drift_seconds', 'histogram', 'Отставание смены разрешений в чате от планового времени')
+METRICS.describe('fanout_chats_total', 'counter', 'Чаты, обработанные плановой рассылкой, по результату')
+METRICS.describe('cache_requests_total', 'counter', 'Обращения к кешам по результату (hit/miss)')
+METRICS.describe('registry_chats', 'gauge', 'Размер реестра чатов')
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, который замеряет время каждого запроса к Bot API"""
+
+    async def do_request(self, url: str, method: str, *args: Any, **kwargs: Any) -> Tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]  # Без токена, который есть в адресе
+        started = perf_counter()
+        status = 'error'
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            if api_method == 'getUpdates' and code == 200:
+                HEALTH.record_poll()
+            return code, payload
+        finally:
+            METRICS.observe('bot_api_request_duration_seconds', perf_counter() - started, method=api_method)
+            METRICS.inc('bot_api_requests_total', method=api_method, status=status)
+
+@functools.lru_cache(maxsize=None)
+def _ssl_context() -> 'ssl.SSLContext':
+    # Одна загрузка корневых сертификатов на все пулы вместо своей для каждого (~20 мс на пул)
+    import ssl
+    import certifi
+    return ssl.create_default_context(cafile=certifi.where())
+
+def http_request(pool_size: int, request_class: type = InstrumentedHTTPXRequest) -> HTTPXRequest:
+    """Пул соединений с Bot API на pool_size соединений с общими настройками HTTP"""
+    import httpx
+
+    return request_class(
+        connection_pool_size=pool_size,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        http_version=HTTP_VERSION,
+        httpx_kwargs={
+            # Простаивающие соединения не закрываются сразу: между пачками запросов не тратим время на новые
+            'limits': httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            ),
+            'verify': _ssl_context(),
+        },
+    )
+
+def measure_handler(func: Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[Any]]):
+    """Замер времени обработки команды"""
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Any:
+        started = perf_counter()
+        try:
+            return await func(update, context)
+        finally:
+            METRICS.observe('handler_duration_seconds', perf_counter() - started, handler=func.__name__)
+    return wrapper
+
+class HealthMonitor:
+    """Задержка цикла событий, свежесть обновлений и итог последней плановой рассылки"""
+
+    def __init__(self):
+        started = monotonic()
+        self.lag = 0.0
+        self.ready = False
+        self._last_tick = started
+        self._last_poll = started  # До первого getUpdates отсчитываем от старта
+        self._last_update: Optional[float] = None
+        self.last_job: Optional[Dict[str, Any]] = None
+        self._ticker: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def record_poll(self) -> None:
+        self._last_poll = monotonic()
+
+    def record_update(self) -> None:
+        self._last_update = monotonic()
+
+    def record_job(self, kind: str, report: Optional['FanOutReport'] = None, error: Optional[str] = None) -> None:
+        """Итог плановой рассылки (report is None — чатов не было или рассылка упала)"""
+        self.last_job = {
+            'kind': kind,
+            'finished_at': datetime.now(moscow_tz).isoformat(),
+            'ok': error is None and (report is None or not report.failures),
+            'chats': report.total if report is not None else 0,
+            'failures': len(report.failures) if report is not None else 0,
+            'error': error,
+        }
+
+    def current_lag(self) -> float:
+        # Если цикл событий завис, тикер не успевает обновить lag — считаем по времени последнего тика
+        if self._ticker is None:
+            return self.lag
+        return max(self.lag, monotonic() - self._last_tick - HEALTH_LAG_INTERVAL)
+
+    def status(self) -> Dict[str, Any]:
+        """Состояние для /healthz и /readyz"""
+        now = monotonic()
+        lag = self.current_lag()
+        poll_age = now - self._last_poll
+        problems = []
+        if lag > HEALTH_MAX_LAG:
+            problems.append(f"задержка цикла событий {lag:.1f}с")
+        if TRANSPORT == 'polling' and poll_age > HEALTH_MAX_POLL_AGE:
+            problems.append(f"нет успешного getUpdates {poll_age:.0f}с")
+        return {
+            'healthy': not problems,
+            'ready': self.ready and not problems,
+            'problems': problems,
+            'event_loop_lag': round(lag, 4),
+            'seconds_since_last_poll': round(poll_age, 1) if TRANSPORT == 'polling' else None,
+            'seconds_since_last_update': round(now - self._last_update, 1) if self._last_update is not None else None,
+            'last_job': self.last_job,
+        }
+
+    def gauges(self) -> Iterable[Tuple[str, Dict[str, Any], float]]:
+        """Показатели здоровья для /metrics"""
+        now = monotonic()
+        yield 'event_loop_lag_seconds', {}, self.current_lag()
+        if TRANSPORT == 'polling':
+            yield 'seconds_since_last_poll', {}, now - self._last_poll
+        if self._last_update is not None:
+            yield 'seconds_since_last_update', {}, now - self._last_update
+
+    async def _tick(self) -> None:
+        while True:
+            started = monotonic()
+            await asyncio.sleep(HEALTH_LAG_INTERVAL)
+            self._last_tick = monotonic()
+            self.lag = self._last_tick - started - HEALTH_LAG_INTERVAL
+
+    def _watch(self) -> None:
+        # Отдельный поток: зависший цикл событий сам себя не остановит
+        while not self._stopped.wait(HEALTH_LAG_INTERVAL):
+            status = self.status()
+            if not status['healthy']:
+                reason = f"Бот нездоров ({', '.join(status['problems'])}), завершаем процесс"
+                logging.getLogger(__name__).critical("%s", reason)
+                print(reason, file=sys.stderr)
+                # os._exit не ждет потока слушателя логов: причину перезапуска дописываем в файл до выхода
+                flush_logging()
+                os._exit(1)
+
+    def start(self, watchdog: bool = False) -> None:
+        self._last_tick = monotonic()
+        self._ticker = asyncio.ensure_future(self._tick())
+        if watchdog:
+            self._stopped.clear()
+            self._watchdog = threading.Thread(target=self._watch, name='health-watchdog', daemon=True)
+            self._watchdog.start()
+
+    async def stop(self) -> None:
+        self.ready = False
+        self._stopped.set()
+        if self._ticker is not None:
+            self._ticker.cancel()
+            await asyncio.gather(self._ticker, return_exceptions=True)
+            self._ticker = None
+
+HEALTH = HealthMonitor()
+METRICS.describe('event_loop_lag_seconds', 'gauge', 'Задержка цикла событий')
+METRICS.describe('seconds_since_last_poll', 'gauge', 'Время с последнего успешного getUpdates')
+METRICS.describe('seconds_since_last_update', 'gauge', 'Время с последнего обработанного обновления')
+
+async def track_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отметка о каждом обработанном обновлении"""
+    HEALTH.record_update()
+
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, не более capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Приостановка выдачи токенов (например, по ответу RetryAfter)"""
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+    def idle(self, now: float) -> bool:
+        """Запас полон и никто не ждет: такое ведро можно выбросить и при нужде создать заново"""
+        tokens = self._tokens + (now - self._updated) * self.rate
+        return tokens >= self.capacity and self._paused_until <= now and not self._lock.locked()
+
+    async def acquire(self) -> None:
+        """Ожидание свободного токена"""
+        async with self._lock:
+            while True:
+                paused = self._paused_until - monotonic()
+                if paused > 0:
+                    await asyncio.sleep(paused)
+                    continue
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class RateLimiter:
+    """Общий лимит запросов бота плюс отдельный лимит на каждый чат.
+
+    С parent запрос проходит еще и общий лимит родителя: так удаления и уведомления администраторам
+    держат свои лимиты на чат, но укладываются в общий на процесс лимит Bot API (get_api_limiter).
+    Собственный общий лимит у такого ограничителя есть, только если global_rate задан явно.
+    """
+
+    def __init__(self, global_rate: Optional[float] = None,
+                 chat_rate: Optional[float] = None, chat_burst: Optional[int] = None,
+                 parent: Optional['RateLimiter'] = None):
+        # Значения по умолчанию читаются при создании, чтобы их можно было менять без перезагрузки модуля
+        self._global = TokenBucket(global_rate or FANOUT_GLOBAL_RATE) if global_rate or parent is None else None
+        self._parent = parent
+        self._chat_rate = chat_rate or FANOUT_CHAT_RATE
+        self._chat_burst = chat_burst or FANOUT_CHAT_BURST
+        self._chats: Dict[int, TokenBucket] = {}
+        self._prune_at = 1024
+
+    async def acquire(self, chat_id: int) -> None:
+        """Ожидание разрешения на один запрос к API в указанном чате"""
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self._prune_at:
+                self._prune()
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        # Сначала лимит чата, чтобы ожидающий чат не занимал общий лимит
+        await bucket.acquire()
+        await self._acquire_global()
+
+    async def _acquire_global(self) -> None:
+        if self._global is not None:
+            await self._global.acquire()
+        if self._parent is not None:
+            await self._parent._acquire_global()
+
+    def _prune(self) -> None:
+        # Ограничитель живет все время работы бота: ведра чатов с полным запасом не копим
+        now = monotonic()
+        self._chats = {chat_id: bucket for chat_id, bucket in self._chats.items() if not bucket.idle(now)}
+        self._prune_at = max(1024, 2 * len(self._chats))
+
+    def pause(self, seconds: float) -> None:
+        """Приостановка всех запросов через этот ограничитель и его родителя"""
+        if self._global is not None:
+            self._global.pause(seconds)
+        if self._parent is not None:
+            self._parent.pause(seconds)
+
+    @contextlib.contextmanager
+    def lend(self, parts: int) -> Iterator[float]:
+        """Доли общего лимита для parts процессов рассылки на время их работы.
+
+        Лимит делится на parts + 1 равных долей: по одной получает каждый процесс, одна остается
+        этому процессу для остальных запросов. Вложенные и параллельные займы складываются.
+        """
+        bucket = self._global
+        share = bucket.rate / (parts + 1)
+        bucket.rate -= share * parts
+        try:
+            yield share
+        finally:
+            bucket.rate += share * parts
+
+    async def call(self, chat_id: int, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        """Запрос к API в чате с соблюдением лимитов и повторами.
+
+        При RetryAfter приостанавливаются все запросы бота на указанное Telegram время,
+        при сетевых ошибках запрос повторяется с растущей паузой. BadRequest и прочие ошибки не повторяются.
+        """
+        attempt = 0
+        while True:
+            await self.acquire(chat_id)
+            try:
+                return await func(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= FANOUT_MAX_RETRIES:
+                    raise
+                retry_after = e.retry_after
+                self.pause(retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after))
+            except BadRequest:
+                raise
+            except NetworkError:
+                if attempt >= FANOUT_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(FANOUT_RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+
+_api_limiter: Optional[Tuple[asyncio.AbstractEventLoop, RateLimiter]] = None
+
+def get_api_limiter() -> RateLimiter:
+    """Общий на процесс ограничитель запросов к Bot API.
+
+    Через него идут все плановые рассылки, в том числе наложившиеся друг на друга корзины разброса,
+    и, через собственные ограничители с parent, удаления и уведомления администраторам.
+    RetryAfter, полученный любым из них, приостанавливает всех.
+    """
+    global _api_limiter
+    loop = asyncio.get_running_loop()
+    # Примитивы asyncio привязаны к своему циклу событий
+    if _api_limiter is None or _api_limiter[0] is not loop:
+        _api_limiter = (loop, RateLimiter())
+    return _api_limiter[1]
+
+@dataclass
+class FanOutReport:
+    """Итоги одного прохода по чатам: счетчики, ошибки и задержки"""
+    name: str
+    total: int = 0
+    succeeded: int = 0
+    skipped: int = 0
+    failures: Dict[int, str] = field(default_factory=dict)
+    latencies: List[float] = field(default_factory=list)
+    drifts: List[float] = field(default_factory=list)  # Отставание от планового времени по чатам
+    duration: float = 0.0
+
+    @staticmethod
+    def _percentile(values: List[float], p: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+        return ordered[index]
+
+    def percentile(self, p: float) -> float:
+        """Перцентиль задержки обработки одного чата в секундах"""
+        return self._percentile(self.latencies, p)
+
+    def drift_percentile(self, p: float) -> float:
+        """Перцентиль отставания момента обработки чата от планового времени в секундах"""
+        return self._percentile(self.drifts, p)
+
+    def summary(self) -> str:
+        """Краткая сводка для лога"""
+        summary = (f"{self.name}: чатов {self.total}, успешно {self.succeeded}, пропущено {self.skipped}, "
+                   f"ошибок {len(self.failures)}, длительность {self.duration:.2f}с, "
+                   f"p50 {self.percentile(50):.3f}с, p95 {self.percentile(95):.3f}с, "
+                   f"p99 {self.percentile(99):.3f}с, max {self.percentile(100):.3f}с")
+        if self.drifts:
+            summary += (f", отставание от плана p50 {self.drift_percentile(50):.3f}с, "
+                        f"p99 {self.drift_percentile(99):.3f}с, max {self.drift_percentile(100):.3f}с")
+        return summary
+
+    def __str__(self) -> str:
+        # Сводка собирается только если запись действительно попадет в лог
+        return self.summary()
+
+async def run_fan_out(
+    name: str,
+    chat_ids: Iterable[int],
+    action: Callable[[int, RateLimiter], Awaitable[Optional[bool]]],
+    limiter: Optional[RateLimiter] = None,
+    concurrency: Optional[int] = None,
+    target: Optional[float] = None,
+    checkpoint: Optional[Callable[[], Awaitable[None]]] = None,
+) -> FanOutReport:
+    """Параллельная обработка чатов с ограничением числа одновременных задач и частоты запросов.
+
+    action(chat_id, limiter) должен делать запросы к API через limiter.call (или вызывать
+    limiter.acquire(chat_id) перед каждым запросом) и возвращать False, если чат пропущен.
+    Если передано плановое время target (unix time), для каждого успешно обработанного чата
+    записывается отставание от него. checkpoint вызывается каждые FANOUT_CHECKPOINT_INTERVAL секунд.
+    """
+    chat_ids = list(chat_ids)
+    report = FanOutReport(name, total=len(chat_ids))
+    if not chat_ids:
+        return report
+    limiter = limiter or get_api_limiter()
+    concurrency = concurrency or FANOUT_CONCURRENCY
+    pending = iter(chat_ids)
+    started = perf_counter()
+
+    async def worker() -> None:
+        for chat_id in pending:
+            chat_started = perf_counter()
+            try:
+                result = await action(chat_id, limiter)
+            except Exception as e:
+                report.failures[chat_id] = str(e)
+            else:
+                if result is False:
+                    report.skipped += 1
+                else:
+                    report.succeeded += 1
+                    if target is not None:
+                        report.drifts.append(wall_time() - target)
+            report.latencies.append(perf_counter() - chat_started)
+
+    async def save_progress() -> None:
+        while True:
+            await asyncio.sleep(FANOUT_CHECKPOINT_INTERVAL)
+            try:
+                await checkpoint()
+            except Exception as e:
+                logging.getLogger(__name__).error("Не удалось сохранить прогресс рассылки: %s", e)
+
+    progress = asyncio.ensure_future(save_progress()) if checkpoint is not None else None
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(chat_ids))))))
+    finally:
+        if progress is not None:
+            progress.cancel()
+    report.duration = perf_counter() - started
+    return report
+
+async def announce_in_chat(bot: Bot, limiter: RateLimiter, chat_id: int, text: str) -> bool:
+    """Объявление о концерте: сообщение, которое сразу удаляется"""
+    msg = await limiter.call(chat_id, bot.send_message, chat_id, text)
+    await limiter.call(chat_id, msg.delete)
+    return True
+
+@dataclass
+class ShardTask:
+    """Часть плановой рассылки для одного процесса"""
+    name: str
+    kind: str
+    phase: str  # 'permissions' — смена разрешений, 'announce' — объявления
+    chat_ids: Sequence[int]
+    target: Optional[float]
+    global_rate: float
+    concurrency: int
+
+def shard_of(chat_id: int, shards: int) -> int:
+    """Номер процесса, который обслуживает чат"""
+    return chat_id % shards
+
+def partition_by_shard(chat_ids: Iterable[int], shards: int) -> List[array]:
+    """Чаты, разложенные по процессам; array('q') передается в процесс одним блоком байтов"""
+    parts = [array('q') for _ in range(shards)]
+    for chat_id in chat_ids:
+        parts[shard_of(chat_id, shards)].append(chat_id)
+    return parts
+
+# Цикл событий и бот процесса пула: создаются один раз при старте процесса и служат всем его рассылкам
+_shard_loop: Optional[asyncio.AbstractEventLoop] = None
+_shard_bot: Optional[Bot] = None
+
+def _init_shard(token: str, base_url: str, concurrency: int) -> None:
+    """Инициализатор процесса пула: свой цикл событий и свой бот с пулом соединений"""
+    global _shard_loop, _shard_bot
+    import multiprocessing.util
+
+    _shard_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_shard_loop)
+    _shard_bot = Bot(token, base_url=base_url, request=http_request(concurrency, HTTPXRequest))
+    # Соединения закрываются, когда пул останавливает процесс
+    multiprocessing.util.Finalize(None, _close_shard, exitpriority=10)
+
+def _close_shard() -> None:
+    with contextlib.suppress(Exception):
+        _shard_loop.run_until_complete(_shard_bot.shutdown())
+    _shard_loop.close()
+
+async def _run_shard(task: ShardTask) -> FanOutReport:
+    # getMe выполняется только при первой рассылке процесса, дальше бот уже инициализирован
+    bot = _shard_bot
+    await bot.initialize()
+    limiter = RateLimiter(global_rate=task.global_rate)
+    if task.phase == 'permissions':
+        permissions = CONCERT_PERMISSIONS if task.kind == 'start' else NORMAL_PERMISSIONS
+
+        async def action(chat_id: int, limiter: RateLimiter) -> bool:
+            await limiter.call(chat_id, bot.set_chat_permissions, chat_id, permissions)
+            return True
+    else:
+        text = CONCERT_ANNOUNCEMENTS[task.kind]
+
+        async def action(chat_id: int, limiter: RateLimiter) -> bool:
+            return await announce_in_chat(bot, limiter, chat_id, text)
+
+    return await run_fan_out(task.name, task.chat_ids, action, limiter, task.concurrency, task.target)
+
+def run_shard(task: ShardTask) -> FanOutReport:
+    """Исполнение части рассылки в процессе пула"""
+    return _shard_loop.run_until_complete(_run_shard(task))
+
+def _shard_ready() -> int:
+    # Прогрев: бот процесса инициализируется заранее, а не в плановое время
+    _shard_loop.run_until_complete(_shard_bot.initialize())
+    return os.getpid()
+
+_shard_pool: Optional['ProcessPoolExecutor'] = None
+_shard_pool_key: Optional[Tuple[str, str, int]] = None
+
+def get_shard_pool(token: str) -> 'ProcessPoolExecutor':
+    """Пул процессов рассылки, создается при первом обращении"""
+    global _shard_pool, _shard_pool_key
+    key = (token, BOT_API_URL, FANOUT_CONCURRENCY)
+    if _shard_pool is not None and _shard_pool_key != key:
+        # Боты процессов созданы под другие токен или адрес API
+        shutdown_shard_pool()
+    if _shard_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # spawn, а не fork: в родительском процессе уже работают цикл событий и потоки
+        _shard_pool = ProcessPoolExecutor(max_workers=FANOUT_SHARDS, mp_context=multiprocessing.get_context('spawn'),
+                                          initializer=_init_shard, initargs=key)
+        _shard_pool_key = key
+    return _shard_pool
+
+async def warm_shard_pool(token: str) -> None:
+    """Запуск процессов пула и инициализация их ботов заранее, чтобы в плановое время не ждать ни того, ни другого"""
+    loop = asyncio.get_running_loop()
+    pool = get_shard_pool(token)
+    await asyncio.gather(*(loop.run_in_executor(pool, _shard_ready) for _ in range(FANOUT_SHARDS)))
+
+def shutdown_shard_pool() -> None:
+    """Остановка процессов рассылки"""
+    global _shard_pool, _shard_pool_key
+    if _shard_pool is not None:
+        _shard_pool.shutdown(cancel_futures=True)
+        _shard_pool = None
+        _shard_pool_key = None
+
+async def run_sharded(name: str, kind: str, phase: str, chat_ids: List[int], token: str,
+                      target: Optional[float] = None) -> FanOutReport:
+    """Рассылка, разделенная между FANOUT_SHARDS процессами, с общим отчетом"""
+    shards = partition_by_shard(chat_ids, FANOUT_SHARDS)
+    loop = asyncio.get_running_loop()
+    pool = get_shard_pool(token)
+    started = perf_counter()
+
+    # Процессы получают свои доли общего лимита процесса на время рассылки, лимит чата соблюдается внутри его процесса
+    with get_api_limiter().lend(FANOUT_SHARDS) as share:
+        tasks = [
+            ShardTask(f"{name} [{index + 1}/{FANOUT_SHARDS}]", kind, phase, shard, target, share, FANOUT_CONCURRENCY)
+            for index, shard in enumerate(shards) if shard
+        ]
+        reports = await asyncio.gather(*(loop.run_in_executor(pool, run_shard, task) for task in tasks))
+
+    report = FanOutReport(name=name)
+    for shard_report in reports:
+        report.total += shard_report.total
+        report.succeeded += shard_report.succeeded
+        report.skipped += shard_report.skipped
+        report.failures.update(shard_report.failures)
+        report.latencies.extend(shard_report.latencies)
+        report.drifts.extend(shard_report.drifts)
+    report.duration = perf_counter() - started
+    return report
+
+@dataclass(frozen=True)
+class BotRights:
+    """Права бота в чате на момент проверки"""
+    is_admin: bool
+    can_restrict_members: bool
+    can_delete_messages: bool
+    checked_at: float
+
+    @classmethod
+    def from_member(cls, member: Optional[ChatMember]) -> 'BotRights':
+        """Права из объекта участника чата, описывающего самого бота (None — бота нет среди администраторов)"""
+        if isinstance(member, ChatMemberAdministrator):
+            return cls(True, bool(member.can_restrict_members), bool(member.can_delete_messages), monotonic())
+        return cls(False, False, False, monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return monotonic() - self.checked_at >= BOT_RIGHTS_TTL
+
+    def __deepcopy__(self, memo: dict) -> 'BotRights':
+        # Объект неизменяемый, копировать его при сохранении bot_data незачем
+        return self
+
+class BotRightsCache(Dict[int, BotRights]):
+    """Кеш прав бота по чатам"""
+
+    def __deepcopy__(self, memo: dict) -> 'BotRightsCache':
+        # Кеш не сохраняется, а копировать его целиком при каждом сбросе bot_data дорого
+        return self
+
+def _bot_rights_cache(context: ContextTypes.DEFAULT_TYPE) -> Dict[int, BotRights]:
+    """Кеш прав бота по чатам, хранится в bot_data"""
+    return context.bot_data.setdefault('bot_rights', BotRightsCache())
+
+async def get_bot_rights(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
+                         limiter: Optional[RateLimiter] = None) -> BotRights:
+    """Права бота в чате: из кеша, а при его отсутствии или устаревании — через get_chat_member"""
+    cache = _bot_rights_cache(context)
+    rights = cache.get(chat_id)
+    if rights is not None and not rights.expired:
+        METRICS.inc('cache_requests_total', cache='bot_rights', result='hit')
+        return rights
+    METRICS.inc('cache_requests_total', cache='bot_rights', result='miss')
+    if limiter is not None:
+        # С ограничителем права проверяются в рассылке — через пул соединений рассылок
+        bot = get_fanout_bot(context)
+        bot_member = await limiter.call(chat_id, bot.get_chat_member, chat_id, bot.id)
+    else:
+        bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
+    rights = cache[chat_id] = BotRights.from_member(bot_member)
+    return rights
+
+_fanout_bot: Optional[Bot] = None
+
+def get_fanout_bot(context: Any) -> Bot:
+    """Бот для плановых рассылок: со своим пулом соединений, если он создан в post_init"""
+    return _fanout_bot if _fanout_bot is not None else context.bot
+
+async def start_fanout_bot(token: str) -> Bot:
+    """Создание бота для рассылок с пулом на FANOUT_POOL_SIZE соединений"""
+    global _fanout_bot
+    bot = Bot(token, base_url=BOT_API_URL, request=http_request(FANOUT_POOL_SIZE))
+    await bot.initialize()
+    _fanout_bot = bot
+    return bot
+
+async def stop_fanout_bot() -> None:
+    global _fanout_bot
+    if _fanout_bot is not None:
+        await _fanout_bot.shutdown()
+        _fanout_bot = None
+
+def invalidate_bot_rights(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+    """Сброс закешированных прав бота в чате"""
+    _bot_rights_cache(context).pop(chat_id, None)
+
+async def track_bot_rights(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обновление кеша прав бота по событиям my_chat_member"""
+    member_update = update.my_chat_member
+    chat_id = member_update.chat.id
+    rights = BotRights.from_member(member_update.new_chat_member)
+    _bot_rights_cache(context)[chat_id] = rights
+
+    # Бот входит в список администраторов, поэтому этот список тоже устарел
+    get_chat_admins_cache(context).invalidate(chat_id)
+
+    # В public режиме заодно запоминаем чат, в который добавили бота
+    if MODE == 'public' and rights.is_admin:
+        get_chat_registry(context).add_tracked(chat_id)
+
+class ChatAdminsCache:
+    """Кеш списков администраторов чатов.
+
+    Список загружается одним запросом get_chat_administrators и используется и для проверки
+    пользователя, и для проверки прав самого бота. Одновременные запросы по одному чату
+    объединяются в один запрос к API.
+    """
+
+    def __init__(self):
+        self._entries: Dict[int, Tuple[frozenset, float]] = {}
+        self._inflight: Dict[int, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __deepcopy__(self, memo: dict) -> 'ChatAdminsCache':
+        # Кеш не сохраняется, а незавершенные запросы копировать нельзя
+        return self
+
+    async def get(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> frozenset:
+        """Идентификаторы администраторов чата"""
+        entry = self._entries.get(chat_id)
+        if entry is not None and monotonic() - entry[1] < CHAT_ADMINS_TTL:
+            self.hits += 1
+            METRICS.inc('cache_requests_total', cache='chat_admins', result='hit')
+            return entry[0]
+        task = self._inflight.get(chat_id)
+        if task is None:
+            self.misses += 1
+            METRICS.inc('cache_requests_total', cache='chat_admins', result='miss')
+            task = self._inflight[chat_id] = asyncio.ensure_future(self._fetch(context, chat_id))
+            task.add_done_callback(lambda _: self._inflight.pop(chat_id, None))
+        else:
+            self.hits += 1
+            METRICS.inc('cache_requests_total', cache='chat_admins', result='hit')
+        # shield: отмена одного ожидающего не должна отменять общий запрос
+        return await asyncio.shield(task)
+
+    async def _fetch(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> frozenset:
+        administrators = await context.bot.get_chat_administrators(chat_id)
+        admin_ids = frozenset(member.user.id for member in administrators)
+
+        # Заодно обновляем права бота: если его нет в списке, он не администратор
+        bot_member = next((member for member in administrators if member.user.id == context.bot.id), None)
+        _bot_rights_cache(context)[chat_id] = BotRights.from_member(bot_member)
+
+        self._entries[chat_id] = (admin_ids, monotonic())
+        return admin_ids
+
+    def invalidate(self, chat_id: int) -> None:
+        """Сброс закешированного списка администраторов чата"""
+        self._entries.pop(chat_id, None)
+
+def get_chat_admins_cache(context: ContextTypes.DEFAULT_TYPE) -> ChatAdminsCache:
+    """Кеш администраторов чатов из bot_data (создается при первом обращении)"""
+    return context.bot_data.setdefault('chat_admins', ChatAdminsCache())
+
+async def track_chat_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сброс кеша администраторов, когда кого-то в чате повышают или понижают"""
+    member_update = update.chat_member
+    admin_statuses = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+    if member_update.old_chat_member.status in admin_statuses or member_update.new_chat_member.status in admin_statuses:
+        get_chat_admins_cache(context).invalidate(member_update.chat.id)
+
+WEEKDAYS = ('пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс')
+
+@dataclass(frozen=True)
+class ChatSchedule:
+    """Расписание концертов чата: дни недели (0 — понедельник), время запуска и остановки, часовой пояс.
+
+    Если остановка не позже запуска, концерт заканчивается на следующий день.
+    """
+    days: Tuple[int, ...]
+    start: time
+    stop: time
+    tz: str
+
+    @classmethod
+    def parse(cls, text: str) -> 'ChatSchedule':
+        """Разбор строки вида «пн,ср-пт 08:00 23:59 Europe/Moscow» (часовой пояс можно не указывать)"""
+        parts = text.split()
+        if len(parts) not in (3, 4):
+            raise ValueError("Формат: дни время_запуска время_остановки [часовой_пояс], например: пн,чт 08:00 23:59 Europe/Moscow")
+        days: Set[int] = set()
+        for item in parts[0].lower().split(','):
+            if item in ('*', 'ежедневно'):
+                days.update(range(7))
+                continue
+            first, _, last = item.partition('-')
+            if first not in WEEKDAYS or (last and last not in WEEKDAYS):
+                raise ValueError(f"Неизвестный день недели: {item} (используйте {', '.join(WEEKDAYS)})")
+            start_day, stop_day = WEEKDAYS.index(first), WEEKDAYS.index(last or first)
+            days.update(range(start_day, stop_day + 1) if start_day <= stop_day else [*range(start_day, 7), *range(stop_day + 1)])
+        try:
+            start, stop = (datetime.strptime(value, '%H:%M').time() for value in parts[1:3])
+        except ValueError:
+            raise ValueError("Время указывается в формате ЧЧ:ММ, например 08:00")
+        tz = parts[3] if len(parts) == 4 else 'Europe/Moscow'
+        try:
+            ZoneInfo(tz)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"Неизвестный часовой пояс: {tz}")
+        return cls(tuple(sorted(days)), start, stop, tz)
+
+    def describe(self) -> str:
+        """Расписание в том же виде, в каком его принимает parse"""
+        days = ','.join(WEEKDAYS[day] for day in self.days)
+        return f"{days} {self.start:%H:%M} {self.stop:%H:%M} {self.tz}"
+
+    def next_time(self, kind: str, after: float) -> float:
+        """Ближайшее после after (unix time) время запуска ('start') или остановки ('stop')"""
+        tz = ZoneInfo(self.tz)
+        today = datetime.fromtimestamp(after, tz).date()
+        overnight = self.stop <= self.start
+        # Остановка после полуночи относится к концерту предыдущего дня, поэтому начинаем со вчерашнего
+        for offset in range(-1, 9):
+            day = today + timedelta(days=offset)
+            if day.weekday() not in self.days:
+                continue
+            if kind == 'start':
+                moment = datetime.combine(day, self.start, tzinfo=tz)
+            else:
+                moment = datetime.combine(day + timedelta(days=overnight), self.stop, tzinfo=tz)
+            if moment.timestamp() > after:
+                return moment.timestamp()
+        raise ValueError("В расписании нет ни одного дня")
+
+try:
+    DEFAULT_SCHEDULE = ChatSchedule.parse(CONCERT_SCHEDULE)
+except ValueError:
+    # Модуль все равно импортируется, а запуск с таким расписанием останавливает check_settings()
+    DEFAULT_SCHEDULE = ChatSchedule.parse('пн 08:00 23:59 Europe/Moscow')
+
+class RegistrySnapshot:
+    """Снимок реестра для задач рассылки: те же массивы, что у реестра, без копирования.
+
+    Реестр не меняет массивы, пока на них есть снимок, а при первом изменении делает себе копию.
+    """
+
+    def __init__(self, ids: array, flags: bytearray):
+        self._ids = ids
+        self._flags = flags
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ids)
+
+    def __contains__(self, chat_id: object) -> bool:
+        return self.flags(chat_id) != 0
+
+    def flags(self, chat_id: object) -> int:
+        """Битовая маска признаков чата (0 — чата нет в реестре)"""
+        index = bisect.bisect_left(self._ids, chat_id)
+        if index < len(self._ids) and self._ids[index] == chat_id:
+            return self._flags[index]
+        return 0
+
+    def chats(self, *names: str) -> array:
+        """Чаты, у которых есть хотя бы один из признаков names, по возрастанию chat_id"""
+        selected = self._flags.translate(ChatRegistry.selector(ChatRegistry.mask(*names)))
+        return array('q', itertools.compress(self._ids, selected))
+
+class _FlagView(AbstractSet):
+    """Живое множество чатов реестра с одним признаком"""
+
+    def __init__(self, registry: 'ChatRegistry', index: int):
+        self._registry = registry
+        self._index = index
+
+    def __contains__(self, chat_id: object) -> bool:
+        return bool(self._registry.flags(chat_id) & (1 << self._index))
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._registry.snapshot().chats(ChatRegistry.FIELDS[self._index]))
+
+    def __len__(self) -> int:
+        return self._registry._counts[self._index]
+
+    def __repr__(self) -> str:
+        return f"{{{', '.join(map(str, self))}}}"
+
+class ChatRegistry:
+    """Реестр чатов: зарегистрированные (secured режим) и известные боту (public режим),
+    а также состояние концерта в каждом чате.
+
+    Чаты хранятся в отсортированном array('q'), признаки — битами в параллельном bytearray:
+    проверка чата — двоичный поиск, а перебор и снимки для рассылки не создают Python-объектов на каждый чат.
+    Все изменения попадают в журнал, который персистентность сбрасывает в базу построчно.
+    """
+
+    # Признаки чата в порядке колонок таблицы chats; номер признака — номер бита в маске
+    FIELDS = ('managed', 'tracked', 'in_concert', 'pending')
+
+    def __init__(self, managed: Iterable[int] = (), tracked: Iterable[int] = ()):
+        rows = dict.fromkeys(managed, self.mask('managed'))
+        tracked_bit = self.mask('tracked')
+        for chat_id in tracked:
+            rows[chat_id] = rows.get(chat_id, 0) | tracked_bit
+        self._load(sorted(rows.items()))
+        self._dirty: Set[int] = set()
+        # Собственные расписания есть у немногих чатов, остальные идут по DEFAULT_SCHEDULE
+        self.schedules: Dict[int, ChatSchedule] = {}
+        self._dirty_schedules: Set[int] = set()
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[int, int]]) -> 'ChatRegistry':
+        """Реестр из пар (chat_id, маска признаков), уже отсортированных по chat_id"""
+        registry = cls()
+        registry._load(rows)
+        return registry
+
+    def _load(self, rows: Iterable[Tuple[int, int]]) -> None:
+        rows = list(rows)
+        self._ids = array('q', map(itemgetter(0), rows))
+        self._flags = bytearray(map(itemgetter(1), rows))
+        self._counts = [self._flags.translate(self.selector(1 << index)).count(1) for index in range(len(self.FIELDS))]
+        self._shared = False
+
+    @classmethod
+    def mask(cls, *names: str) -> int:
+        """Битовая маска признаков"""
+        return sum(1 << cls.FIELDS.index(name) for name in names)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def selector(mask: int) -> bytes:
+        """Таблица для bytes.translate: 1 для масок признаков, пересекающихся с mask, иначе 0"""
+        return bytes(1 if flags & mask else 0 for flags in range(256))
+
+    managed = property(lambda self: _FlagView(self, 0), doc="Зарегистрированные чаты (secured режим)")
+    tracked = property(lambda self: _FlagView(self, 1), doc="Чаты, в которых появлялся бот (public режим)")
+    in_concert = property(lambda self: _FlagView(self, 2), doc="Чаты, где сейчас идет концерт")
+    pending = property(lambda self: _FlagView(self, 3), doc="Чаты, где смена разрешений начата, но не подтверждена")
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __deepcopy__(self, memo: dict) -> 'ChatRegistry':
+        # PTB копирует bot_data перед сохранением; реестр сам отдает изменения через журнал
+        return self
+
+    def snapshot(self) -> RegistrySnapshot:
+        """Снимок текущего состояния без копирования массивов"""
+        self._shared = True
+        return RegistrySnapshot(self._ids, self._flags)
+
+    def flags(self, chat_id: object) -> int:
+        """Битовая маска признаков чата (0 — чата нет в реестре)"""
+        index = bisect.bisect_left(self._ids, chat_id)
+        if index < len(self._ids) and self._ids[index] == chat_id:
+            return self._flags[index]
+        return 0
+
+    def _update(self, chat_id: int, add: int = 0, remove: int = 0) -> bool:
+        """Установка и снятие признаков чата; False, если ничего не изменилось"""
+        index = bisect.bisect_left(self._ids, chat_id)
+        found = index < len(self._ids) and self._ids[index] == chat_id
+        old = self._flags[index] if found else 0
+        new = (old | add) & ~remove
+        if new == old:
+            return False
+        if self._shared:
+            # Копия при записи: выданные снимки продолжают видеть прежнее состояние
+            self._ids, self._flags, self._shared = array('q', self._ids), bytearray(self._flags), False
+        if not found:
+            self._ids.insert(index, chat_id)
+            self._flags.insert(index, new)
+        elif new:
+            self._flags[index] = new
+        else:
+            # Чат без признаков из реестра удаляется
+            del self._ids[index]
+            del self._flags[index]
+        for bit in range(len(self.FIELDS)):
+            self._counts[bit] += ((new >> bit) & 1) - ((old >> bit) & 1)
+        self._dirty.add(chat_id)
+        return True
+
+    def add_managed(self, chat_id: int) -> bool:
+        """Регистрация чата; False, если он уже был зарегистрирован"""
+        return self._update(chat_id, add=self.mask('managed'))
+
+    def remove_managed(self, chat_id: int) -> bool:
+        """Отмена регистрации чата; False, если он не был зарегистрирован"""
+        return self._update(chat_id, remove=self.mask('managed'))
+
+    def add_tracked(self, chat_id: int) -> bool:
+        """Запоминание чата, в котором появился бот; False, если он уже известен"""
+        return self._update(chat_id, add=self.mask('tracked'))
+
+    def is_in_concert(self, chat_id: int) -> bool:
+        """Идет ли сейчас концерт в чате"""
+        return bool(self.flags(chat_id) & self.mask('in_concert'))
+
+    def needs_change(self, chat_id: int, in_concert: bool) -> bool:
+        """Нужно ли менять разрешения в чате, чтобы привести его в состояние in_concert"""
+        return self.is_in_concert(chat_id) != in_concert
+
+    def set_concert(self, chat_id: int, in_concert: bool) -> None:
+        """Запоминание подтвержденного состояния концерта в чате"""
+        concert, pending = self.mask('in_concert'), self.mask('pending')
+        if in_concert:
+            self._update(chat_id, add=concert, remove=pending)
+        else:
+            self._update(chat_id, remove=concert | pending)
+
+    def mark_pending(self, chat_ids: Iterable[int]) -> None:
+        """Отметка чатов, в которых начинается смена разрешений"""
+        pending = self.mask('pending')
+        for chat_id in chat_ids:
+            self._update(chat_id, add=pending)
+
+    def clear_pending(self, chat_id: int) -> None:
+        """Снятие отметки без изменения состояния (смена разрешений не удалась)"""
+        self._update(chat_id, remove=self.mask('pending'))
+
+    def schedule_of(self, chat_id: int) -> ChatSchedule:
+        """Расписание, по которому живет чат"""
+        return self.schedules.get(chat_id, DEFAULT_SCHEDULE)
+
+    def set_schedule(self, chat_id: int, schedule: Optional[ChatSchedule]) -> Optional[ChatSchedule]:
+        """Собственное расписание чата (None — расписание по умолчанию); возвращает прежнее"""
+        previous = self.schedules.pop(chat_id, None)
+        if schedule is not None and schedule != DEFAULT_SCHEDULE:
+            self.schedules[chat_id] = schedule
+        if self.schedules.get(chat_id) != previous:
+            self._dirty_schedules.add(chat_id)
+        return previous
+
+    def pop_schedule_changes(self) -> List[Tuple[int, Optional[ChatSchedule]]]:
+        """Расписания чатов, изменившиеся с прошлого вызова (None — вернулось расписание по умолчанию)"""
+        dirty, self._dirty_schedules = self._dirty_schedules, set()
+        return [(chat_id, self.schedules.get(chat_id)) for chat_id in dirty]
+
+    def row(self, chat_id: int) -> Tuple[bool, ...]:
+        """Признаки чата в порядке FIELDS"""
+        flags = self.flags(chat_id)
+        return tuple(bool(flags & (1 << index)) for index in range(len(self.FIELDS)))
+
+    def pop_changes(self) -> List[Tuple[int, Tuple[bool, ...]]]:
+        """Строки (chat_id, признаки), изменившиеся с прошлого вызова"""
+        dirty, self._dirty = self._dirty, set()
+        return [(chat_id, self.row(chat_id)) for chat_id in dirty]
+
+def get_chat_registry(context: ContextTypes.DEFAULT_TYPE) -> ChatRegistry:
+    """Реестр чатов из bot_data (создается при первом обращении)"""
+    return context.bot_data.setdefault('chat_registry', ChatRegistry())
+
+def _get_persistence(context: ContextTypes.DEFAULT_TYPE) -> Optional['SQLitePersistence']:
+    """Подключенная база реестра, если она есть"""
+    application = getattr(context, 'application', None)
+    persistence = getattr(application, 'persistence', None)
+    return persistence if isinstance(persistence, SQLitePersistence) else None
+
+async def flush_registry(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Немедленная запись изменений реестра в базу, не дожидаясь очередного сброса"""
+    persistence = _get_persistence(context)
+    if persistence is not None:
+        await persistence.update_bot_data(context.bot_data)
 
 async def is_user_admin(chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Проверка, является ли пользователь администратором чата"""
     try:
-        chat_member = await context.bot.get_chat_member(chat_id, user_id)
-        return isinstance(chat_member, ChatMemberAdministrator) or chat_member.status == 'creator'
+        return user_id in await get_chat_admins_cache(context).get(context, chat_id)
     except TelegramError:
         return False
 
+@measure_handler
 async def start_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Запуск концерта вручную (только для администратора)"""
     user_id = update.effective_user.id
@@ -51,29 +1489,10 @@ async def start_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             await update.message.reply_text("❌ Только администратор чата может запускать концерт!")
             return
 
-    chat_id = update.effective_chat.id
-    
-    # Установка разрешений для чата (разрешаем только видеокружочки)
-    permissions = ChatPermissions(
-        can_send_messages=False, 
-        can_send_other_messages=False,
-        can_add_web_page_previews=False,
-        can_send_polls=False,
-        can_change_info=False,
-        can_invite_users=True,
-        can_pin_messages=False,
-        can_send_photos=False,
-        can_send_videos=False, 
-        can_send_audios=False,
-        can_send_documents=False,
-        can_send_video_notes=True,  # Разрешаем только видеокружочки
-        can_send_voice_notes=False
-    )
-    
     try:
         # Проверяем права бота в чате
-        bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
-        if not isinstance(bot_member, ChatMemberAdministrator):
+        bot_rights = await get_bot_rights(context, chat_id)
+        if not bot_rights.is_admin:
             await update.message.reply_text("❌ Ошибка: Я не являюсь администратором в этом чате.\n"
                                           "Пожалуйста, назначьте меня администратором с правами:\n"
                                           "- Удаление сообщений\n"
@@ -81,11 +1500,11 @@ async def start_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
                                           "- Управление правами участников")
             return
             
-        if not (bot_member.can_restrict_members and bot_member.can_delete_messages):
+        if not (bot_rights.can_restrict_members and bot_rights.can_delete_messages):
             missing_rights = []
-            if not bot_member.can_restrict_members:
+            if not bot_rights.can_restrict_members:
                 missing_rights.append("- Управление правами участников")
-            if not bot_member.can_delete_messages:
+            if not bot_rights.can_delete_messages:
                 missing_rights.append("- Удаление сообщений")
                 
             await update.message.reply_text("❌ Ошибка: У меня недостаточно прав администратора.\n"
@@ -94,8 +1513,9 @@ async def start_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
         # Пробуем установить разрешения
         try:
-            await context.bot.set_chat_permissions(chat_id, permissions)
-            msg = await update.message.reply_text("Я включаю Михаила Круга")
+            await context.bot.set_chat_permissions(chat_id, CONCERT_PERMISSIONS)
+            get_chat_registry(context).set_concert(chat_id, True)
+            msg = await update.message.reply_text(CONCERT_ANNOUNCEMENTS['start'])
             
             # Пробуем удалить командное сообщение
             try:
@@ -108,6 +1528,7 @@ async def start_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
                     
         except BadRequest as e:
             if "Not enough rights" in str(e):
+                invalidate_bot_rights(context, chat_id)
                 await update.message.reply_text("❌ Ошибка: Не удалось изменить права участников.\n"
                                               "Убедитесь, что у меня есть права:\n"
                                               "- Управление правами участников")
@@ -118,6 +1539,7 @@ async def start_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.message.reply_text(f"❌ Произошла ошибка Telegram: {str(e)}\n"
                                       "Пожалуйста, проверьте права бота и попробуйте снова.")
 
+@measure_handler
 async def stop_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Остановка концерта вручную (только для администратора)"""
     user_id = update.effective_user.id
@@ -133,29 +1555,10 @@ async def stop_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             await update.message.reply_text("❌ Только администратор чата может останавливать концерт!")
             return
 
-    chat_id = update.effective_chat.id
-    
-    # Восстановление всех прав
-    permissions = ChatPermissions(
-        can_send_messages=True,
-        can_send_other_messages=True,
-        can_add_web_page_previews=True,
-        can_send_polls=True,
-        can_change_info=False,
-        can_invite_users=True,
-        can_pin_messages=False,
-        can_send_photos=True,
-        can_send_videos=True,
-        can_send_audios=True,
-        can_send_documents=True,
-        can_send_video_notes=True,
-        can_send_voice_notes=True
-    )
-    
     try:
         # Проверяем права бота в чате
-        bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
-        if not isinstance(bot_member, ChatMemberAdministrator):
+        bot_rights = await get_bot_rights(context, chat_id)
+        if not bot_rights.is_admin:
             await update.message.reply_text("❌ Ошибка: Я не являюсь администратором в этом чате.\n"
                                           "Пожалуйста, назначьте меня администратором с правами:\n"
                                           "- Удаление сообщений\n"
@@ -163,11 +1566,11 @@ async def stop_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                                           "- Управление правами участников")
             return
             
-        if not (bot_member.can_restrict_members and bot_member.can_delete_messages):
+        if not (bot_rights.can_restrict_members and bot_rights.can_delete_messages):
             missing_rights = []
-            if not bot_member.can_restrict_members:
+            if not bot_rights.can_restrict_members:
                 missing_rights.append("- Управление правами участников")
-            if not bot_member.can_delete_messages:
+            if not bot_rights.can_delete_messages:
                 missing_rights.append("- Удаление сообщений")
                 
             await update.message.reply_text("❌ Ошибка: У меня недостаточно прав администратора.\n"
@@ -176,8 +1579,9 @@ async def stop_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
         # Пробуем установить разрешения
         try:
-            await context.bot.set_chat_permissions(chat_id, permissions)
-            msg = await update.message.reply_text("Концерт Михаила Круга окончен, мемасы снова доступны")
+            await context.bot.set_chat_permissions(chat_id, NORMAL_PERMISSIONS)
+            get_chat_registry(context).set_concert(chat_id, False)
+            msg = await update.message.reply_text(CONCERT_ANNOUNCEMENTS['stop'])
             
             # Пробуем удалить командное сообщение
             try:
@@ -190,6 +1594,7 @@ async def stop_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                     
         except BadRequest as e:
             if "Not enough rights" in str(e):
+                invalidate_bot_rights(context, chat_id)
                 await update.message.reply_text("❌ Ошибка: Не удалось изменить права участников.\n"
                                               "Убедитесь, что у меня есть права:\n"
                                               "- Управление правами участников")
@@ -200,148 +1605,538 @@ async def stop_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.message.reply_text(f"❌ Произошла ошибка Telegram: {str(e)}\n"
                                       "Пожалуйста, проверьте права бота и попробуйте снова.")
 
-async def start_concert_job(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Запуск концерта по расписанию (понедельник 8:00 МСК)"""
+ScheduleGroups = List[Tuple[ChatSchedule, int]]  # Пары (расписание, корзина разброса), которым пора сработать
+
+@dataclass
+class ConcertPlan:
+    """Заранее подготовленный план плановой рассылки: чаты с проверенными правами и целевое время"""
+    kind: str  # 'start' или 'stop'
+    chat_ids: List[int]
+    target: datetime
+    groups: Optional[ScheduleGroups] = None  # Для каких (расписание, корзина) собран план; None — для всех чатов
+
+    @property
+    def permissions(self) -> ChatPermissions:
+        return CONCERT_PERMISSIONS if self.kind == 'start' else NORMAL_PERMISSIONS
+
+    def __deepcopy__(self, memo: dict) -> 'ConcertPlan':
+        # План живет несколько минут и в базу не пишется
+        return self
+
+async def prepare_concert_plan(context: ContextTypes.DEFAULT_TYPE, kind: str, target: datetime,
+                               groups: Optional[ScheduleGroups] = None) -> ConcertPlan:
+    """Подготовка плана: список активных чатов и проверка прав бота в каждом из них.
+
+    Если переданы groups, в план попадают только чаты с этими расписаниями и корзинами разброса.
+    """
     now = datetime.now(moscow_tz)
     logger = logging.getLogger(__name__)
-    logger.info(f"[{now}] Запуск планового концерта")
-    
+    action = 'запуска' if kind == 'start' else 'остановки'
+
+    # Чаты, которые уже находятся в нужном состоянии, не трогаем
+    registry = get_chat_registry(context)
+    in_concert = kind == 'start'
+    managed_chats = [chat_id for chat_id in await get_managed_chats(context) if registry.needs_change(chat_id, in_concert)]
+    if groups is not None:
+        wanted = set(groups)
+        managed_chats = [
+            chat_id for chat_id in managed_chats
+            if (registry.schedule_of(chat_id), ConcertScheduler.bucket_of(chat_id)) in wanted
+        ]
+    chat_ids: List[int] = []
+
+    async def check_rights(chat_id: int, limiter: RateLimiter) -> bool:
+        bot_rights = await get_bot_rights(context, chat_id, limiter)
+        if not bot_rights.can_restrict_members:
+            # В public режиме бот может быть в чате и без прав администратора, это не ошибка
+            log = logger.error if MODE == 'secured' else logger.debug
+            log("[%s] Недостаточно прав для %s концерта в чате %s", now, action, chat_id)
+            return False
+        chat_ids.append(chat_id)
+        return True
+
+    report = await run_fan_out(f"Проверка прав перед {action} концерта", managed_chats, check_rights)
+    for chat_id, chat_error in report.failures.items():
+        logger.error("[%s] Не удалось проверить права в чате %s: %s", now, chat_id, chat_error)
+
+    if FANOUT_SHARDS > 1:
+        await warm_shard_pool(context.bot.token)
+
+    return ConcertPlan(kind, chat_ids, target, groups)
+
+class ConcertPlans(Dict[Tuple[str, float], 'asyncio.Task[ConcertPlan]']):
+    """Подготовки планов по ключу (вид, целевое время): завершенные и еще идущие"""
+
+    def __deepcopy__(self, memo: dict) -> 'ConcertPlans':
+        # Задачи живут несколько минут и в базу не пишутся
+        return self
+
+def _concert_plans(context: ContextTypes.DEFAULT_TYPE) -> ConcertPlans:
+    """Подготовки планов, хранятся в bot_data"""
+    return context.bot_data.setdefault('concert_plans', ConcertPlans())
+
+async def prepare_concert_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Подготовка плана за PREWARM_MINUTES минут до срабатывания расписания"""
+    kind, groups = context.job.data['kind'], context.job.data['groups']
+    target = datetime.fromtimestamp(context.job.data['target'], moscow_tz)
+    now = datetime.now(moscow_tz)
+
+    logger = logging.getLogger(__name__)
+    plans = _concert_plans(context)
+    # Планы, срабатывание которых так и не наступило (бот был остановлен, расписание сменилось), выбрасываем
+    stale_before = now.timestamp() - PREWARM_MINUTES * 60
+    for key in [key for key in plans if key[1] < stale_before]:
+        plans.pop(key).cancel()
+
+    # Задача кладется в bot_data сразу: срабатывание, наступившее до конца подготовки, дождется ее
+    task = asyncio.ensure_future(prepare_concert_plan(context, kind, target, groups))
+    plans[(kind, target.timestamp())] = task
     try:
-        # Получаем список активных чатов
-        managed_chats = await get_managed_chats(context)
-        logger.info(f"[{now}] Активные чаты для запуска концерта: {managed_chats}")
-        
-        if not managed_chats:
-            logger.warning(f"[{now}] Нет активных чатов для запуска концерта")
-            return
-            
-        for chat_id in managed_chats:
-            try:
-                # Проверяем права бота перед запуском
-                bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
-                if not (isinstance(bot_member, ChatMemberAdministrator) and bot_member.can_restrict_members):
-                    logger.error(f"[{now}] Недостаточно прав для запуска концерта в чате {chat_id}")
-                    continue
-                
-                # Удаляем лог-файл перед запуском концерта
-                log_file = Path(os.path.dirname(os.path.abspath(__file__))) / 'mishakrug.log'
-                if log_file.exists():
-                    try:
-                        log_file.unlink()
-                        logger.info(f"[{now}] Лог-файл успешно удален")
-                    except Exception as log_error:
-                        logger.error(f"[{now}] Ошибка при удалении лог-файла: {log_error}")
-                
-                # Разрешаем только видеокружочки
-                permissions = ChatPermissions(
-                    can_send_messages=False, 
-                    can_send_other_messages=False,
-                    can_add_web_page_previews=False,
-                    can_send_polls=False,
-                    can_change_info=False,
-                    can_invite_users=True,
-                    can_pin_messages=False,
-                    can_send_photos=False,
-                    can_send_videos=False, 
-                    can_send_audios=False,
-                    can_send_documents=False,
-                    can_send_video_notes=True,  # Разрешаем только видеокружочки
-                    can_send_voice_notes=False
-                )
-                
-                await context.bot.set_chat_permissions(chat_id, permissions)
-                msg = await context.bot.send_message(chat_id, "Я включаю Михаила Круга")
-                logger.info(f"[{now}] Запущен концерт в чате {chat_id}")
-                await msg.delete()
-                
-            except Exception as chat_error:
-                logger.error(f"[{now}] Ошибка при запуске концерта в чате {chat_id}: {chat_error}")
-                notify_admins(context, f"Ошибка при запуске концерта в чате {chat_id}:\n{str(chat_error)}")
-                
+        plan = await asyncio.shield(task)
+        logger.info("[%s] План на %s готов: чатов %s", now, target, len(plan.chat_ids))
     except Exception as e:
-        logger.error(f"[{now}] Глобальная ошибка при запуске концерта: {e}")
-        notify_admins(context, f"Глобальная ошибка при запуске концерта:\n{str(e)}")
+        logger.error("[%s] Ошибка при подготовке плана концерта: %s", now, e)
 
-async def stop_concert_job(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Остановка концерта по расписанию (23:59 МСК)"""
+async def _get_concert_plan(context: ContextTypes.DEFAULT_TYPE, kind: str, target: datetime,
+                            groups: Optional[ScheduleGroups] = None) -> ConcertPlan:
+    """Готовый план для этого срабатывания или, если его нет, план, собранный прямо сейчас"""
+    task = _concert_plans(context).pop((kind, target.timestamp()), None)
+    plan = None
+    if task is not None:
+        try:
+            # Подготовка могла еще не закончиться — дожидаемся ее, а не начинаем заново
+            plan = await task
+        except Exception:
+            # Ошибка уже записана в журнал подготовкой; план собирается заново
+            pass
+    if plan is None:
+        return await prepare_concert_plan(context, kind, target, groups)
+    # К срабатыванию могли добавиться группы, для которых план заранее не готовился
+    # (например, /schedule включил расписание с тем же временем уже внутри PREWARM_MINUTES)
+    if plan.groups is not None and (groups is None or not set(groups) <= set(plan.groups)):
+        missing = None if groups is None else [group for group in groups if group not in plan.groups]
+        extra = await prepare_concert_plan(context, kind, target, missing)
+        known = set(plan.chat_ids)
+        plan.chat_ids = [*plan.chat_ids, *(chat_id for chat_id in extra.chat_ids if chat_id not in known)]
+        plan.groups = None if missing is None else [*plan.groups, *missing]
+    return plan
+
+def record_fan_out_metrics(job: str, phase: str, report: FanOutReport) -> None:
+    """Длительность рассылки, отставание по чатам и итоги по чатам"""
+    METRICS.observe('fanout_duration_seconds', report.duration, job=job, phase=phase)
+    for drift in report.drifts:
+        METRICS.observe('fanout_drift_seconds', drift, job=job)
+    METRICS.inc('fanout_chats_total', report.succeeded, job=job, phase=phase, result='succeeded')
+    METRICS.inc('fanout_chats_total', report.skipped, job=job, phase=phase, result='skipped')
+    METRICS.inc('fanout_chats_total', len(report.failures), job=job, phase=phase, result='failed')
+
+async def execute_concert_plan(context: ContextTypes.DEFAULT_TYPE, plan: ConcertPlan) -> FanOutReport:
+    """Исполнение плана: сначала только смена разрешений во всех чатах, затем объявления"""
     now = datetime.now(moscow_tz)
     logger = logging.getLogger(__name__)
-    logger.info(f"[{now}] Остановка планового концерта")
+    limiter = get_api_limiter()
+    permissions = plan.permissions
+    in_concert = plan.kind == 'start'
+
+    # Пока план ждал своего времени, состояние части чатов могли изменить вручную
+    registry = get_chat_registry(context)
+    chat_ids = [chat_id for chat_id in plan.chat_ids if registry.needs_change(chat_id, in_concert)]
+    bot = get_fanout_bot(context)
+
+    # Отметка «в процессе» и запись о начатой рассылке сохраняются до ее начала,
+    # чтобы после падения состояние можно было сверить, а остаток — доделать
+    registry.mark_pending(chat_ids)
+    await flush_registry(context)
+    await record_run(context, plan, chat_ids)
+
+    async def set_permissions(chat_id: int, limiter: RateLimiter) -> bool:
+        try:
+            await limiter.call(chat_id, bot.set_chat_permissions, chat_id, permissions)
+        except Exception:
+            registry.clear_pending(chat_id)
+            raise
+        registry.set_concert(chat_id, in_concert)
+        return True
+
+    name = "Запуск концерта" if plan.kind == 'start' else "Остановка концерта"
+    sharded = FANOUT_SHARDS > 1 and len(chat_ids) > 1
+    if sharded:
+        # Процессы возвращают только отчет, состояние чатов отмечаем по нему
+        report = await run_sharded(name, plan.kind, 'permissions', chat_ids, context.bot.token, plan.target.timestamp())
+        for chat_id in chat_ids:
+            if chat_id in report.failures:
+                registry.clear_pending(chat_id)
+            else:
+                registry.set_concert(chat_id, in_concert)
+    else:
+        report = await run_fan_out(name, chat_ids, set_permissions, limiter,
+                                   target=plan.target.timestamp(), checkpoint=lambda: flush_registry(context))
+    await flush_registry(context)
+    await finish_run(context, plan)
+    record_fan_out_metrics(plan.kind, 'permissions', report)
+
+    # Объявления не привязаны к плановому времени и уходят после смены разрешений
+    text = CONCERT_ANNOUNCEMENTS[plan.kind]
+
+    async def announce(chat_id: int, limiter: RateLimiter) -> bool:
+        return await announce_in_chat(bot, limiter, chat_id, text)
+
+    switched = [chat_id for chat_id in chat_ids if chat_id not in report.failures]
+    if sharded:
+        announcements = await run_sharded(f"{name}: объявления", plan.kind, 'announce', switched, context.bot.token)
+    else:
+        announcements = await run_fan_out(f"{name}: объявления", switched, announce, limiter)
+    record_fan_out_metrics(plan.kind, 'announce', announcements)
+    for chat_id, chat_error in announcements.failures.items():
+        logger.warning("[%s] Не удалось отправить объявление в чат %s: %s", now, chat_id, chat_error)
+    return report
+
+async def record_run(context: ContextTypes.DEFAULT_TYPE, plan: ConcertPlan, chat_ids: Sequence[int]) -> None:
+    """Запись о начале плановой рассылки вместе со списком ее чатов"""
+    persistence = _get_persistence(context)
+    if persistence is not None:
+        await asyncio.to_thread(persistence.record_run, plan.kind, plan.target.timestamp(), chat_ids)
+
+async def finish_run(context: ContextTypes.DEFAULT_TYPE, plan: ConcertPlan) -> None:
+    """Отметка о завершении плановой рассылки"""
+    persistence = _get_persistence(context)
+    if persistence is not None:
+        await asyncio.to_thread(persistence.finish_run, plan.kind, plan.target.timestamp())
+
+async def resume_concert_job(context: ContextTypes.DEFAULT_TYPE) -> Optional[FanOutReport]:
+    """Продолжение рассылки, прерванной перезапуском бота"""
+    kind = context.job.data['kind']
+    target = datetime.fromtimestamp(context.job.data['target'], moscow_tz)
+    now = datetime.now(moscow_tz)
+    logger = logging.getLogger(__name__)
+    logger.info("[%s] Продолжение прерванной рассылки (%s) с плановым временем %s", now, kind, target)
+    digest = AdminDigest(f"Продолжение прерванной рассылки ({kind})")
+
+    try:
+        # Только чаты прерванной рассылки; уже переведенные в нужное состояние пропустит execute_concert_plan
+        plan = ConcertPlan(kind, context.job.data['chat_ids'], target)
+        report = await execute_concert_plan(context, plan)
+        for chat_id, chat_error in report.failures.items():
+            logger.error("[%s] Ошибка при продолжении рассылки в чате %s: %s", now, chat_id, chat_error)
+        digest.add_failures(report.failures)
+        logger.info("[%s] %s", now, report)
+        HEALTH.record_job(kind, report)
+        return report
+    except Exception as e:
+        logger.error("[%s] Глобальная ошибка при продолжении рассылки: %s", now, e)
+        digest.add_error(str(e))
+        HEALTH.record_job(kind, error=str(e))
+        return None
+    finally:
+        await send_admin_digest(context, digest)
+
+CONCERT_JOB_TITLES = {'start': "Запуск планового концерта", 'stop': "Остановка планового концерта"}
+
+async def run_concert_job(context: ContextTypes.DEFAULT_TYPE, kind: str, target: datetime,
+                          groups: Optional[ScheduleGroups] = None,
+                          firings: Optional[Dict[float, int]] = None) -> Optional[FanOutReport]:
+    """Запуск ('start') или остановка ('stop') концерта в чатах, которым пора по расписанию.
+
+    firings — из каких срабатываний расписания (плановое время без разброса -> число корзин) состоит рассылка;
+    сводка для администраторов тогда отправляется одна на срабатывание, после его последней корзины.
+    """
+    now = datetime.now(moscow_tz)
+    logger = logging.getLogger(__name__)
+    action = 'запуска' if kind == 'start' else 'остановки'
+    title = CONCERT_JOB_TITLES[kind]
+    logger.info("[%s] %s", now, title)
+    # Ошибки собираются за всю рассылку и уходят администраторам одним сообщением в конце
+    digest = AdminDigest(title)
     
     try:
-        # Получаем список активных чатов
-        managed_chats = await get_managed_chats(context)
-        logger.info(f"[{now}] Активные чаты для остановки концерта: {managed_chats}")
+        # Берем подготовленный заранее план с активными чатами
+        plan = await _get_concert_plan(context, kind, target, groups)
+        logger.info("[%s] Активных чатов для %s концерта: %s", now, action, len(plan.chat_ids))
         
-        if not managed_chats:
-            logger.warning(f"[{now}] Нет активных чатов для остановки концерта")
-            return
-            
-        for chat_id in managed_chats:
-            try:
-                # Проверяем права бота перед остановкой
-                bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
-                if not (isinstance(bot_member, ChatMemberAdministrator) and bot_member.can_restrict_members):
-                    logger.error(f"[{now}] Недостаточно прав для остановки концерта в чате {chat_id}")
-                    continue
-                
-                # Восстанавливаем все права
-                permissions = ChatPermissions(
-                    can_send_messages=True,
-                    can_send_media_messages=True,
-                    can_send_other_messages=True,
-                    can_add_web_page_previews=True,
-                    can_send_polls=True,
-                    can_change_info=False,
-                    can_invite_users=True,
-                    can_pin_messages=False,
-                    can_send_photos=True,
-                    can_send_videos=True,
-                    can_send_audios=True,
-                    can_send_documents=True,
-                    can_send_video_notes=True,
-                    can_send_voice_notes=True
-                )
-                
-                await context.bot.set_chat_permissions(chat_id, permissions)
-                msg = await context.bot.send_message(chat_id, "Концерт Михаила Круга окончен, мемасы снова доступны")
-                logger.info(f"[{now}] Остановлен концерт в чате {chat_id}")
-                await msg.delete()
-                
-            except Exception as chat_error:
-                logger.error(f"[{now}] Ошибка при остановке концерта в чате {chat_id}: {chat_error}")
-                notify_admins(context, f"Ошибка при остановке концерта в чате {chat_id}:\n{str(chat_error)}")
+        if not plan.chat_ids:
+            logger.warning("[%s] Нет активных чатов для %s концерта", now, action)
+            HEALTH.record_job(kind)
+            return None
+
+        report = await execute_concert_plan(context, plan)
+        for chat_id, chat_error in report.failures.items():
+            logger.error("[%s] Ошибка при %s концерта в чате %s: %s", now, action, chat_id, chat_error)
+        digest.add_failures(report.failures)
+        logger.info("[%s] %s", now, report)
+        HEALTH.record_job(kind, report)
+        return report
                 
     except Exception as e:
-        logger.error(f"[{now}] Глобальная ошибка при остановке концерта: {e}")
-        notify_admins(context, f"Глобальная ошибка при остановке концерта:\n{str(e)}")
+        logger.error("[%s] Глобальная ошибка при %s концерта: %s", now, action, e)
+        digest.add_error(str(e))
+        HEALTH.record_job(kind, error=str(e))
+        return None
+    finally:
+        if firings:
+            digest = get_concert_scheduler(context.bot_data).collect_digest(kind, firings, digest)
+        if digest is not None:
+            await send_admin_digest(context, digest)
+
+async def concert_job(context: ContextTypes.DEFAULT_TYPE) -> Optional[FanOutReport]:
+    """Срабатывание расписания: запуск или остановка концерта в чатах из context.job.data['groups']"""
+    data = context.job.data
+    target = datetime.fromtimestamp(data['target'], moscow_tz)
+    return await run_concert_job(context, data['kind'], target, data['groups'], data.get('firings'))
+
+async def start_concert_job(context: ContextTypes.DEFAULT_TYPE) -> Optional[FanOutReport]:
+    """Запуск концерта во всех активных чатах сейчас"""
+    return await run_concert_job(context, 'start', datetime.now(moscow_tz))
+
+async def stop_concert_job(context: ContextTypes.DEFAULT_TYPE) -> Optional[FanOutReport]:
+    """Остановка концерта во всех активных чатах сейчас"""
+    return await run_concert_job(context, 'stop', datetime.now(moscow_tz))
+
+class ConcertScheduler:
+    """Планировщик концертов: min-куча ближайших срабатываний расписаний.
+
+    В куче лежат не чаты, а пары (расписание, корзина разброса), поэтому ее размер и стоимость
+    планирования не зависят от числа чатов. Срабатывания с одним временем объединяются в одну рассылку,
+    а в JobQueue всегда стоит одна задача — на ближайшее срабатывание.
+    """
+
+    def __init__(self):
+        # (время, порядковый номер, действие, kind, расписание, корзина, время срабатывания без разброса)
+        self._heap: List[Tuple[float, int, str, str, ChatSchedule, int, float]] = []
+        self._seq = itertools.count()
+        self._members: Counter = Counter()  # Число чатов на каждом собственном расписании
+        self._active: Set[ChatSchedule] = set()  # Расписания, у которых есть записи в куче
+        self._job = None
+        self._armed_at: Optional[float] = None
+        # Сводки срабатываний (kind, плановое время без разброса): сколько записей корзин еще не отчиталось
+        # и что уже собрано; готовые сводки срабатываний, последние корзины которых были пропущены
+        self._pending: Counter = Counter()
+        self._digests: Dict[Tuple[str, float], AdminDigest] = {}
+        self._ready: List[AdminDigest] = []
+
+    def __deepcopy__(self, memo: dict) -> 'ConcertScheduler':
+        # Расписания хранятся в реестре, куча строится заново при запуске
+        return self
+
+    @staticmethod
+    def bucket_of(chat_id: int) -> int:
+        """Корзина разброса, в которую всегда попадает чат"""
+        return chat_id % SCHEDULE_JITTER_BUCKETS if SCHEDULE_JITTER > 0 else 0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def load(self, registry: ChatRegistry, now: float) -> None:
+        """Построение кучи по расписаниям из реестра"""
+        self._members = Counter(registry.schedules.values())
+        for schedule in (DEFAULT_SCHEDULE, *self._members):
+            self._activate(schedule, now)
+
+    def update(self, previous: Optional[ChatSchedule], schedule: Optional[ChatSchedule], now: float) -> None:
+        """Учет смены собственного расписания чата"""
+        if previous is not None:
+            self._members[previous] -= 1
+            if self._members[previous] <= 0:
+                del self._members[previous]  # Записи в куче удалятся, когда до них дойдет очередь
+        if schedule is not None:
+            self._members[schedule] += 1
+            self._activate(schedule, now)
+
+    def _is_live(self, schedule: ChatSchedule) -> bool:
+        return schedule == DEFAULT_SCHEDULE or schedule in self._members
+
+    def _activate(self, schedule: ChatSchedule, now: float) -> None:
+        if schedule not in self._active:
+            self._active.add(schedule)
+            for kind in ('start', 'stop'):
+                self._push(schedule, kind, now)
+
+    @staticmethod
+    def _offset(bucket: int) -> float:
+        """Сдвиг срабатывания корзины от времени по расписанию"""
+        return SCHEDULE_JITTER * bucket / SCHEDULE_JITTER_BUCKETS if SCHEDULE_JITTER > 0 else 0.0
+
+    def _push(self, schedule: ChatSchedule, kind: str, after: float) -> None:
+        """Записи для ближайшего срабатывания расписания после after"""
+        base = schedule.next_time(kind, after)
+        buckets = SCHEDULE_JITTER_BUCKETS if SCHEDULE_JITTER > 0 else 1
+        self._pending[(kind, base)] += buckets
+        for bucket in range(buckets):
+            at = base + self._offset(bucket)
+            heapq.heappush(self._heap, (at, next(self._seq), 'run', kind, schedule, bucket, base))
+            prepare_at = at - PREWARM_MINUTES * 60
+            if PREWARM_MINUTES > 0 and prepare_at > after:
+                heapq.heappush(self._heap, (prepare_at, next(self._seq), 'prepare', kind, schedule, bucket, base))
 
-async def get_managed_chats(context: ContextTypes.DEFAULT_TYPE) -> set:
-    """Получение списка активных чатов в зависимости от режима работы"""
+    def next_due(self) -> Optional[float]:
+        """Время ближайшего срабатывания"""
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> List[Tuple[str, str, float, ScheduleGroups, Dict[float, int]]]:
+        """Наступившие срабатывания, сгруппированные по (действие, kind, плановое время).
+
+        К каждой рассылке прилагается, сколько ее групп относится к каждому срабатыванию расписания
+        (по плановому времени без разброса) — по этим числам собираются сводки для администраторов.
+        """
+        batches: Dict[Tuple[str, str, float], ScheduleGroups] = {}
+        firings: Dict[Tuple[str, str, float], Counter] = {}
+        while self._heap and self._heap[0][0] <= now:
+            at, _, action, kind, schedule, bucket, base = heapq.heappop(self._heap)
+            live = self._is_live(schedule)
+            if action == 'run' and bucket == 0:
+                # Следующее срабатывание ставится один раз на все корзины
+                if live:
+                    self._push(schedule, kind, base)
+                else:
+                    self._active.discard(schedule)
+            if live:
+                target = base + self._offset(bucket)
+                batches.setdefault((action, kind, target), []).append((schedule, bucket))
+                firings.setdefault((action, kind, target), Counter())[base] += 1
+            elif action == 'run':
+                # Пропущенная корзина тоже считается отчитавшейся, иначе сводка срабатывания не уйдет
+                digest = self._settle(kind, base, 1)
+                if digest is not None:
+                    self._ready.append(digest)
+        return [(action, kind, target, groups, dict(firings[(action, kind, target)]))
+                for (action, kind, target), groups in batches.items()]
+
+    def _settle(self, kind: str, base: float, count: int) -> Optional['AdminDigest']:
+        """Учет отчитавшихся корзин срабатывания; когда отчитались все, возвращается его сводка"""
+        key = (kind, base)
+        self._pending[key] -= count
+        if self._pending[key] > 0:
+            return None
+        del self._pending[key]
+        return self._digests.pop(key, None)
+
+    def collect_digest(self, kind: str, firings: Dict[float, int], digest: 'AdminDigest') -> Optional['AdminDigest']:
+        """Сводка рассылки добавляется к сводке ее срабатывания; возвращается сводка, которую пора отправить.
+
+        Рассылка, в которую попали корзины двух срабатываний с совпавшим временем, пишет ошибки в сводку
+        более раннего из них.
+        """
+        first = min(firings)
+        self._digests.setdefault((kind, first), AdminDigest(digest.title)).merge(digest)
+        ready = None
+        for base, count in sorted(firings.items()):
+            done = self._settle(kind, base, count)
+            if done is not None:
+                ready = done if ready is None else ready.merge(done)
+        return ready
+
+    def arm(self, job_queue: JobQueue) -> None:
+        """Одна задача в JobQueue — на ближайшее срабатывание"""
+        due = self.next_due()
+        if due == self._armed_at:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+        self._job = job_queue.run_once(self._wake, when=datetime.fromtimestamp(due, timezone.utc), name='concert_scheduler') \
+            if due is not None else None
+        self._armed_at = due
+
+    async def _wake(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        self._job, self._armed_at = None, None
+        # Небольшой запас: JobQueue может разбудить на доли секунды раньше
+        for action, kind, target, groups, firings in self.pop_due(wall_time() + 0.5):
+            callback = prepare_concert_job if action == 'prepare' else concert_job
+            data = {'kind': kind, 'target': target, 'groups': groups}
+            if action == 'run':
+                data['firings'] = firings
+            context.job_queue.run_once(callback, 0, data=data)
+        self.arm(context.job_queue)
+        ready, self._ready = self._ready, []
+        for digest in ready:
+            await send_admin_digest(context, digest)
+
+def get_concert_scheduler(bot_data: Dict[str, Any]) -> ConcertScheduler:
+    """Планировщик концертов приложения"""
+    return bot_data.setdefault('concert_scheduler', ConcertScheduler())
+
+async def get_managed_chats(context: ContextTypes.DEFAULT_TYPE) -> Sequence[int]:
+    """Получение списка активных чатов (по возрастанию chat_id) в зависимости от режима работы"""
+    snapshot = get_chat_registry(context).snapshot()
     if MODE == 'secured':
         # В secured режиме работаем только с зарегистрированными чатами
-        return context.bot_data.get('managed_chats', set())
+        return snapshot.chats('managed')
     else:
-        # В public режиме получаем список всех чатов, где бот является администратором
-        managed_chats = set()
-        if 'all_chats' in context.bot_data:
-            for chat_id in context.bot_data['all_chats']:
-                try:
-                    bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
-                    if isinstance(bot_member, ChatMemberAdministrator) and bot_member.can_restrict_members:
-                        managed_chats.add(chat_id)
-                except TelegramError:
-                    continue
-        return managed_chats
+        # В public режиме — все чаты, куда добавлен бот. Права бота в них проверяет
+        # prepare_concert_plan: параллельно и через ограничитель частоты запросов
+        return snapshot.chats('tracked')
+
+class AdminDigest:
+    """Ошибки одной плановой рассылки, собранные в одно сообщение для администраторов"""
+
+    def __init__(self, title: str):
+        self.title = title
+        self.errors: List[str] = []
+        self.failures: Dict[str, List[int]] = {}  # Текст ошибки -> чаты, где она случилась
+        self.failed_chats = 0
+
+    def add_error(self, message: str) -> None:
+        self.errors.append(message)
 
-def notify_admins(context: ContextTypes.DEFAULT_TYPE, message: str) -> None:
-    """Отправка уведомления администраторам"""
+    def add_failures(self, failures: Dict[int, str]) -> None:
+        # При массовом сбое ошибки обычно одинаковые, поэтому группируем чаты по тексту ошибки
+        for chat_id, error in failures.items():
+            self.failures.setdefault(error, []).append(chat_id)
+        self.failed_chats += len(failures)
+
+    def merge(self, other: 'AdminDigest') -> 'AdminDigest':
+        """Добавление ошибок другой сводки, например соседней корзины того же срабатывания"""
+        self.errors.extend(other.errors)
+        for error, chat_ids in other.failures.items():
+            self.failures.setdefault(error, []).extend(chat_ids)
+        self.failed_chats += other.failed_chats
+        return self
+
+    def __bool__(self) -> bool:
+        return bool(self.errors or self.failures)
+
+    def render(self, max_length: Optional[int] = None, max_chats: Optional[int] = None) -> str:
+        """Текст сводки, обрезанный до max_length символов"""
+        max_length = max_length if max_length is not None else ADMIN_DIGEST_MAX_LENGTH
+        max_chats = max_chats if max_chats is not None else ADMIN_DIGEST_MAX_CHATS
+        lines = [self.title]
+        lines.extend(f"Глобальная ошибка: {error}" for error in self.errors)
+        if self.failures:
+            lines.append(f"Ошибки в {self.failed_chats} чатах:")
+            for error, chat_ids in sorted(self.failures.items(), key=lambda item: -len(item[1])):
+                shown = ', '.join(str(chat_id) for chat_id in chat_ids[:max_chats])
+                more = f" и еще {len(chat_ids) - max_chats}" if len(chat_ids) > max_chats else ''
+                lines.append(f"- {error} ({len(chat_ids)}): {shown}{more}")
+
+        text = ''
+        for index, line in enumerate(lines):
+            tail = f"\n… и еще {len(lines) - index} строк" if index else ''
+            if len(text) + len(line) + 1 + len(tail) > max_length:
+                return (text + tail)[:max_length]
+            text = f"{text}\n{line}" if text else line
+        return text
+
+_notify_limiter: Optional[Tuple[asyncio.AbstractEventLoop, RateLimiter]] = None
+
+def get_notify_limiter() -> RateLimiter:
+    """Ограничитель уведомлений администраторам, один на процесс: ADMIN_NOTIFY_RATE соблюдается и между сводками"""
+    global _notify_limiter
+    loop = asyncio.get_running_loop()
+    if _notify_limiter is None or _notify_limiter[0] is not loop:
+        _notify_limiter = (loop, RateLimiter(global_rate=ADMIN_NOTIFY_RATE, parent=get_api_limiter()))
+    return _notify_limiter[1]
+
+async def send_admin_digest(context: ContextTypes.DEFAULT_TYPE, digest: AdminDigest) -> None:
+    """Отправка сводки каждому администратору: не чаще ADMIN_NOTIFY_RATE и в пределах общего лимита Bot API"""
+    if not digest or not ADMIN_CHAT_IDS:
+        return
+    text = digest.render()
+    limiter = get_notify_limiter()
     for admin_id in ADMIN_CHAT_IDS:
         try:
-            context.bot.send_message(admin_id, message)
+            await limiter.call(admin_id, context.bot.send_message, admin_id, text)
         except Exception as e:
-            logging.error(f"Не удалось отправить сообщение администратору {admin_id}: {e}")
+            logging.getLogger(__name__).error("Не удалось отправить сообщение администратору %s: %s", admin_id, e)
 
+@measure_handler
 async def register_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Регистрация чата для управления концертами (только в secured режиме)"""
     if MODE != 'secured':
@@ -353,12 +2148,12 @@ async def register_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
         
     chat_id = update.effective_chat.id
-    if 'managed_chats' not in context.bot_data:
-        context.bot_data['managed_chats'] = set()
-    
-    context.bot_data['managed_chats'].add(chat_id)
+    get_chat_registry(context).add_managed(chat_id)
+    # Регистрация пишется в базу до ответа, а не при очередном сбросе раз в REGISTRY_FLUSH_INTERVAL
+    await flush_registry(context)
     await update.message.reply_text("Чат зарегистрирован для управления концертами!")
 
+@measure_handler
 async def unregister_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отмена регистрации чата (только в secured режиме)"""
     if MODE != 'secured':
@@ -370,87 +2165,717 @@ async def unregister_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
         
     chat_id = update.effective_chat.id
-    if 'managed_chats' in context.bot_data and chat_id in context.bot_data['managed_chats']:
-        context.bot_data['managed_chats'].remove(chat_id)
+    if get_chat_registry(context).remove_managed(chat_id):
+        await flush_registry(context)
         await update.message.reply_text("Регистрация чата отменена!")
     else:
         await update.message.reply_text("Этот чат не был зарегистрирован!")
 
+@measure_handler
+async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Просмотр и изменение расписания концертов чата: /schedule [дни запуск остановка [пояс] | сброс]"""
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    registry = get_chat_registry(context)
+
+    if not context.args:
+        await update.message.reply_text(f"Расписание концертов: {registry.schedule_of(chat_id).describe()}")
+        return
+
+    # Проверка прав в зависимости от режима
+    if MODE == 'secured':
+        if user_id not in ADMIN_CHAT_IDS:
+            await update.message.reply_text("❌ Только администратор бота может менять расписание!")
+            return
+    else:  # public mode
+        if not await is_user_admin(chat_id, user_id, context):
+            await update.message.reply_text("❌ Только администратор чата может менять расписание!")
+            return
+
+    text = ' '.join(context.args)
+    if text.lower() in ('сброс', 'default'):
+        schedule = None
+    else:
+        try:
+            schedule = ChatSchedule.parse(text)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        if schedule == DEFAULT_SCHEDULE:
+            schedule = None
+
+    # Остановку идущего концерта прежнее расписание больше не сделает, поэтому останавливаем его сразу
+    if registry.is_in_concert(chat_id) and registry.schedules.get(chat_id) != schedule:
+        try:
+            await context.bot.set_chat_permissions(chat_id, NORMAL_PERMISSIONS)
+        except TelegramError as e:
+            await update.message.reply_text(f"❌ Не удалось остановить идущий концерт, расписание не изменено: {e}")
+            return
+        registry.set_concert(chat_id, False)
+        await update.message.reply_text(CONCERT_ANNOUNCEMENTS['stop'])
+
+    previous = registry.set_schedule(chat_id, schedule)
+    if previous != schedule:
+        scheduler = get_concert_scheduler(context.bot_data)
+        scheduler.update(previous, schedule, wall_time())
+        if context.job_queue is not None:
+            scheduler.arm(context.job_queue)
+    await update.message.reply_text(f"Расписание концертов: {registry.schedule_of(chat_id).describe()}")
+
 async def track_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отслеживание новых чатов в public режиме"""
     if MODE != 'public':
         return
         
     chat_id = update.effective_chat.id
-    if 'all_chats' not in context.bot_data:
-        context.bot_data['all_chats'] = set()
-    context.bot_data['all_chats'].add(chat_id)
-    print(f"Бот добавлен в новый чат: {chat_id}")
+    get_chat_registry(context).add_tracked(chat_id)
+    logging.getLogger(__name__).info("Бот добавлен в новый чат: %s", chat_id)
 
-def main() -> None:
+METRICS.describe('enforced_messages_total', 'counter', 'Сообщения, удаляемые во время концерта, по результату')
+
+class DeletionQueue:
+    """Очередь удаления сообщений во время концерта.
+
+    Сообщения копятся по чатам и раз в ENFORCE_FLUSH_INTERVAL секунд (или сразу, как в чате набралась
+    полная пачка) удаляются через delete_messages по 100 штук. Сверх ENFORCE_QUEUE_SIZE сообщения отбрасываются.
+    Ограничитель частоты живет все время работы очереди, поэтому лимит ENFORCE_CHAT_RATE действует
+    и между сбросами; общий лимит Bot API удаления делят с рассылками и уведомлениями.
+    """
+
+    BATCH_SIZE = 100  # Предел delete_messages
+
+    def __init__(self):
+        self._pending: Dict[int, List[int]] = {}
+        self._size = 0
+        self.dropped = 0
+        self._wakeup = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._limiter: Optional[RateLimiter] = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, chat_id: int, message_id: int) -> bool:
+        """Постановка сообщения в очередь на удаление (False — очередь переполнена)"""
+        if self._size >= ENFORCE_QUEUE_SIZE:
+            self.dropped += 1
+            METRICS.inc('enforced_messages_total', result='dropped')
+            return False
+        message_ids = self._pending.setdefault(chat_id, [])
+        message_ids.append(message_id)
+        self._size += 1
+        if len(message_ids) >= self.BATCH_SIZE:
+            self._wakeup.set()
+        return True
+
+    async def flush(self, bot: Bot) -> None:
+        """Удаление всего, что накопилось в очереди"""
+        pending, self._pending, self._size = self._pending, {}, 0
+        if not pending:
+            return
+        if self._limiter is None:
+            self._limiter = self._new_limiter()
+        limiter = self._limiter
+        await asyncio.gather(*(self._delete(bot, limiter, chat_id, ids) for chat_id, ids in pending.items()))
+
+    @staticmethod
+    def _new_limiter() -> RateLimiter:
+        # Первая пачка в чате уходит сразу, следующие — не чаще ENFORCE_CHAT_RATE в секунду
+        return RateLimiter(chat_rate=ENFORCE_CHAT_RATE, chat_burst=1, parent=get_api_limiter())
+
+    async def _delete(self, bot: Bot, limiter: RateLimiter, chat_id: int, message_ids: List[int]) -> None:
+        for start in range(0, len(message_ids), self.BATCH_SIZE):
+            batch = message_ids[start:start + self.BATCH_SIZE]
+            try:
+                await limiter.call(chat_id, bot.delete_messages, chat_id, batch)
+                METRICS.inc('enforced_messages_total', len(batch), result='deleted')
+            except TelegramError as e:
+                METRICS.inc('enforced_messages_total', len(batch), result='failed')
+                logging.getLogger(__name__).warning("Не удалось удалить %s сообщений в чате %s: %s", len(batch), chat_id, e)
+
+    async def _run(self, bot: Bot) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), ENFORCE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush(bot)
+
+    def start(self, bot: Bot) -> None:
+        self._stopping = False
+        self._limiter = self._new_limiter()
+        self._flusher = asyncio.ensure_future(self._run(bot))
+
+    async def stop(self, bot: Bot) -> None:
+        """Остановка с удалением того, что осталось в очереди"""
+        if self._flusher is not None:
+            # Без отмены: начатый сброс доделывается, а не теряет уже изъятые из очереди сообщения.
+            # К тому же wait_for в Python 3.11 может проглотить отмену, и задача не завершится
+            self._stopping = True
+            self._wakeup.set()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush(bot)
+
+DELETIONS = DeletionQueue()
+
+async def enforce_concert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Удаление сообщений, кроме видеосообщений, в чатах, где идет концерт"""
+    message = update.effective_message
+    if message is None or message.video_note is not None:
+        return
+    if get_chat_registry(context).is_in_concert(message.chat_id) and DELETIONS.add(message.chat_id, message.message_id):
+        METRICS.inc('enforced_messages_total', result='queued')
+
+class SQLitePersistence(BasePersistence):
+    """Хранение реестра чатов в SQLite (режим WAL).
+
+    Из bot_data сохраняется только реестр чатов, причем в базу пишутся лишь строки,
+    изменившиеся с прошлого сброса, а не весь bot_data целиком.
+    """
+
+    def __init__(self, path: str = REGISTRY_DB, update_interval: float = REGISTRY_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self._lock = threading.Lock()
+        import sqlite3
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chats ("
+            "chat_id INTEGER PRIMARY KEY, managed INTEGER NOT NULL, tracked INTEGER NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        # Базы, созданные до появления новых признаков, дополняем недостающими колонками
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(chats)")}
+        for name in ChatRegistry.FIELDS:
+            if name not in columns:
+                self._connection.execute(f"ALTER TABLE chats ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0")
+        # Собственные расписания чатов
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS schedules ("
+            "chat_id INTEGER PRIMARY KEY, days TEXT NOT NULL, start TEXT NOT NULL, stop TEXT NOT NULL, tz TEXT NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        # Плановые рассылки со списками их чатов: по ним после перезапуска продолжаем прерванные.
+        # В таблице старого формата не было списка чатов, продолжить такие рассылки все равно нельзя
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(fanout_runs)")}
+        if columns and 'chat_ids' not in columns:
+            self._connection.execute("DROP TABLE fanout_runs")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS fanout_runs ("
+            "kind TEXT NOT NULL, target REAL NOT NULL, finished INTEGER NOT NULL, chat_ids BLOB NOT NULL, "
+            "PRIMARY KEY (kind, target)"
+            ")"
+        )
+        self._connection.commit()
+        self._registry: Optional[ChatRegistry] = None
+
+    def load_registry(self) -> ChatRegistry:
+        """Чтение реестра чатов из базы"""
+        # Маска признаков собирается прямо в запросе, строки уже упорядочены по первичному ключу
+        mask = ' | '.join(f"({name} << {index})" for index, name in enumerate(ChatRegistry.FIELDS))
+        with self._lock:
+            rows = self._connection.execute(f"SELECT chat_id, {mask} FROM chats ORDER BY chat_id").fetchall()
+            schedules = self._connection.execute("SELECT chat_id, days, start, stop, tz FROM schedules").fetchall()
+        registry = ChatRegistry.from_rows(rows)
+        for chat_id, days, start, stop, tz in schedules:
+            registry.schedules[chat_id] = ChatSchedule(
+                tuple(int(day) for day in days.split(',')), time.fromisoformat(start), time.fromisoformat(stop), tz
+            )
+        return registry
+
+    def write_changes(self, rows: List[Tuple[int, Tuple[bool, ...]]]) -> None:
+        """Запись изменившихся строк реестра одной транзакцией"""
+        fields = ChatRegistry.FIELDS
+        with self._lock, self._connection:
+            # Чаты без единого признака из базы удаляем
+            self._connection.executemany(
+                "DELETE FROM chats WHERE chat_id = ?",
+                [(chat_id,) for chat_id, flags in rows if not any(flags)]
+            )
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO chats (chat_id, {', '.join(fields)}) "
+                f"VALUES ({', '.join('?' * (len(fields) + 1))})",
+                [(chat_id, *map(int, flags)) for chat_id, flags in rows if any(flags)]
+            )
+
+    def write_schedules(self, rows: List[Tuple[int, Optional[ChatSchedule]]]) -> None:
+        """Запись изменившихся расписаний чатов"""
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "DELETE FROM schedules WHERE chat_id = ?",
+                [(chat_id,) for chat_id, schedule in rows if schedule is None]
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO schedules (chat_id, days, start, stop, tz) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (chat_id, ','.join(map(str, schedule.days)), schedule.start.isoformat('minutes'),
+                     schedule.stop.isoformat('minutes'), schedule.tz)
+                    for chat_id, schedule in rows if schedule is not None
+                ]
+            )
+
+    def record_run(self, kind: str, target: float, chat_ids: Sequence[int]) -> None:
+        """Запись о начале рассылки по чатам chat_ids"""
+        with self._lock, self._connection:
+            # Рассылки старше FANOUT_RESUME_MAX_AGE уже не продолжаются и больше не нужны
+            self._connection.execute(
+                "DELETE FROM fanout_runs WHERE target < ?", (target - FANOUT_RESUME_MAX_AGE * 3600,)
+            )
+            # Продолжение рассылки после перезапуска сохраняет ее исходный список чатов
+            self._connection.execute(
+                "INSERT INTO fanout_runs (kind, target, finished, chat_ids) VALUES (?, ?, 0, ?) "
+                "ON CONFLICT (kind, target) DO UPDATE SET finished = 0",
+                (kind, target, array('q', chat_ids).tobytes())
+            )
+
+    def finish_run(self, kind: str, target: float) -> None:
+        """Отметка о завершении рассылки"""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE fanout_runs SET finished = 1 WHERE kind = ? AND target = ?", (kind, target)
+            )
+
+    def load_runs(self) -> List[Tuple[str, float, bool, array]]:
+        """Сохраненные рассылки по возрастанию планового времени: (kind, target, finished, chat_ids)"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT kind, target, finished, chat_ids FROM fanout_runs ORDER BY target"
+            ).fetchall()
+        runs = []
+        for kind, target, finished, blob in rows:
+            chat_ids = array('q')
+            chat_ids.frombytes(blob)
+            runs.append((kind, target, bool(finished), chat_ids))
+        return runs
+
+    async def _flush_registry(self) -> None:
+        if self._registry is None:
+            return
+        rows = self._registry.pop_changes()
+        if rows:
+            await asyncio.to_thread(self.write_changes, rows)
+        schedules = self._registry.pop_schedule_changes()
+        if schedules:
+            await asyncio.to_thread(self.write_schedules, schedules)
+
+    async def get_bot_data(self) -> Dict[str, Any]:
+        self._registry = await asyncio.to_thread(self.load_registry)
+        return {'chat_registry': self._registry}
+
+    async def update_bot_data(self, data: Dict[str, Any]) -> None:
+        # Реестр не копируется вместе с bot_data, поэтому журнал берем у живого объекта
+        registry = data.get('chat_registry')
+        if registry is not None:
+            self._registry = registry
+        await self._flush_registry()
+
+    async def refresh_bot_data(self, bot_data: Dict[str, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        await self._flush_registry()
+        with self._lock:
+            self._connection.close()
+
+    # Остальные данные бот не хранит
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_user_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_user_data(self, user_id: int, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+async def reconcile_concert_state(application: Application) -> None:
+    """Сверка состояния концерта в чатах, где смена разрешений была прервана (например, падением процесса)"""
+    logger = logging.getLogger(__name__)
+    registry = application.bot_data.get('chat_registry')
+    if registry is None or not registry.pending:
+        return
+
+    bot = get_fanout_bot(application)
+
+    async def check(chat_id: int, limiter: RateLimiter) -> bool:
+        chat = await limiter.call(chat_id, bot.get_chat, chat_id)
+        registry.set_concert(chat_id, chat.permissions is not None and not chat.permissions.can_send_messages)
+        return True
+
+    report = await run_fan_out("Сверка состояния концертов", list(registry.pending), check)
+    logger.info("%s", report)
+    for chat_id, chat_error in report.failures.items():
+        logger.error("Не удалось сверить состояние концерта в чате %s: %s", chat_id, chat_error)
+    await application.update_persistence()
+
+async def resume_interrupted_run(application: Application) -> None:
+    """Планирование продолжения последней рассылки, если она была прервана"""
+    logger = logging.getLogger(__name__)
+    if not isinstance(application.persistence, SQLitePersistence) or application.job_queue is None:
+        return
+    runs = await asyncio.to_thread(application.persistence.load_runs)
+    if not runs:
+        return
+
+    # Каждый чат продолжаем только по самой свежей рассылке, в которую он попал:
+    # если после прерванной рассылки в чате уже прошла другая, остаток для него не нужен
+    latest: Dict[int, int] = {}
+    for index, (_, _, _, chat_ids) in enumerate(runs):
+        for chat_id in chat_ids:
+            latest[chat_id] = index
+    for index, (kind, target, finished, chat_ids) in enumerate(runs):
+        if finished:
+            continue
+        remaining = [chat_id for chat_id in chat_ids if latest[chat_id] == index]
+        if not remaining:
+            continue
+        if wall_time() - target > FANOUT_RESUME_MAX_AGE * 3600:
+            logger.warning("Прерванная рассылка (%s) слишком старая, продолжать не будем", kind)
+            continue
+        logger.info("Найдена прерванная рассылка (%s), продолжаем: чатов %s", kind, len(remaining))
+        application.job_queue.run_once(
+            resume_concert_job, when=0, data={'kind': kind, 'target': target, 'chat_ids': remaining}
+        )
+
+def registry_gauges(application: Application) -> Iterable[Tuple[str, Dict[str, Any], float]]:
+    """Текущие размеры реестра чатов"""
+    registry = application.bot_data.get('chat_registry')
+    if registry is None:
+        return
+    for name in ChatRegistry.FIELDS:
+        yield 'registry_chats', {'set': name}, len(getattr(registry, name))
+
+_metrics_server: Optional[asyncio.AbstractServer] = None
+_warm_up_task: Optional[asyncio.Task] = None
+
+async def start_metrics_server(application: Application, host: str, port: int) -> asyncio.AbstractServer:
+    """HTTP-сервер, отдающий метрики по GET /metrics и состояние бота по /healthz и /readyz"""
+    import json
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) >= 2 and parts[0] == 'GET' else None
+            content_type = 'application/json'
+            if path == '/metrics':
+                gauges = itertools.chain(registry_gauges(application), HEALTH.gauges())
+                status, body = '200 OK', METRICS.render(gauges).encode()
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            elif path in ('/healthz', '/readyz'):
+                health = HEALTH.status()
+                ok = health['healthy'] if path == '/healthz' else health['ready']
+                status = '200 OK' if ok else '503 Service Unavailable'
+                body = json.dumps(health, ensure_ascii=False).encode()
+            else:
+                status, body = '404 Not Found', b'{"error": "not found"}'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+async def warm_up(application: Application) -> None:
+    """Запросы к API, которые не должны задерживать прием обновлений после перезапуска:
+    бот рассылок, сверка состояния прерванных чатов и продолжение прерванной рассылки"""
+    try:
+        await start_fanout_bot(application.bot.token)
+        await reconcile_concert_state(application)
+        await resume_interrupted_run(application)
+    except Exception as e:
+        logging.getLogger(__name__).error("Ошибка при подготовке бота после запуска: %s", e)
+    # /readyz отвечает успехом, когда состояние сверено
+    HEALTH.ready = True
+
+async def post_init(application: Application) -> None:
+    """Действия после инициализации: планировщик, метрики и проверка здоровья; остальное — в фоне (warm_up)"""
+    global _metrics_server, _warm_up_task
+    HEALTH.start(watchdog=HEALTH_WATCHDOG)
+    if application.job_queue is not None:
+        # Куча срабатываний строится по расписаниям из реестра, в JobQueue ставится только ближайшее
+        scheduler = get_concert_scheduler(application.bot_data)
+        scheduler.load(get_chat_registry(application), wall_time())
+        scheduler.arm(application.job_queue)
+    if ENFORCE_CONCERT:
+        DELETIONS.start(application.bot)
+    if METRICS_PORT:
+        _metrics_server = await start_metrics_server(application, METRICS_LISTEN, METRICS_PORT)
+        logging.getLogger(__name__).info("Метрики доступны на http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+    _warm_up_task = asyncio.ensure_future(warm_up(application))
+
+async def post_stop(application: Application) -> None:
+    """Удаление сообщений, оставшихся в очереди, пока бот еще может отправлять запросы"""
+    if ENFORCE_CONCERT:
+        await DELETIONS.stop(application.bot)
+
+async def post_shutdown(application: Application) -> None:
+    """Остановка сервера метрик, проверки здоровья и пула соединений рассылок"""
+    global _metrics_server, _warm_up_task
+    if _warm_up_task is not None:
+        _warm_up_task.cancel()
+        await asyncio.gather(_warm_up_task, return_exceptions=True)
+        _warm_up_task = None
+    await HEALTH.stop()
+    await stop_fanout_bot()
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
+
+def collect_allowed_updates(application: Application) -> List[str]:
+    """Типы обновлений, которые действительно нужны зарегистрированным обработчикам"""
+    allowed_updates = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ChatMemberHandler):
+                if handler.chat_member_types in (ChatMemberHandler.MY_CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    allowed_updates.add(Update.MY_CHAT_MEMBER)
+                if handler.chat_member_types in (ChatMemberHandler.CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    allowed_updates.add(Update.CHAT_MEMBER)
+            elif isinstance(handler, (CommandHandler, MessageHandler)):
+                allowed_updates.add(Update.MESSAGE)
+            elif isinstance(handler, TypeHandler) and handler.type is Update:
+                # Отметка о любом обновлении, своих типов не требует
+                continue
+            else:
+                # Для незнакомого обработчика не рискуем и получаем все типы обновлений
+                return list(Update.ALL_TYPES)
+    return sorted(allowed_updates)
+
+def webhook_settings() -> Dict[str, Any]:
+    """Параметры встроенного webhook-сервера для run_webhook/start_webhook"""
+    if not WEBHOOK_URL:
+        raise ValueError("Для TRANSPORT=webhook нужно указать WEBHOOK_URL")
+    return {
+        'listen': WEBHOOK_LISTEN,
+        'port': WEBHOOK_PORT,
+        'url_path': WEBHOOK_PATH,
+        'webhook_url': f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        'secret_token': WEBHOOK_SECRET,  # Запросы без этого заголовка сервер отклоняет
+        'max_connections': WEBHOOK_MAX_CONNECTIONS,
+    }
+
+def build_application() -> Application:
+    """Создание приложения и регистрация обработчиков"""
+    # Создание приложения с явным указанием использования job_queue
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(BOT_API_URL)
+        # Отдельные пулы для обработчиков и getUpdates (у рассылок свой бот, см. start_fanout_bot);
+        # InstrumentedHTTPXRequest замеряет время каждого запроса к Bot API
+        .request(http_request(HTTP_POOL_SIZE))
+        .get_updates_request(http_request(1))
+        .concurrent_updates(UPDATE_WORKERS)  # Включаем параллельную обработку обновлений
+        .job_queue(JobQueue())  # Явно включаем поддержку job_queue
+        .persistence(SQLitePersistence(REGISTRY_DB))  # Реестр чатов переживает перезапуски
+        .post_init(post_init)  # После падения сверяем состояние и доделываем прерванную рассылку
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    # Добавление обработчиков команд
+    application.add_handler(CommandHandler("start_concert", start_concert))
+    application.add_handler(CommandHandler("stop_concert", stop_concert))
+    application.add_handler(CommandHandler("schedule", schedule_command))
+    
+    # Добавляем обработчики для secured режима
+    if MODE == 'secured':
+        application.add_handler(CommandHandler("register_chat", register_chat))
+        application.add_handler(CommandHandler("unregister_chat", unregister_chat))
+    else:  # public mode
+        # Отслеживаем добавление бота в новые чаты
+        application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, track_chat))
+        # Сбрасываем кеш администраторов при повышении и понижении участников
+        application.add_handler(ChatMemberHandler(track_chat_admins, ChatMemberHandler.CHAT_MEMBER))
+
+    # Во время концерта удаляем все, кроме видеосообщений; отдельная группа, чтобы команды тоже обрабатывались
+    if ENFORCE_CONCERT:
+        application.add_handler(MessageHandler(filters.ChatType.GROUPS & ~filters.VIDEO_NOTE, enforce_concert), group=1)
+
+    # Обновляем кеш прав бота при изменении его статуса в чатах
+    application.add_handler(ChatMemberHandler(track_bot_rights, ChatMemberHandler.MY_CHAT_MEMBER))
+
+    # Отмечаем каждое обновление до остальных обработчиков — для проверки здоровья
+    application.add_handler(TypeHandler(Update, track_update), group=-1)
+    return application
+
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Настройка логирования через очередь: запись в консоль и файл идет в отдельном потоке"""
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers: List[logging.Handler] = [logging.StreamHandler()]
+    if LOG_FILE:
+        # Ротация вместо удаления лог-файла: старые записи уходят в архивные файлы
+        if LOG_ROTATE_WHEN:
+            handlers.append(logging.handlers.TimedRotatingFileHandler(
+                LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+            ))
+        else:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+            ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # В цикле событий запись только кладется в очередь, форматирование и запись на диск — в потоке слушателя
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL)
+    # Подробные логи httpx о каждом запросе на рассылке по тысячам чатов не нужны
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    global _log_listener
+    listener = _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def flush_logging() -> None:
+    """Запись всего, что накопилось в очереди логов (перед аварийным завершением процесса)"""
+    global _log_listener
+    listener, _log_listener = _log_listener, None
+    if listener is not None:
+        listener.stop()
+
+async def _profile_startup(application: Application) -> None:
+    await application.initialize()
+    STARTUP.mark("инициализация приложения (getMe, загрузка реестра)")
+    await post_init(application)
+    STARTUP.mark("post_init")
+    try:
+        if TRANSPORT == 'polling':
+            # После start_polling бот уже ждет обновлений в getUpdates
+            await application.updater.start_polling(allowed_updates=collect_allowed_updates(application))
+            STARTUP.mark("запуск polling (deleteWebhook)")
+        STARTUP.milestone("до приема обновлений")
+        if _warm_up_task is not None:
+            await _warm_up_task
+            STARTUP.mark("фоновый прогрев до готовности (/readyz)")
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        await post_stop(application)
+        await application.shutdown()
+        await post_shutdown(application)
+
+def profile_startup() -> int:
+    """Запуск до первого ответа getUpdates с замером времени по фазам, затем остановка"""
+    problems = check_settings()
+    if problems:
+        print("Ошибки настроек: " + '; '.join(problems), file=sys.stderr)
+        return 2
+    listener = setup_logging()
+    STARTUP.mark("настройка логирования")
+    try:
+        application = build_application()
+        STARTUP.mark("создание приложения")
+        asyncio.run(_profile_startup(application))
+    finally:
+        shutdown_shard_pool()
+        listener.stop()
+    print(STARTUP.report())
+    return 0
+
+def main() -> int:
     """Запуск бота"""
     # Настройка логирования
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+    listener = setup_logging()
     logger = logging.getLogger(__name__)
 
+    problems = check_settings()
+    if problems:
+        for problem in problems:
+            logger.critical("Ошибка настроек: %s", problem)
+        listener.stop()
+        return 2
+
     try:
-        # Создание приложения с явным указанием использования job_queue
-        application = (
-            Application.builder()
-            .token(TOKEN)
-            .concurrent_updates(True)  # Включаем параллельную обработку обновлений
-            .job_queue(JobQueue())  # Явно включаем поддержку job_queue
-            .build()
-        )
+        application = build_application()
 
-        # Добавление обработчиков команд
-        application.add_handler(CommandHandler("start_concert", start_concert))
-        application.add_handler(CommandHandler("stop_concert", stop_concert))
-        
-        # Добавляем обработчики для secured режима
-        if MODE == 'secured':
-            application.add_handler(CommandHandler("register_chat", register_chat))
-            application.add_handler(CommandHandler("unregister_chat", unregister_chat))
-        else:  # public mode
-            # Отслеживаем добавление бота в новые чаты
-            application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, track_chat))
-
-        # Настройка планировщика задач с использованием cron
-        job_queue = application.job_queue
-        if job_queue:
-            # Запуск концерта по понедельникам в 8:00 МСК
-            job_queue.run_daily(
-                start_concert_job,
-                days=(2,),  # Понедельник
-                time=time(hour=8, minute=0, tzinfo=moscow_tz)
-            )
-            
-            # Остановка концерта каждый день в 23:59 МСК
-            job_queue.run_daily(
-                stop_concert_job,
-                days=(2,),  # Понедельник
-                time=time(hour=23, minute=59, tzinfo=moscow_tz)
-            )
-            
-            logger.info("Планировщик задач успешно настроен")
-            logger.info(f"Часовой пояс: {moscow_tz}")
-            logger.info("Расписание:")
-            logger.info("- Запуск концерта: каждый понедельник в 8:00 МСК")
-            logger.info("- Остановка концерта: каждый день в 23:59 МСК")
+        # Расписания чатов обслуживает ConcertScheduler, задачи в JobQueue он ставит сам в post_init
+        if application.job_queue:
+            logger.info("Часовой пояс: %s", moscow_tz)
+            logger.info("Расписание по умолчанию: %s", DEFAULT_SCHEDULE.describe())
+            logger.info("Подготовка плана: за %s мин. до запуска и остановки", PREWARM_MINUTES)
+            if SCHEDULE_JITTER > 0:
+                logger.info("Разброс срабатываний: до %s с по %s корзинам", SCHEDULE_JITTER, SCHEDULE_JITTER_BUCKETS)
         else:
             logger.error("Не удалось инициализировать планировщик задач!")
-            return
+            return 1
+
+        # Получаем только те обновления, которые обрабатывает бот
+        allowed_updates = collect_allowed_updates(application)
 
         # Запуск бота с выводом информации о запуске
-        logger.info("Бот запущен и готов к работе!")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if TRANSPORT == 'webhook':
+            settings = webhook_settings()
+            logger.info("Бот запущен в режиме webhook на %s:%s", settings['listen'], settings['port'])
+            application.run_webhook(allowed_updates=allowed_updates, **settings)
+        else:
+            logger.info("Бот запущен и готов к работе!")
+            application.run_polling(allowed_updates=allowed_updates)
+        return 0
 
-    except Exception as e:
-        logger.error(f"Критическая ошибка при запуске бота: {e}")
-        raise
+    except Exception:
+        # stdout и stderr при запуске из cron уходят в /dev/null, поэтому трассировка пишется в лог
+        logger.exception("Критическая ошибка при запуске бота")
+        return 1
+    finally:
+        shutdown_shard_pool()
+        # Дописываем оставшиеся в очереди записи
+        listener.stop()
+
+STARTUP.mark("определения модуля")
 
 if __name__ == '__main__':
-    main()
+    # --healthcheck обрабатывается в начале модуля, до тяжелых импортов
+    if '--profile-startup' in sys.argv[1:]:
+        sys.exit(profile_startup())
+    sys.exit(main())
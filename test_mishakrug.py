@@ -1,9 +1,42 @@
+import asyncio
+import copy
+import dataclasses
+import os
+import subprocess
+import sys
+import time as time_module
+import logging
+import logging.handlers
+import socket
+import httpx
 import pytest
-from datetime import datetime, time
-import pytz
+from time import perf_counter
+from datetime import datetime, time, timedelta
+import sqlite3
+from types import SimpleNamespace
 from unittest.mock import AsyncMock, MagicMock, patch
-from mishakrug import start_concert_job, moscow_tz, get_managed_chats
-from telegram import ChatMemberAdministrator
+from mishakrug import (
+    start_concert_job, moscow_tz, get_managed_chats, run_fan_out, RateLimiter,
+    get_bot_rights, track_bot_rights, ChatRegistry, SQLitePersistence,
+    build_application, collect_allowed_updates, webhook_settings,
+    is_user_admin, track_chat_admins, prepare_concert_job, prepare_concert_plan, concert_job, ConcertPlan, ConcertPlans,
+    stop_concert_job, reconcile_concert_state, resume_interrupted_run, resume_concert_job,
+    setup_logging, execute_concert_plan, shard_of, shutdown_shard_pool,
+    InstrumentedHTTPXRequest, start_metrics_server, HealthMonitor, AdminDigest, partition_by_shard,
+    ChatSchedule, ConcertScheduler, DEFAULT_SCHEDULE, DeletionQueue, enforce_concert,
+    http_request, start_fanout_bot, stop_fanout_bot, get_fanout_bot, NORMAL_PERMISSIONS,
+    parse_admin_ids, check_settings, StartupProfile, _profile_startup, schedule_command, main,
+    register_chat, unregister_chat, get_api_limiter, get_concert_scheduler, get_notify_limiter,
+    Settings
+)
+from telegram import ChatPermissions
+from telegram import ChatMemberAdministrator, ChatMemberLeft, Update, User
+from telegram.error import BadRequest, RetryAfter, TimedOut
+from telegram import Bot
+from telegram.ext import ExtBot
+from fake_bot_api import FakeApiConfig, FakeBotApi
+from bench_mishakrug import run_benchmarks, compare
+from loadtest_mishakrug import run_load, make_workload, check_registry
 
 @pytest.mark.asyncio
 async def test_start_concert_on_monday_8am():
@@ -51,3 +84,1037 @@ async def test_start_concert_on_monday_8am():
         mock_bot.get_chat_member.assert_called_once_with(123456, mock_bot.id)
         mock_bot.set_chat_permissions.assert_called_once()
         mock_bot.send_message.assert_called_once_with(123456, "Я включаю Михаила Круга")
+
+@pytest.mark.asyncio
+async def test_fan_out_bounded_concurrency_and_report():
+    # Проверяем, что одновременно обрабатывается не больше concurrency чатов
+    active = 0
+    peak = 0
+
+    async def action(chat_id, limiter):
+        nonlocal active, peak
+        await limiter.acquire(chat_id)
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        if chat_id == 7:
+            raise RuntimeError("boom")
+        return chat_id != 3  # Чат 3 пропускаем
+
+    limiter = RateLimiter(global_rate=1000, chat_rate=1000, chat_burst=10)
+    report = await run_fan_out("test", range(20), action, limiter=limiter, concurrency=4)
+
+    assert peak == 4
+    assert report.total == 20
+    assert report.succeeded == 18
+    assert report.skipped == 1
+    assert report.failures == {7: "boom"}
+    assert len(report.latencies) == 20
+    assert 0 < report.percentile(50) <= report.percentile(99)
+
+@pytest.mark.asyncio
+async def test_rate_limiter_global_rate():
+    # 10 запросов при лимите 50 в секунду и запасе 1 токен занимают не меньше ~0.18с
+    limiter = RateLimiter(global_rate=50, chat_rate=1000, chat_burst=10)
+    limiter._global.capacity = 1
+    limiter._global._tokens = 1
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    await asyncio.gather(*(limiter.acquire(chat_id) for chat_id in range(10)))
+    assert loop.time() - started >= 0.17
+
+@pytest.mark.asyncio
+async def test_overlapping_runs_share_one_process_limit():
+    # Наложившиеся рассылки (например, соседние корзины разброса) делят один общий лимит
+    async def action(chat_id, limiter):
+        await limiter.acquire(chat_id)
+
+    with patch('mishakrug.FANOUT_GLOBAL_RATE', 50), patch('mishakrug.FANOUT_CHAT_RATE', 1000):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        # 100 запросов: 50 из запаса, остальные 50 — за секунду
+        await asyncio.gather(run_fan_out("a", range(50), action), run_fan_out("b", range(50, 100), action))
+        assert loop.time() - started >= 0.9
+
+        # RetryAfter, полученный удалениями или уведомлениями, приостанавливает и рассылки
+        child = RateLimiter(chat_rate=1000, parent=get_api_limiter())
+        request = AsyncMock(side_effect=[RetryAfter(0.3), 'ok'])
+        retried = asyncio.ensure_future(child.call(1, request))
+        await asyncio.sleep(0.05)
+        started = loop.time()
+        await get_api_limiter().acquire(2)
+        assert loop.time() - started >= 0.2
+        assert await retried == 'ok'
+
+        # Процессы рассылки получают доли общего лимита, одна доля остается основному процессу
+        with get_api_limiter().lend(4) as share:
+            assert share == 10 and get_api_limiter()._global.rate == pytest.approx(10)
+        assert get_api_limiter()._global.rate == pytest.approx(50)
+
+def make_admin_member(can_restrict_members=True, can_delete_messages=True):
+    # Мок участника-администратора с нужными правами
+    member = MagicMock()
+    member.can_restrict_members = can_restrict_members
+    member.can_delete_messages = can_delete_messages
+    member.status = 'administrator'
+    member.__class__ = ChatMemberAdministrator
+    return member
+
+@pytest.mark.asyncio
+async def test_public_plan_checks_rights_concurrently_through_limiter():
+    # Список чатов строится без запросов к API, права проверяются параллельно, RetryAfter не выкидывает чат
+    in_flight = peak = 0
+    retried = set()
+
+    async def get_chat_member(chat_id, user_id):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+        if chat_id == 7 and chat_id not in retried:
+            retried.add(chat_id)
+            raise RetryAfter(0.01)
+        return make_admin_member(can_restrict_members=chat_id % 2 == 1)
+
+    mock_bot = AsyncMock(get_chat_member=AsyncMock(side_effect=get_chat_member))
+    mock_bot.id = 987654321
+    context = SimpleNamespace(bot=mock_bot, bot_data={'chat_registry': ChatRegistry(tracked=range(100))})
+
+    with patch('mishakrug.MODE', 'public'), patch('mishakrug.FANOUT_GLOBAL_RATE', 10000):
+        assert list(await get_managed_chats(context)) == list(range(100))
+        mock_bot.get_chat_member.assert_not_called()
+        started = perf_counter()
+        plan = await prepare_concert_plan(context, 'start', datetime.now(moscow_tz))
+    assert sorted(plan.chat_ids) == list(range(1, 100, 2))
+    assert peak > 1
+    assert perf_counter() - started < 1
+    assert mock_bot.get_chat_member.await_count == 101
+
+@pytest.mark.asyncio
+async def test_my_chat_member_update_refreshes_rights_cache():
+    # Первый запрос идет в API, событие my_chat_member обновляет кеш без новых запросов
+    mock_context = MagicMock()
+    mock_context.bot = AsyncMock()
+    mock_context.bot.get_chat_member.return_value = make_admin_member()
+    mock_context.bot_data = {}
+
+    assert (await get_bot_rights(mock_context, 42)).can_restrict_members
+    assert (await get_bot_rights(mock_context, 42)).can_restrict_members
+    mock_context.bot.get_chat_member.assert_called_once()
+
+    update = MagicMock()
+    update.my_chat_member.chat.id = 42
+    update.my_chat_member.new_chat_member = MagicMock(spec=ChatMemberLeft)
+    await track_bot_rights(update, mock_context)
+
+    assert not (await get_bot_rights(mock_context, 42)).is_admin
+    mock_context.bot.get_chat_member.assert_called_once()
+
+    # Кеш не сохраняется, поэтому при сбросе bot_data он не копируется
+    assert copy.deepcopy(mock_context.bot_data)['bot_rights'] is mock_context.bot_data['bot_rights']
+
+@pytest.mark.asyncio
+async def test_sqlite_persistence_writes_only_changes(tmp_path):
+    # Реестр переживает перезапуск, а в базу пишутся только изменившиеся чаты
+    persistence = SQLitePersistence(str(tmp_path / 'registry.db'))
+    bot_data = await persistence.get_bot_data()
+    registry = bot_data['chat_registry']
+    registry.add_managed(1)
+    registry.add_managed(2)
+    registry.add_tracked(3)
+    await persistence.update_bot_data(bot_data)
+
+    registry.remove_managed(2)
+    with patch.object(persistence, 'write_changes', wraps=persistence.write_changes) as write_changes:
+        await persistence.update_bot_data(bot_data)
+        await persistence.update_bot_data(bot_data)
+    write_changes.assert_called_once_with([(2, (False, False, False, False))])
+    await persistence.flush()
+
+    restored = SQLitePersistence(str(tmp_path / 'registry.db')).load_registry()
+    assert restored.managed == {1}
+    assert restored.tracked == {3}
+
+@pytest.mark.asyncio
+async def test_registration_is_written_before_reply(tmp_path):
+    # Ответ уходит, когда строка уже в базе: перезапуск сразу после него регистрацию не теряет
+    path = str(tmp_path / 'registry.db')
+    persistence = SQLitePersistence(path)
+    bot_data = await persistence.get_bot_data()
+    replies = []
+
+    async def reply_text(text):
+        stored = (await SQLitePersistence(path).get_bot_data())['chat_registry']
+        replies.append(set(stored.managed))
+
+    update = MagicMock()
+    update.effective_user.id = 1
+    update.effective_chat.id = -5
+    update.message.reply_text = reply_text
+    context = SimpleNamespace(bot_data=bot_data, application=SimpleNamespace(persistence=persistence))
+    with patch('mishakrug.MODE', 'secured'), patch('mishakrug.ADMIN_CHAT_IDS', frozenset({1})):
+        await register_chat(update, context)
+        await unregister_chat(update, context)
+    assert replies == [{-5}, set()]
+
+def test_sqlite_persistence_loads_100k_chats_fast(tmp_path):
+    # Загрузка 100 тысяч чатов при старте укладывается с запасом в секунду
+    persistence = SQLitePersistence(str(tmp_path / 'registry.db'))
+    persistence.write_changes([
+        (-1000000000000 - chat_id, (True, chat_id % 2 == 0, False, False)) for chat_id in range(100000)
+    ])
+
+    started = perf_counter()
+    registry = persistence.load_registry()
+    assert perf_counter() - started < 1.0
+    assert len(registry.managed) == 100000
+    assert len(registry.tracked) == 50000
+
+def test_allowed_updates_match_handlers(tmp_path):
+    # Бот запрашивает у Telegram только те типы обновлений, которые обрабатывает
+    with patch('mishakrug.TOKEN', '123:TEST'), patch('mishakrug.REGISTRY_DB', str(tmp_path / 'registry.db')):
+        application = build_application()
+    assert collect_allowed_updates(application) == [Update.MESSAGE, Update.MY_CHAT_MEMBER]
+
+@pytest.mark.asyncio
+async def test_webhook_accepts_only_requests_with_secret(tmp_path):
+    # Поднимаем встроенный webhook-сервер локально и отправляем в него поддельные обновления
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    with patch('mishakrug.TOKEN', '123:TEST'), \
+         patch('mishakrug.REGISTRY_DB', str(tmp_path / 'registry.db')), \
+         patch('mishakrug.WEBHOOK_URL', 'https://example.com'), \
+         patch('mishakrug.WEBHOOK_LISTEN', '127.0.0.1'), \
+         patch('mishakrug.WEBHOOK_PORT', port), \
+         patch('mishakrug.WEBHOOK_SECRET', 'secret'), \
+         patch.object(ExtBot, 'get_me', AsyncMock(return_value=User(1, 'bot', True, username='bot'))), \
+         patch.object(ExtBot, 'set_webhook', AsyncMock(return_value=True)) as set_webhook:
+        application = build_application()
+        settings = webhook_settings()
+        await application.updater.initialize()
+        await application.updater.start_webhook(allowed_updates=collect_allowed_updates(application), **settings)
+        try:
+            url = f"http://127.0.0.1:{port}/{settings['url_path']}"
+            payload = {'update_id': 1, 'message': {
+                'message_id': 1, 'date': 0, 'chat': {'id': -100, 'type': 'supergroup'}, 'text': '/start_concert'
+            }}
+            async with httpx.AsyncClient() as client:
+                denied = await client.post(url, json=payload, headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+                accepted = await client.post(url, json=payload, headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'})
+            assert denied.status_code == 403
+            assert accepted.status_code == 200
+            update = await asyncio.wait_for(application.update_queue.get(), 1)
+            assert update.message.text == '/start_concert'
+            assert application.update_queue.empty()
+            assert set_webhook.call_args.kwargs['url'] == 'https://example.com/telegram'
+            assert set_webhook.call_args.kwargs['secret_token'] == 'secret'
+        finally:
+            await application.updater.stop()
+            await application.updater.shutdown()
+
+@pytest.mark.asyncio
+async def test_benchmark_against_fake_api():
+    # Плановые задачи против локального поддельного API: 3 запроса на чат и ни одной ошибки
+    results = await run_benchmarks([50], FakeApiConfig(latency=0.001, seed=0), concurrency=8)
+    by_scenario = {item['scenario']: item for item in results}
+
+    assert by_scenario['prepare_plan_cold']['api_calls'] == 50
+    assert by_scenario['prepare_plan_warm']['api_calls'] == 0
+    for scenario in ('start_concert_job', 'stop_concert_job'):
+        assert by_scenario[scenario]['api_calls'] == 150
+        assert by_scenario[scenario]['failures'] == 0
+        assert by_scenario[scenario]['p99'] >= by_scenario[scenario]['p50']
+
+    slower = [{**item, 'wall_clock': item['wall_clock'] * 2 + 1} for item in results]
+    assert compare(results, results, 0.2) == []
+    assert len(compare(slower, results, 0.2)) == len(results)
+
+@pytest.mark.asyncio
+async def test_benchmark_reports_injected_errors():
+    # Ошибки API попадают в отчет рассылки, а не обрывают ее
+    results = await run_benchmarks([40], FakeApiConfig(error_rate=0.5, seed=1), concurrency=8)
+    start = next(item for item in results if item['scenario'] == 'start_concert_job')
+    assert start['api_errors'] > 0
+    assert 0 < start['failures'] < 40
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('mode', ['secured', 'public'])
+async def test_update_load_keeps_registry_consistent(mode):
+    # Параллельная обработка пачки команд оставляет реестр ровно в ожидаемом состоянии
+    result = await run_load(mode, updates=200, chats=20, rate=0, config=FakeApiConfig(seed=0), workers=16)
+    assert result['consistent'], result['problems']
+    assert result['api_errors'] == 0
+    assert result['p99'] >= result['p50'] > 0
+    assert result['updates_per_second'] > 0
+
+def test_registry_check_reports_lost_updates():
+    # Проверка замечает чат, команда для которого «потерялась»
+    workload, expected = make_workload('secured', 50, [-1, -2, -3], seed=1)
+    registry = ChatRegistry(managed=sorted(expected['managed'])[1:])
+    for chat_id in expected['in_concert']:
+        registry.set_concert(chat_id, True)
+    assert len(workload) == 50
+    assert check_registry(registry, expected) == ["managed: лишних 0, недостает 1"]
+
+@pytest.mark.asyncio
+async def test_admin_burst_costs_one_api_call():
+    # Пачка команд от администраторов в одном чате — один запрос get_chat_administrators
+    bot_admin = make_admin_member()
+    bot_admin.user.id = 987654321
+    owner = MagicMock(status='creator')
+    owner.user.id = 1
+
+    async def get_chat_administrators(chat_id):
+        await asyncio.sleep(0.01)
+        return [owner, bot_admin]
+
+    mock_context = MagicMock()
+    mock_context.bot = AsyncMock()
+    mock_context.bot.id = 987654321
+    mock_context.bot.get_chat_administrators = AsyncMock(side_effect=get_chat_administrators)
+    mock_context.bot_data = {}
+
+    results = await asyncio.gather(*(is_user_admin(-100, user_id % 3, mock_context) for user_id in range(30)))
+    assert results == [user_id % 3 == 1 for user_id in range(30)]
+    assert (await get_bot_rights(mock_context, -100)).can_restrict_members
+    mock_context.bot.get_chat_administrators.assert_called_once_with(-100)
+    mock_context.bot.get_chat_member.assert_not_called()
+
+    # Повышение участника сбрасывает кеш
+    update = MagicMock()
+    update.chat_member.chat.id = -100
+    update.chat_member.old_chat_member.status = 'member'
+    update.chat_member.new_chat_member.status = 'administrator'
+    await track_chat_admins(update, mock_context)
+    await is_user_admin(-100, 2, mock_context)
+    assert mock_context.bot.get_chat_administrators.call_count == 2
+
+def test_allowed_updates_public_mode(tmp_path):
+    # В public режиме бот дополнительно получает chat_member для сброса кеша администраторов
+    with patch('mishakrug.TOKEN', '123:TEST'), patch('mishakrug.MODE', 'public'), \
+         patch('mishakrug.REGISTRY_DB', str(tmp_path / 'registry.db')):
+        application = build_application()
+    assert collect_allowed_updates(application) == [Update.CHAT_MEMBER, Update.MESSAGE, Update.MY_CHAT_MEMBER]
+
+@pytest.mark.asyncio
+async def test_prepared_plan_sends_only_permission_changes_on_time():
+    # План готовится заранее; в момент срабатывания права уже не проверяются
+    mock_bot = AsyncMock()
+    mock_bot.id = 987654321
+    mock_bot.get_chat_member.return_value = make_admin_member()
+    mock_context = MagicMock()
+    mock_context.bot = mock_bot
+    mock_context.bot_data = {'chat_registry': ChatRegistry(managed=range(1, 11))}
+    target = (datetime.now(moscow_tz) + timedelta(minutes=5)).timestamp()
+    mock_context.job.data = {'kind': 'start', 'target': target, 'groups': [(DEFAULT_SCHEDULE, 0)]}
+
+    await prepare_concert_job(mock_context)
+    plan = mock_context.bot_data['concert_plans'][('start', target)].result()
+    assert isinstance(plan, ConcertPlan)
+    assert sorted(plan.chat_ids) == list(range(1, 11))
+    assert mock_bot.get_chat_member.call_count == 10
+
+    mock_bot.get_chat_member.reset_mock()
+    plan.target = datetime.now(moscow_tz)
+    report = await concert_job(mock_context)
+
+    mock_bot.get_chat_member.assert_not_called()
+    assert mock_bot.set_chat_permissions.call_count == 10
+    assert report.succeeded == 10
+    assert len(report.drifts) == 10
+    assert 0 <= report.drift_percentile(99) < 5
+    assert not mock_context.bot_data['concert_plans']
+
+@pytest.mark.asyncio
+async def test_trigger_waits_for_prepare_in_flight():
+    # Срабатывание во время подготовки дожидается ее, а не проверяет права второй раз
+    mock_bot = AsyncMock()
+    mock_bot.id = 987654321
+    checked = asyncio.Event()
+
+    async def slow_member(chat_id, user_id, **kwargs):
+        await checked.wait()
+        return make_admin_member()
+
+    mock_bot.get_chat_member.side_effect = slow_member
+    mock_context = MagicMock()
+    mock_context.bot = mock_bot
+    mock_context.bot_data = {'chat_registry': ChatRegistry(managed=range(1, 4))}
+    target = datetime.now(moscow_tz).timestamp()
+    stale = ('stop', target - 24 * 3600)
+    mock_context.bot_data['concert_plans'] = ConcertPlans({stale: asyncio.get_running_loop().create_future()})
+    mock_context.job.data = {'kind': 'start', 'target': target, 'groups': [(DEFAULT_SCHEDULE, 0)]}
+
+    prepare = asyncio.create_task(prepare_concert_job(mock_context))
+    await asyncio.sleep(0)
+    assert stale not in mock_context.bot_data['concert_plans']
+    trigger = asyncio.create_task(concert_job(mock_context))
+    await asyncio.sleep(0.05)
+    checked.set()
+    report = await trigger
+    await prepare
+
+    assert mock_bot.get_chat_member.call_count == 3
+    assert report.succeeded == 3
+    assert not mock_context.bot_data['concert_plans']
+    assert copy.deepcopy(mock_context.bot_data)['concert_plans'] is mock_context.bot_data['concert_plans']
+
+@pytest.mark.asyncio
+async def test_trigger_covers_groups_added_after_prepare():
+    # Расписание, включенное внутри PREWARM_MINUTES, не готовилось заранее, но его чаты тоже обрабатываются
+    mock_bot = AsyncMock()
+    mock_bot.id = 987654321
+    mock_bot.get_chat_member.return_value = make_admin_member()
+    registry = ChatRegistry(managed=[1, 2])
+    registry.set_schedule(2, ChatSchedule.parse('сб 10:00 12:00'))
+    mock_context = MagicMock()
+    mock_context.bot = mock_bot
+    mock_context.bot_data = {'chat_registry': registry}
+    target = datetime.now(moscow_tz).timestamp()
+    mock_context.job.data = {'kind': 'start', 'target': target, 'groups': [(DEFAULT_SCHEDULE, 0)]}
+    await prepare_concert_job(mock_context)
+    assert mock_context.bot_data['concert_plans'][('start', target)].result().chat_ids == [1]
+
+    custom = ChatSchedule.parse('пн,ср 08:00 20:00')
+    registry.set_schedule(2, custom)
+    mock_context.job.data = {'kind': 'start', 'target': target, 'groups': [(DEFAULT_SCHEDULE, 0), (custom, 0)]}
+    await concert_job(mock_context)
+    assert sorted(call.args[0] for call in mock_bot.set_chat_permissions.call_args_list) == [1, 2]
+
+def test_chat_schedule_parse_and_next_time():
+    # Дни недели задаются списком и диапазонами, остановка раньше запуска переносится на следующий день
+    schedule = ChatSchedule.parse('пн,ср-пт 08:00 23:59')
+    assert schedule.days == (0, 2, 3, 4)
+    assert ChatSchedule.parse(schedule.describe()) == schedule
+    with pytest.raises(ValueError):
+        ChatSchedule.parse('пн 25:00 23:59')
+
+    monday = datetime(2024, 3, 11, 7, 0, tzinfo=moscow_tz).timestamp()
+    assert datetime.fromtimestamp(schedule.next_time('start', monday), moscow_tz) == \
+        datetime(2024, 3, 11, 8, 0, tzinfo=moscow_tz)
+    night = ChatSchedule.parse('сб 22:00 02:00')
+    assert datetime.fromtimestamp(night.next_time('stop', monday), moscow_tz) == \
+        datetime(2024, 3, 17, 2, 0, tzinfo=moscow_tz)
+
+def test_scheduler_groups_due_entries_independently_of_chat_count():
+    # В куче лежат расписания и корзины, а не чаты: миллион чатов на одном расписании дает те же записи
+    monday = datetime(2024, 3, 11, 7, 0, tzinfo=moscow_tz).timestamp()
+    custom = ChatSchedule.parse('пн 08:00 09:00')
+    with patch('mishakrug.SCHEDULE_JITTER', 60), patch('mishakrug.SCHEDULE_JITTER_BUCKETS', 4), \
+         patch('mishakrug.PREWARM_MINUTES', 5), patch('mishakrug.DEFAULT_SCHEDULE', ChatSchedule.parse('пн 08:00 23:59')):
+        registry = ChatRegistry(managed=range(1000))
+        registry.set_schedule(7, custom)
+        scheduler = ConcertScheduler()
+        scheduler.load(registry, monday)
+        size = len(scheduler)
+        for chat_id in range(10, 1000):
+            registry.set_schedule(chat_id, custom)
+            scheduler.update(None, custom, monday)
+        assert len(scheduler) == size
+
+        # В 8:00 срабатывает корзина 0 обоих расписаний одной рассылкой, остальные — со сдвигом
+        due = scheduler.pop_due(monday + 3600)
+        runs = [batch for batch in due if batch[0] == 'run']
+        assert len(runs) == 1 and runs[0][1] == 'start'
+        assert sorted(groups[1] for groups in runs[0][3]) == [0, 0]
+        assert {action for action, *_ in due} == {'prepare', 'run'}
+        assert ConcertScheduler.bucket_of(7) == 3
+
+        # Когда у расписания не остается чатов, его записи пропускаются
+        for chat_id in [7, *range(10, 1000)]:
+            scheduler.update(registry.set_schedule(chat_id, None), None, monday)
+        later = scheduler.pop_due(monday + 4 * 3600)
+        assert all(schedule != custom for _, _, _, groups, _ in later for schedule, _ in groups)
+
+@pytest.mark.asyncio
+async def test_admin_digest_is_sent_once_per_firing_across_buckets():
+    # Ошибки всех корзин одного срабатывания уходят администраторам одной сводкой после последней корзины
+    monday = datetime(2024, 3, 11, 7, 0, tzinfo=moscow_tz).timestamp()
+    context = MagicMock()
+    context.bot.get_chat_member = AsyncMock(return_value=make_admin_member())
+    context.bot.set_chat_permissions = AsyncMock(side_effect=BadRequest("Chat not found"))
+    context.bot.send_message = AsyncMock()
+    with patch('mishakrug.SCHEDULE_JITTER', 60), patch('mishakrug.SCHEDULE_JITTER_BUCKETS', 4), \
+         patch('mishakrug.PREWARM_MINUTES', 0), patch('mishakrug.DEFAULT_SCHEDULE', ChatSchedule.parse('пн 08:00 23:59')), \
+         patch('mishakrug.MODE', 'secured'), patch('mishakrug.ADMIN_CHAT_IDS', {10, 20}), \
+         patch('mishakrug.ADMIN_NOTIFY_RATE', 1000):
+        registry = ChatRegistry(managed=range(8))
+        context.bot_data = {'chat_registry': registry}
+        scheduler = get_concert_scheduler(context.bot_data)
+        scheduler.load(registry, monday)
+
+        sent = []
+        for offset in (0, 15, 30, 45):
+            for action, kind, target, groups, firings in scheduler.pop_due(monday + 3600 + offset):
+                context.job.data = {'kind': kind, 'target': target, 'groups': groups, 'firings': firings}
+                await concert_job(context)
+            sent.append(context.bot.send_message.await_count)
+        assert get_notify_limiter() is get_notify_limiter()
+
+    assert sent == [0, 0, 0, 2]
+    assert {call.args[0] for call in context.bot.send_message.await_args_list} == {10, 20}
+    text = context.bot.send_message.await_args.args[1]
+    assert "Ошибки в 8 чатах" in text and "- Chat not found (8)" in text
+
+@pytest.mark.asyncio
+async def test_prepare_plan_selects_chats_by_schedule_group(tmp_path):
+    # В план попадают только чаты с нужным расписанием, расписания переживают перезапуск
+    custom = ChatSchedule.parse('вт 10:00 11:00 Europe/Berlin')
+    persistence = SQLitePersistence(str(tmp_path / 'registry.db'))
+    bot_data = await persistence.get_bot_data()
+    registry = bot_data['chat_registry']
+    for chat_id in (1, 2, 3):
+        registry.add_managed(chat_id)
+    registry.set_schedule(2, custom)
+    await persistence.update_bot_data(bot_data)
+    restored = (await SQLitePersistence(str(tmp_path / 'registry.db')).get_bot_data())['chat_registry']
+    assert restored.schedule_of(2) == custom and restored.schedule_of(1) == DEFAULT_SCHEDULE
+
+    mock_bot = AsyncMock()
+    mock_bot.id = 987654321
+    mock_bot.get_chat_member.return_value = make_admin_member()
+    context = SimpleNamespace(bot=mock_bot, bot_data={'chat_registry': restored})
+    plan = await prepare_concert_plan(context, 'start', datetime.now(moscow_tz), [(custom, 0)])
+    assert list(plan.chat_ids) == [2]
+
+@pytest.mark.asyncio
+async def test_schedule_change_stops_running_concert():
+    # Прежнее расписание чат уже не остановит, поэтому концерт останавливается при смене расписания
+    registry = ChatRegistry(managed=[-1])
+    registry.set_concert(-1, True)
+    update = MagicMock()
+    update.effective_user.id = 1
+    update.effective_chat.id = -1
+    update.message.reply_text = AsyncMock()
+    context = SimpleNamespace(bot=AsyncMock(), bot_data={'chat_registry': registry}, job_queue=None,
+                              args=['сб', '10:00', '12:00'])
+
+    context.bot.set_chat_permissions.side_effect = BadRequest("Not enough rights")
+    with patch('mishakrug.MODE', 'secured'), patch('mishakrug.ADMIN_CHAT_IDS', frozenset({1})):
+        await schedule_command(update, context)
+        assert registry.schedule_of(-1) == DEFAULT_SCHEDULE and registry.is_in_concert(-1)
+
+        context.bot.set_chat_permissions.side_effect = None
+        await schedule_command(update, context)
+    context.bot.set_chat_permissions.assert_awaited_with(-1, NORMAL_PERMISSIONS)
+    assert registry.schedule_of(-1) == ChatSchedule.parse('сб 10:00 12:00')
+    assert not registry.is_in_concert(-1)
+
+@pytest.mark.asyncio
+async def test_jobs_touch_only_chats_that_change_state():
+    # Остановка не трогает чаты без концерта, запуск — чаты, где концерт уже идет
+    mock_bot = AsyncMock()
+    mock_bot.id = 987654321
+    mock_bot.get_chat_member.return_value = make_admin_member()
+    registry = ChatRegistry(managed=[1, 2, 3])
+    registry.set_concert(1, True)
+    mock_context = MagicMock()
+    mock_context.bot = mock_bot
+    mock_context.bot_data = {'chat_registry': registry}
+
+    await stop_concert_job(mock_context)
+    assert [call.args[0] for call in mock_bot.set_chat_permissions.call_args_list] == [1]
+    assert registry.in_concert == set()
+
+    mock_bot.set_chat_permissions.reset_mock()
+    registry.set_concert(2, True)  # Концерт в чате 2 запустили вручную
+    await start_concert_job(mock_context)
+    assert sorted(call.args[0] for call in mock_bot.set_chat_permissions.call_args_list) == [1, 3]
+    assert registry.in_concert == {1, 2, 3}
+    assert registry.pending == set()
+
+@pytest.mark.asyncio
+async def test_reconcile_repairs_state_after_crash(tmp_path):
+    # После падения посреди рассылки состояние чатов сверяется с их реальными разрешениями
+    path = str(tmp_path / 'registry.db')
+    with sqlite3.connect(path) as connection:  # База в формате до появления состояния концерта
+        connection.execute("CREATE TABLE chats (chat_id INTEGER PRIMARY KEY, managed INTEGER NOT NULL, "
+                           "tracked INTEGER NOT NULL) WITHOUT ROWID")
+        connection.executemany("INSERT INTO chats VALUES (?, 1, 0)", [(1,), (2,)])
+    persistence = SQLitePersistence(path)
+    bot_data = await persistence.get_bot_data()
+    registry = bot_data['chat_registry']
+    assert registry.managed == {1, 2}
+    registry.mark_pending([1, 2])
+    await persistence.update_bot_data(bot_data)
+
+    restored = (await SQLitePersistence(path).get_bot_data())['chat_registry']
+    assert restored.pending == {1, 2}
+
+    async def get_chat(chat_id):
+        return MagicMock(permissions=ChatPermissions(can_send_messages=chat_id != 1))
+
+    application = SimpleNamespace(
+        bot=AsyncMock(get_chat=AsyncMock(side_effect=get_chat)),
+        bot_data={'chat_registry': restored},
+        update_persistence=AsyncMock(),
+    )
+    await reconcile_concert_state(application)
+    assert restored.pending == set()
+    assert restored.in_concert == {1}
+    application.update_persistence.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_limiter_call_honours_retry_after():
+    # На RetryAfter запрос повторяется после паузы, BadRequest не повторяется
+    limiter = RateLimiter(global_rate=1000, chat_rate=1000, chat_burst=1000)
+    request = AsyncMock(side_effect=[RetryAfter(0.1), TimedOut(), 'ok'])
+    with patch('mishakrug.FANOUT_RETRY_BACKOFF', 0.01):
+        started = perf_counter()
+        assert await limiter.call(1, request, 1, text='x') == 'ok'
+    assert perf_counter() - started >= 0.1
+    assert request.await_count == 3
+    request.assert_awaited_with(1, text='x')
+
+    failing = AsyncMock(side_effect=BadRequest("Chat not found"))
+    with pytest.raises(BadRequest):
+        await limiter.call(1, failing)
+    failing.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_interrupted_run_is_resumed(tmp_path):
+    # Рассылка, прерванная перезапуском, продолжается только для оставшихся чатов
+    persistence = SQLitePersistence(str(tmp_path / 'registry.db'))
+    registry = (await persistence.get_bot_data())['chat_registry']
+    for chat_id in (1, 2, 3):
+        registry.add_managed(chat_id)
+    registry.add_managed(4)  # Чат с другим расписанием, в прерванную рассылку не входил
+    registry.set_concert(1, True)
+    target = datetime.now(moscow_tz).replace(microsecond=0)
+    persistence.record_run('stop', target.timestamp() - 3600, [1, 2, 3, 4])
+    persistence.finish_run('stop', target.timestamp() - 3600)
+    persistence.record_run('start', target.timestamp(), [1, 2, 3])
+
+    application = SimpleNamespace(persistence=persistence, job_queue=MagicMock())
+    await resume_interrupted_run(application)
+    job_kwargs = application.job_queue.run_once.call_args.kwargs
+    assert job_kwargs['data'] == {'kind': 'start', 'target': target.timestamp(), 'chat_ids': [1, 2, 3]}
+
+    context = MagicMock()
+    context.application.persistence = persistence
+    context.bot_data = {'chat_registry': registry}
+    context.job.data = job_kwargs['data']
+    context.bot.get_chat_member = AsyncMock(return_value=make_admin_member())
+    context.bot.set_chat_permissions = AsyncMock()
+    context.bot.send_message = AsyncMock()
+    with patch('mishakrug.MODE', 'secured'):
+        report = await resume_concert_job(context)
+    assert report.total == 2
+    assert {call.args[0] for call in context.bot.set_chat_permissions.await_args_list} == {2, 3}
+    assert registry.in_concert == {1, 2, 3}
+    assert [run[:3] for run in persistence.load_runs()] == [
+        ('stop', target.timestamp() - 3600, True), ('start', target.timestamp(), True)
+    ]
+    assert list(persistence.load_runs()[1][3]) == [1, 2, 3]
+
+    # Завершенная рассылка повторно не запускается
+    application.job_queue.reset_mock()
+    await resume_interrupted_run(application)
+    application.job_queue.run_once.assert_not_called()
+
+    # Чаты, в которых после прерванной рассылки прошла другая, не продолжаются
+    persistence.record_run('stop', target.timestamp() + 60, [4, 5])
+    persistence.record_run('start', target.timestamp() + 120, [5])
+    persistence.finish_run('start', target.timestamp() + 120)
+    await resume_interrupted_run(application)
+    assert application.job_queue.run_once.call_args.kwargs['data']['chat_ids'] == [4]
+
+def test_logging_goes_through_queue_with_rotation(tmp_path):
+    # Запись в файл идет в потоке слушателя, вместо удаления лога — ротация
+    log_file = tmp_path / 'mishakrug.log'
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    try:
+        with patch('mishakrug.LOG_FILE', str(log_file)), patch('mishakrug.LOG_MAX_BYTES', 200), \
+             patch('mishakrug.LOG_BACKUP_COUNT', 2):
+            listener = setup_logging()
+        assert [type(handler) for handler in root.handlers] == [logging.handlers.QueueHandler]
+        for i in range(10):
+            logging.getLogger('mishakrug').info("Запись номер %s", i)
+        listener.stop()
+    finally:
+        root.handlers[:] = saved_handlers
+        root.setLevel(saved_level)
+
+    assert "Запись номер 9" in log_file.read_text(encoding='utf-8')
+    assert (tmp_path / 'mishakrug.log.1').exists()
+    assert not (tmp_path / 'mishakrug.log.3').exists()
+
+def test_watchdog_writes_reason_to_log_before_exit(tmp_path):
+    # os._exit не дожидается потока слушателя логов, поэтому причина перезапуска дописывается до выхода
+    log_file = tmp_path / 'mishakrug.log'
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    monitor = HealthMonitor()
+    monitor.lag = 100
+    logged_at_exit = []
+
+    def exit_(code):
+        # К моменту выхода слушатель остановлен (очередь дописана) и причина уже в файле
+        logged_at_exit.append((listener._thread is None, log_file.read_text(encoding='utf-8')))
+        raise SystemExit(code)
+
+    try:
+        with patch('mishakrug.LOG_FILE', str(log_file)), patch('mishakrug.HEALTH_LAG_INTERVAL', 0.01), \
+             patch('mishakrug.os._exit', side_effect=exit_):
+            listener = setup_logging()
+            with pytest.raises(SystemExit):
+                monitor._watch()
+        stopped, text = logged_at_exit[0]
+        assert stopped and "Бот нездоров (задержка цикла событий 100.0с)" in text
+    finally:
+        root.handlers[:] = saved_handlers
+        root.setLevel(saved_level)
+
+def test_startup_error_traceback_goes_to_log(tmp_path):
+    # При запуске из cron stdout и stderr выброшены, поэтому трассировка ошибки запуска должна быть в логе
+    log_file = tmp_path / 'mishakrug.log'
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers[:], root.level
+    try:
+        with patch('mishakrug.LOG_FILE', str(log_file)), patch('mishakrug.TOKEN', '123:TEST'), \
+             patch('mishakrug.MODE', 'secured'), patch('mishakrug.ADMIN_CHAT_IDS', frozenset({1})), \
+             patch('mishakrug.build_application', side_effect=RuntimeError("нет сети")):
+            assert main() == 1
+    finally:
+        root.handlers[:] = saved_handlers
+        root.setLevel(saved_level)
+
+    text = log_file.read_text(encoding='utf-8')
+    assert "Критическая ошибка при запуске бота" in text
+    assert "Traceback" in text and "RuntimeError: нет сети" in text
+
+@pytest.mark.asyncio
+async def test_sharded_plan_splits_chats_between_processes():
+    # Чаты делятся между процессами по chat_id, каждый процесс ходит в API через свой пул
+    chats = [-1000000000000 - i for i in range(40)]
+    assert {shard_of(chat_id, 4) for chat_id in chats} == {0, 1, 2, 3}
+
+    server = FakeBotApi()
+    server.start_in_thread()
+    registry = ChatRegistry(managed=chats)
+    context = SimpleNamespace(bot=SimpleNamespace(token='123456:SHARD'), bot_data={'chat_registry': registry})
+    plan = ConcertPlan('start', chats, datetime.now(moscow_tz))
+    try:
+        with patch('mishakrug.FANOUT_SHARDS', 4), patch('mishakrug.BOT_API_URL', server.base_url):
+            report = await execute_concert_plan(context, plan)
+            in_concert = set(registry.in_concert)
+            stop_report = await execute_concert_plan(context, ConcertPlan('stop', chats, datetime.now(moscow_tz)))
+    finally:
+        shutdown_shard_pool()
+        server.stop_thread()
+
+    assert report.total == report.succeeded == 40
+    assert len(report.drifts) == 40
+    assert in_concert == set(chats)
+    assert stop_report.succeeded == 40 and not registry.in_concert and not registry.pending
+    assert server.calls['setChatPermissions'] == 80
+    assert server.calls['sendMessage'] == server.calls['deleteMessage'] == 80
+    # Бот создается один раз на процесс пула и служит обеим фазам обеих рассылок
+    assert 1 <= server.calls['getMe'] <= 4
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_exposes_api_fan_out_and_registry_metrics():
+    # Запросы к API, итоги рассылки и размеры реестра видны на /metrics
+    server = FakeBotApi()
+    server.start_in_thread()
+    registry = ChatRegistry(managed=[1, 2, 3], tracked=[4])
+    registry.set_concert(1, True)
+    bot = Bot('123456:METRICS', base_url=server.base_url, request=InstrumentedHTTPXRequest())
+    try:
+        async with bot:
+            context = SimpleNamespace(bot=bot, bot_data={'chat_registry': registry})
+            plan = ConcertPlan('start', [2, 3], datetime.now(moscow_tz))
+            await execute_concert_plan(context, plan)
+    finally:
+        server.stop_thread()
+
+    application = SimpleNamespace(bot_data={'chat_registry': registry})
+    metrics_server = await start_metrics_server(application, '127.0.0.1', 0)
+    port = metrics_server.sockets[0].getsockname()[1]
+    try:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(f"http://127.0.0.1:{port}/metrics")
+            missing = await client.get(f"http://127.0.0.1:{port}/")
+    finally:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+
+    assert missing.status_code == 404
+    text = response.text
+    assert '# TYPE bot_api_request_duration_seconds histogram' in text
+    assert 'bot_api_requests_total{method="setChatPermissions",status="200"}' in text
+    assert '123456:METRICS' not in text
+    assert 'fanout_drift_seconds_count{job="start"}' in text
+    assert 'fanout_chats_total{job="start",phase="permissions",result="succeeded"}' in text
+    assert 'registry_chats{set="managed"} 3' in text
+    assert 'registry_chats{set="in_concert"} 3' in text
+
+@pytest.mark.asyncio
+async def test_health_reports_loop_lag_stale_polling_and_last_job():
+    # Зависший цикл событий и давно не отвечавший getUpdates делают бота нездоровым
+    monitor = HealthMonitor()
+    with patch('mishakrug.HEALTH', monitor), patch('mishakrug.HEALTH_LAG_INTERVAL', 0.05), \
+         patch('mishakrug.HEALTH_MAX_LAG', 0.2), patch('mishakrug.HEALTH_MAX_POLL_AGE', 60), \
+         patch('mishakrug.TRANSPORT', 'polling'):
+        monitor.start()
+        monitor.ready = True
+        monitor.record_job('start', error="сеть недоступна")
+        await asyncio.sleep(0.1)
+        assert monitor.status()['healthy']
+
+        time_module.sleep(0.4)  # Блокируем цикл событий
+        status = monitor.status()
+        assert not status['healthy'] and status['event_loop_lag'] >= 0.3
+        await asyncio.sleep(0.1)
+        assert monitor.status()['healthy']
+
+        application = SimpleNamespace(bot_data={})
+        metrics_server = await start_metrics_server(application, '127.0.0.1', 0)
+        port = metrics_server.sockets[0].getsockname()[1]
+        try:
+            async with httpx.AsyncClient() as client:
+                healthy = await client.get(f"http://127.0.0.1:{port}/healthz")
+                with patch('mishakrug.HEALTH_MAX_POLL_AGE', 0):
+                    stale = await client.get(f"http://127.0.0.1:{port}/readyz")
+        finally:
+            metrics_server.close()
+            await metrics_server.wait_closed()
+            await monitor.stop()
+
+    assert healthy.status_code == 200
+    assert healthy.json()['last_job']['ok'] is False
+    assert healthy.json()['last_job']['error'] == "сеть недоступна"
+    assert stale.status_code == 503
+    assert 'getUpdates' in stale.json()['problems'][0]
+
+@pytest.mark.asyncio
+async def test_mass_failure_sends_one_capped_digest_per_admin():
+    # Массовый сбой: каждому администратору одно сообщение со сводкой, а не по сообщению на чат
+    chats = list(range(1, 301))
+    context = MagicMock()
+    context.bot_data = {'chat_registry': ChatRegistry(managed=chats)}
+    context.bot.get_chat_member = AsyncMock(return_value=make_admin_member())
+    context.bot.send_message = AsyncMock()
+
+    async def set_chat_permissions(chat_id, permissions):
+        raise BadRequest("Chat not found" if chat_id % 3 else "Not enough rights")
+
+    context.bot.set_chat_permissions = AsyncMock(side_effect=set_chat_permissions)
+    with patch('mishakrug.MODE', 'secured'), patch('mishakrug.ADMIN_CHAT_IDS', {10, 20}), \
+         patch('mishakrug.ADMIN_DIGEST_MAX_LENGTH', 300), patch('mishakrug.ADMIN_NOTIFY_RATE', 1000), \
+         patch('mishakrug.FANOUT_GLOBAL_RATE', 100000):
+        report = await start_concert_job(context)
+
+    assert len(report.failures) == 300
+    assert context.bot.send_message.await_count == 2
+    assert {call.args[0] for call in context.bot.send_message.await_args_list} == {10, 20}
+    text = context.bot.send_message.await_args.args[1]
+    assert len(text) <= 300
+    assert "Ошибки в 300 чатах" in text
+    assert "- Chat not found (200): 1, 2, 4, 5" in text
+    assert "и еще 190" in text
+
+def test_admin_digest_truncates_long_error_list():
+    # Сводка не выходит за лимит длины даже при сотнях разных ошибок
+    digest = AdminDigest("Запуск планового концерта")
+    digest.add_error("сеть недоступна")
+    digest.add_failures({chat_id: f"ошибка {chat_id}" for chat_id in range(500)})
+    text = digest.render(max_length=1000)
+    assert len(text) <= 1000
+    assert text.startswith("Запуск планового концерта\nГлобальная ошибка: сеть недоступна")
+    assert text.rstrip().endswith("строк")
+
+def test_registry_snapshot_is_zero_copy_until_registry_changes():
+    # Снимок делит массивы с реестром; первое изменение реестра снимок не затрагивает
+    registry = ChatRegistry(managed=[30, -10, 20], tracked=[20, 40])
+    registry.set_concert(30, True)
+    assert len(registry) == 4
+    assert list(registry.managed) == [-10, 20, 30]
+    assert len(registry.tracked) == 2 and 40 in registry.tracked and 30 not in registry.tracked
+    assert registry.row(20) == (True, True, False, False)
+
+    snapshot = registry.snapshot()
+    assert snapshot._ids is registry._ids
+    registry.add_managed(25)
+    registry.remove_managed(-10)
+    assert list(snapshot.chats('managed')) == [-10, 20, 30]
+    assert list(registry.snapshot().chats('managed')) == [20, 25, 30]
+    assert list(registry.snapshot().chats('managed', 'tracked')) == [20, 25, 30, 40]
+    assert -10 not in registry.snapshot()  # Чат без признаков удаляется из реестра
+    assert registry.in_concert == {30}
+
+def test_partition_by_shard_keeps_sorted_order():
+    # Чаты раскладываются по процессам, внутри процесса порядок сохраняется
+    registry = ChatRegistry(managed=range(-5, 5))
+    parts = partition_by_shard(registry.snapshot().chats('managed'), 3)
+    assert [list(part) for part in parts] == [[-3, 0, 3], [-5, -2, 1, 4], [-4, -1, 2]]
+
+def make_group_message(chat_id, message_id, video_note=False):
+    update = MagicMock()
+    update.effective_message.chat_id = chat_id
+    update.effective_message.message_id = message_id
+    update.effective_message.video_note = MagicMock() if video_note else None
+    return update
+
+@pytest.mark.asyncio
+async def test_enforcement_deletes_in_batches_only_during_concert():
+    # Во время концерта удаляется все, кроме видеосообщений, пачками по 100 за вызов
+    registry = ChatRegistry(managed=[-1, -2])
+    registry.set_concert(-1, True)
+    context = SimpleNamespace(bot_data={'chat_registry': registry})
+    deletions = DeletionQueue()
+    with patch('mishakrug.DELETIONS', deletions), patch('mishakrug.ENFORCE_CHAT_RATE', 1000):
+        for message_id in range(250):
+            await enforce_concert(make_group_message(-1, message_id), context)
+        await enforce_concert(make_group_message(-1, 999, video_note=True), context)
+        await enforce_concert(make_group_message(-2, 1), context)
+        assert len(deletions) == 250
+
+        bot = AsyncMock()
+        await deletions.flush(bot)
+    assert [call.args for call in bot.delete_messages.call_args_list] == [
+        (-1, list(range(0, 100))), (-1, list(range(100, 200))), (-1, list(range(200, 250)))
+    ]
+    assert len(deletions) == 0
+
+@pytest.mark.asyncio
+async def test_enforcement_queue_is_bounded_and_flushes_on_stop():
+    # Сверх ENFORCE_QUEUE_SIZE сообщения отбрасываются, при остановке очередь дочищается
+    deletions = DeletionQueue()
+    bot = AsyncMock()
+    bot.delete_messages.side_effect = [BadRequest("Message to delete not found"), True]
+    with patch('mishakrug.ENFORCE_QUEUE_SIZE', 3), patch('mishakrug.ENFORCE_FLUSH_INTERVAL', 60):
+        deletions.start(bot)
+        assert [deletions.add(-1, 1), deletions.add(-2, 2), deletions.add(-2, 3), deletions.add(-2, 4)] == \
+            [True, True, True, False]
+        assert deletions.dropped == 1
+        await deletions.stop(bot)
+    assert bot.delete_messages.call_count == 2
+    assert len(deletions) == 0
+
+@pytest.mark.asyncio
+async def test_enforcement_chat_rate_holds_across_flushes():
+    # Досрочные сбросы одного чата не обходят ENFORCE_CHAT_RATE: ограничитель живет между сбросами
+    deletions = DeletionQueue()
+    bot = AsyncMock()
+    with patch('mishakrug.ENFORCE_CHAT_RATE', 5), patch('mishakrug.ENFORCE_FLUSH_INTERVAL', 60):
+        deletions.start(bot)
+        started = perf_counter()
+        for batch in range(3):
+            for message_id in range(100):
+                deletions.add(-1, batch * 100 + message_id)
+            await asyncio.sleep(0)
+        await deletions.stop(bot)
+    assert bot.delete_messages.call_count == 3
+    assert perf_counter() - started >= 0.35
+
+def test_enforcement_handler_registered_only_when_enabled(tmp_path):
+    # Обработчик удаления не меняет набор получаемых обновлений и включается переменной ENFORCE_CONCERT
+    with patch('mishakrug.TOKEN', '123:TEST'), patch('mishakrug.ENFORCE_CONCERT', True), \
+         patch('mishakrug.REGISTRY_DB', str(tmp_path / 'registry.db')):
+        application = build_application()
+    assert any(handler.callback is enforce_concert for handler in application.handlers[1])
+    assert collect_allowed_updates(application) == [Update.MESSAGE, Update.MY_CHAT_MEMBER]
+
+@pytest.mark.asyncio
+async def test_command_requests_do_not_queue_behind_fan_out():
+    # Рассылка занимает свой пул соединений, запрос из обработчика не ждет в очереди за ней
+    server = FakeBotApi(FakeApiConfig(latency=0.05))
+    server.start_in_thread()
+    interactive = None
+    try:
+        with patch('mishakrug.BOT_API_URL', server.base_url), patch('mishakrug.FANOUT_POOL_SIZE', 2), \
+             patch('mishakrug.HTTP_POOL_TIMEOUT', 30):
+            fanout = await start_fanout_bot('123456:TEST')
+            interactive = Bot('123456:TEST', base_url=server.base_url, request=http_request(4))
+            await interactive.initialize()
+            assert get_fanout_bot(SimpleNamespace(bot=interactive)) is fanout
+
+            # 60 запросов через 2 соединения по 50 мс — больше секунды
+            fan_out = asyncio.ensure_future(asyncio.gather(*(
+                fanout.set_chat_permissions(chat_id, NORMAL_PERMISSIONS) for chat_id in range(-60, 0)
+            )))
+            await asyncio.sleep(0.1)
+            started = perf_counter()
+            await interactive.send_message(-1, 'ping')
+            latency = perf_counter() - started
+            assert not fan_out.done()
+            await fan_out
+        assert latency < 0.5
+    finally:
+        await stop_fanout_bot()
+        if interactive is not None:
+            await interactive.shutdown()
+        server.stop_thread()
+    assert get_fanout_bot(SimpleNamespace(bot=interactive)) is interactive
+
+def test_import_without_admin_chat_id_does_not_crash():
+    # Без ADMIN_CHAT_ID модуль импортируется, а ошибку настроек сообщает check_settings при запуске
+    env = {key: value for key, value in os.environ.items() if key not in ('ADMIN_CHAT_ID', 'TELEGRAM_BOT_TOKEN')}
+    result = subprocess.run([sys.executable, '-c', 'import mishakrug; print(mishakrug.check_settings())'],
+                            env=env, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert 'TELEGRAM_BOT_TOKEN' in result.stdout and 'ADMIN_CHAT_ID' in result.stdout
+
+    # Так же и с нечисловыми значениями и неверным расписанием: их сообщает check_settings
+    env.update(CONCERT_SCHEDULE='пн 25:00 23:59', FANOUT_CONCURRENCY='много', HEALTH_MAX_LAG='5s')
+    result = subprocess.run([sys.executable, '-c', 'import mishakrug; print(mishakrug.check_settings())'],
+                            env=env, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    for name in ('CONCERT_SCHEDULE', 'FANOUT_CONCURRENCY', 'HEALTH_MAX_LAG'):
+        assert name in result.stdout
+
+    assert parse_admin_ids(' 1, -100200, abc,,') == frozenset({1, -100200})
+    with patch('mishakrug.TOKEN', '123:TEST'), patch('mishakrug.MODE', 'secured'), \
+         patch('mishakrug.ADMIN_CHAT_IDS', frozenset({1})):
+        assert check_settings() == []
+
+def test_settings_are_parsed_once_into_frozen_dataclass():
+    # Настройки читаются из окружения один раз; ошибки разбора копятся, а не роняют импорт
+    settings = Settings.from_env({'MODE': 'Public', 'ADMIN_CHAT_ID': '1,2', 'FANOUT_CONCURRENCY': '8',
+                                  'SCHEDULE_JITTER': 'много', 'HEALTH_WATCHDOG': 'yes'})
+    assert settings.mode == 'public' and settings.admin_chat_ids == frozenset()
+    assert settings.fanout_pool_size == 8 and settings.health_watchdog
+    assert settings.schedule_jitter == 0 and settings.errors == ("SCHEDULE_JITTER='много' — нужно число",)
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        settings.mode = 'secured'
+
+def test_healthcheck_exits_before_importing_telegram():
+    # Проверке здоровья из cron не нужны python-telegram-bot и asyncio: она завершается до их импорта
+    env = {key: value for key, value in os.environ.items() if key != 'METRICS_PORT'}
+    result = subprocess.run([sys.executable, '-X', 'importtime', 'mishakrug.py', '--healthcheck'],
+                            env=env, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    assert result.returncode == 2
+    assert "METRICS_PORT" in result.stderr
+    imported = [line.rsplit('|', 1)[-1].strip() for line in result.stderr.splitlines() if line.startswith('import time:')]
+    assert 'dotenv' in imported
+    assert not any(name.startswith(('telegram', 'httpx', 'asyncio', 'sqlite3')) for name in imported)
+
+@pytest.mark.asyncio
+async def test_startup_does_not_wait_for_reconcile(tmp_path):
+    # Сверка прерванных чатов идет в фоне: бот начинает принимать обновления, не дожидаясь ее
+    server = FakeBotApi(FakeApiConfig(latency=0.1))
+    server.start_in_thread()
+    path = str(tmp_path / 'registry.db')
+    SQLitePersistence(path).write_changes([(chat_id, (True, False, False, True)) for chat_id in (-1, -2, -3)])
+    profile = StartupProfile(perf_counter())
+    try:
+        with patch('mishakrug.TOKEN', '123456:TEST'), patch('mishakrug.BOT_API_URL', server.base_url), \
+             patch('mishakrug.REGISTRY_DB', path), patch('mishakrug.STARTUP', profile), \
+             patch('mishakrug.FANOUT_CHAT_RATE', 1000):
+            application = build_application()
+            await _profile_startup(application)
+    finally:
+        server.stop_thread()
+
+    phases = dict(profile.phases)
+    assert phases['post_init'] < 0.05
+    # getMe бота рассылок и getChat по 100 мс идут одновременно с запуском polling и заканчиваются после него
+    assert phases['фоновый прогрев до готовности (/readyz)'] >= 0.05
+    assert server.calls['getChat'] == 3
+    assert 'до приема обновлений' in profile.report()